@@ -1,15 +1,14 @@
 from django.conf import settings
 
-import stripe
+from longclaw.checkout.gateways.stripe import get_stripe_gateway
 
 
 def create_stripe_customer(email, name, phone):
     if not settings.STRIPE_SECRET_KEY:
         raise RuntimeError('Missing setting "STRIPE_SECRET_KEY"')
 
-    stripe.api_key = settings.STRIPE_SECRET_KEY
-
-    customer = stripe.Customer.create(
+    customer = get_stripe_gateway().request(
+        'customers.create',
         email=email,
         name=name,
         phone=phone,
@@ -24,9 +23,8 @@ def create_stripe_payment_method(name, number, exp_month, exp_year, cvc):
     if not settings.STRIPE_SECRET_KEY:
         raise RuntimeError('Missing setting "STRIPE_SECRET_KEY"')
 
-    stripe.api_key = settings.STRIPE_SECRET_KEY
-
-    payment_method = stripe.PaymentMethod.create(
+    payment_method = get_stripe_gateway().request(
+        'payment_methods.create',
         type='card',
         card={
             'number': number,
@@ -48,9 +46,8 @@ def attach_stripe_payment_method(pm_id, cust_id):
     if not settings.STRIPE_SECRET_KEY:
         raise RuntimeError('Missing setting "STRIPE_SECRET_KEY"')
 
-    stripe.api_key = settings.STRIPE_SECRET_KEY
-
-    payment_method = stripe.PaymentMethod.attach(
+    payment_method = get_stripe_gateway().request(
+        'payment_methods.attach',
         pm_id,
         customer=cust_id
     )
@@ -1,6 +1,7 @@
 from rest_framework.decorators import action
 from rest_framework import permissions, status, viewsets
 from rest_framework.response import Response
+from longclaw.basket.backends import BASKET_OPERATIONS
 from longclaw.basket.models import BasketItem
 from longclaw.basket.serializers import BasketItemSerializer
 from longclaw.basket import utils
@@ -9,6 +10,38 @@ from longclaw.utils import ProductVariant
 from .signals import basket_modified
 
 
+def invalid_operations(operations):
+    """
+    Return an error for each of ``operations`` (``(operation, variant_id, quantity)``
+    tuples) with an unknown operation or variant, or a quantity which
+    isn't positive ('set' also accepts 0, which removes the item).
+    Variants are looked up with a single query.
+    """
+    variants = ProductVariant.objects.in_bulk({
+        variant_id for operation, variant_id, _ in operations if operation != 'remove'
+    })
+    errors = []
+    for index, (operation, variant_id, quantity) in enumerate(operations):
+        if operation not in BASKET_OPERATIONS:
+            message = "Unknown operation '{}'".format(operation)
+        elif operation == 'remove':
+            continue
+        elif variant_id not in variants:
+            message = "Variant {} does not exist".format(variant_id)
+        elif quantity < (0 if operation == 'set' else 1):
+            message = "Invalid quantity {}".format(quantity)
+        else:
+            continue
+        errors.append({'index': index, 'variant_id': variant_id, 'message': message})
+    return errors
+
+
+def invalid_operations_response(errors):
+    return Response(
+        {"message": "Invalid basket operations", "errors": errors},
+        status=status.HTTP_400_BAD_REQUEST)
+
+
 class BasketViewSet(viewsets.ModelViewSet):
     """
     Viewset for interacting with a sessions 'basket' -
@@ -18,8 +51,8 @@ class BasketViewSet(viewsets.ModelViewSet):
     permission_classes = (permissions.AllowAny, )
 
     def get_queryset(self, request=None):
-        items, _ = utils.get_basket_items(request or self.request)
-        return items
+        summary, _ = utils.get_basket_summary(request or self.request)
+        return summary.items
 
     def create(self, request):
         """
@@ -31,23 +64,13 @@ class BasketViewSet(viewsets.ModelViewSet):
             variant = ProductVariant.objects.get(id=variant_id)
 
             quantity = int(request.data.get("quantity", 1))
-            items, bid = utils.get_basket_items(request)
-
-            # Check if the variant is already in the basket
-            in_basket = False
-            for item in items:
-                if item.variant.id == variant.id:
-                    item.increase_quantity(quantity)
-                    in_basket = True
-                    break
-            if not in_basket:
-                item = BasketItem(variant=variant, quantity=quantity, basket_id=bid)
-                item.save()
+            bid = utils.basket_id(request)
+            utils.get_basket_backend().add_item(bid, variant.id, quantity)
 
             serializer = BasketItemSerializer(self.get_queryset(request), many=True)
             response = Response(data=serializer.data,
                                 status=status.HTTP_201_CREATED)
-            
+
             basket_modified.send(sender=BasketItem, basket_id=bid)
 
         else:
@@ -61,19 +84,60 @@ class BasketViewSet(viewsets.ModelViewSet):
         """Put multiple items in the basket,
         removing anything that already exists
         """
-        # Delete everything in the basket
-        bid = utils.destroy_basket(request)
+        try:
+            items = [
+                (int(item_data.get('variant_id', item_data.get('variant'))),
+                 int(item_data.get('quantity', 1)))
+                for item_data in request.data
+            ]
+        except (AttributeError, TypeError, ValueError):
+            return Response(
+                {"message": "Each item requires an integer 'variant_id' and 'quantity'"},
+                status=status.HTTP_400_BAD_REQUEST)
+        errors = invalid_operations([('add', variant_id, quantity) for variant_id, quantity in items])
+        if errors:
+            return invalid_operations_response(errors)
 
-        for item_data in request.data:
-            item = BasketItem(basket_id=bid, **item_data)
-            item.save()
+        bid = utils.basket_id(request)
+        changed = utils.get_basket_backend().replace(bid, items)
 
         serializer = BasketItemSerializer(self.get_queryset(request), many=True)
         response = Response(data=serializer.data,
                             status=status.HTTP_200_OK)
-        
-        basket_modified.send(sender=BasketItem, basket_id=bid)
-        
+
+        if changed:
+            basket_modified.send(sender=BasketItem, basket_id=bid)
+
+        return response
+
+    def batch(self, request):
+        """Apply a list of operations to the basket in one go.
+        Each operation is an object with an ``op`` of 'add', 'set' or 'remove',
+        a ``variant_id`` and (except for 'remove') a ``quantity``
+        """
+        try:
+            operations = [
+                (data['op'], int(data['variant_id']), int(data.get('quantity', 1)))
+                for data in request.data
+            ]
+        except (KeyError, TypeError, ValueError):
+            return Response(
+                {"message": "Each operation requires an 'op' and a 'variant_id'"},
+                status=status.HTTP_400_BAD_REQUEST)
+        errors = invalid_operations(operations)
+        if errors:
+            return invalid_operations_response(errors)
+
+        bid = utils.basket_id(request)
+        changed = utils.get_basket_backend().apply(bid, operations)
+
+        serializer = BasketItemSerializer(self.get_queryset(request), many=True)
+        response = Response(data=serializer.data,
+                            status=status.HTTP_200_OK)
+
+        if changed:
+            basket_modified.send(sender=BasketItem, basket_id=bid)
+
         return response
 
     def destroy(self, request, variant_id=None):
@@ -81,33 +145,24 @@ class BasketViewSet(viewsets.ModelViewSet):
         Remove an item from the basket
         """
         bid = utils.basket_id(request)
-        
-        variant = ProductVariant.objects.get(id=variant_id)
-        try:
-            item = BasketItem.objects.get(
-                basket_id=bid, variant=variant)
-            item.delete()
-        except BasketItem.DoesNotExist:
-            pass
+
+        utils.get_basket_backend().remove_item(bid, variant_id)
 
         serializer = BasketItemSerializer(self.get_queryset(request), many=True)
         response = Response(data=serializer.data,
                         status=status.HTTP_200_OK)
-        
+
         basket_modified.send(sender=BasketItem, basket_id=bid)
-        
-        return response 
+
+        return response
 
     @action(detail=False, methods=['get'])
     def total_items(self, request):
         """
         Get total number of items in the basket
         """
-        n_total = 0
-        for item in self.get_queryset(request):
-            n_total += item.quantity
-
-        return Response(data={"quantity": n_total}, status=status.HTTP_200_OK)
+        summary, _ = utils.get_basket_summary(request)
+        return Response(data={"quantity": summary.unit_count}, status=status.HTTP_200_OK)
 
     @action(detail=True, methods=['get'])
     def item_count(self, request, variant_id=None):
@@ -115,9 +170,5 @@ class BasketViewSet(viewsets.ModelViewSet):
         Get quantity of a single item in the basket
         """
         bid = utils.basket_id(request)
-        item = ProductVariant.objects.get(id=variant_id)
-        try:
-            count = BasketItem.objects.get(basket_id=bid, variant=item).quantity
-        except BasketItem.DoesNotExist:
-            count = 0
+        count = utils.get_basket_backend().item_quantity(bid, variant_id)
         return Response(data={"quantity": count}, status=status.HTTP_200_OK)
@@ -0,0 +1,426 @@
+"""
+Storage backends for basket contents.
+
+The backend in use is chosen by the ``BASKET_BACKEND`` setting and is
+accessed through the functions in ``longclaw.basket.utils``.
+"""
+from decimal import Decimal
+
+from django.core.cache import caches
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import (
+    Case, Count, DecimalField, ExpressionWrapper, F, IntegerField, Sum, Value, When
+)
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from longclaw import settings
+from longclaw.basket.models import BasketItem
+from longclaw.products.models import ProductVariantBase
+from longclaw.utils import ProductVariant, variant_related_fields
+
+# Totals can only be calculated by the database when the variant model
+# does not compute its own ``price``
+DB_PRICES = ProductVariant.price is ProductVariantBase.price
+
+
+def summarise(items):
+    """Calculate the totals of already loaded basket items
+    """
+    return {
+        'line_count': len(items),
+        'unit_count': sum(item.quantity for item in items),
+        'subtotal': sum((item.total() for item in items), Decimal(0)),
+    }
+
+
+# Operations accepted by ``BasketBackend.apply``
+BASKET_OPERATIONS = ('add', 'set', 'remove')
+
+
+def merge_quantities(items):
+    """Turn ``(variant_id, quantity)`` pairs into a dict of quantities,
+    summing repeated variants and dropping lines with no quantity
+    """
+    quantities = {}
+    for variant_id, quantity in items:
+        quantities[variant_id] = quantities.get(variant_id, 0) + quantity
+    return {variant_id: quantity for variant_id, quantity in quantities.items() if quantity > 0}
+
+
+def apply_operations(quantities, operations):
+    """Return the quantities resulting from applying ``operations``,
+    ``(operation, variant_id, quantity)`` tuples, in order
+    """
+    quantities = dict(quantities)
+    for operation, variant_id, quantity in operations:
+        if operation == 'add':
+            quantities[variant_id] = quantities.get(variant_id, 0) + quantity
+        elif operation == 'set':
+            quantities[variant_id] = quantity
+        elif operation == 'remove':
+            quantities.pop(variant_id, None)
+        else:
+            raise ValueError('Unknown basket operation {}'.format(operation))
+    return merge_quantities(quantities.items())
+
+
+def supports_upsert():
+    """Whether the database supports ``INSERT ... ON CONFLICT DO UPDATE``
+    """
+    connection = connections[router.db_for_write(BasketItem)]
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 24, 0)
+    return False
+
+
+def upsert_item(basket_id, variant_id, quantity):
+    """Insert a basket line, or add ``quantity`` to it if the basket
+    already contains the variant, in a single statement
+    """
+    connection = connections[router.db_for_write(BasketItem)]
+    opts = BasketItem._meta
+    qn = connection.ops.quote_name
+    columns = [opts.get_field(name).column for name in ('basket_id', 'variant', 'quantity', 'date_added')]
+    sql = (
+        'INSERT INTO {table} ({columns}) VALUES (%s, %s, %s, %s) '
+        'ON CONFLICT ({basket_id}, {variant}) '
+        'DO UPDATE SET {quantity} = {table}.{quantity} + EXCLUDED.{quantity}'
+    ).format(
+        table=qn(opts.db_table),
+        columns=', '.join(qn(column) for column in columns),
+        basket_id=qn(columns[0]),
+        variant=qn(columns[1]),
+        quantity=qn(columns[2])
+    )
+    date_added = opts.get_field('date_added').get_db_prep_save(timezone.now(), connection)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [basket_id, variant_id, quantity, date_added])
+
+
+class BasketSummary(object):
+    """
+    The items in a basket and its line count, unit count and subtotal.
+
+    Items and totals are loaded lazily. If the items have already been
+    loaded the totals are calculated from them, otherwise they are
+    fetched from the backend without loading the items.
+    """
+
+    def __init__(self, backend, basket_id):
+        self.backend = backend
+        self.basket_id = basket_id
+
+    @cached_property
+    def items(self):
+        return list(self.backend.get_items(self.basket_id))
+
+    @cached_property
+    def totals(self):
+        if 'items' in self.__dict__:
+            return summarise(self.items)
+        return self.backend.get_totals(self.basket_id)
+
+    @property
+    def line_count(self):
+        return self.totals['line_count']
+
+    @property
+    def unit_count(self):
+        return self.totals['unit_count']
+
+    @property
+    def subtotal(self):
+        return self.totals['subtotal']
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return self.line_count
+
+    def __bool__(self):
+        return self.line_count > 0
+
+
+class BasketBackend(object):
+    """
+    Provides the interface for basket storage backends.
+
+    All methods take the ``basket_id`` of the basket to operate on.
+    Variants are referred to by their primary key so that modifying
+    a basket never requires the variant to be loaded.
+    """
+
+    def get_items(self, basket_id):
+        """Return an iterable of ``BasketItem`` for the basket,
+        with the variant and product of each item already loaded
+        """
+        raise NotImplementedError()
+
+    def get_totals(self, basket_id):
+        """Return a dict of the ``line_count``, ``unit_count`` and
+        ``subtotal`` of the basket
+        """
+        return summarise(list(self.get_items(basket_id)))
+
+    def get_summary(self, basket_id):
+        """Return a ``BasketSummary`` for the basket
+        """
+        return BasketSummary(self, basket_id)
+
+    def add_item(self, basket_id, variant_id, quantity=1):
+        """Add ``quantity`` of a variant to the basket, creating
+        the line if it is not already in the basket
+        """
+        raise NotImplementedError()
+
+    def remove_item(self, basket_id, variant_id):
+        """Remove a variant from the basket altogether
+        """
+        raise NotImplementedError()
+
+    def item_quantity(self, basket_id, variant_id):
+        """Return the quantity of a variant in the basket (0 if absent)
+        """
+        raise NotImplementedError()
+
+    def get_quantities(self, basket_id):
+        """Return a dict mapping the variant ids in the basket to their quantity
+        """
+        raise NotImplementedError()
+
+    def replace(self, basket_id, items):
+        """Replace the contents of the basket with ``items``, an
+        iterable of ``(variant_id, quantity)`` pairs.
+        Return whether the contents of the basket changed.
+        """
+        raise NotImplementedError()
+
+    def apply(self, basket_id, operations):
+        """Apply a list of ``(operation, variant_id, quantity)`` tuples,
+        where operation is one of ``BASKET_OPERATIONS``, as a single change
+        to the basket. Return whether the contents of the basket changed.
+        """
+        quantities = apply_operations(self.get_quantities(basket_id), operations)
+        return self.replace(basket_id, quantities.items())
+
+    def clear(self, basket_id):
+        """Remove everything from the basket
+        """
+        raise NotImplementedError()
+
+    def persist(self, basket_id):
+        """Make sure the basket is stored as ``BasketItem`` rows and
+        return a queryset of them. Called when checkout starts.
+        """
+        raise NotImplementedError()
+
+
+class DatabaseBasketBackend(BasketBackend):
+    """
+    Stores every basket line as a ``BasketItem`` row.
+    This is the default backend.
+    """
+
+    def get_items(self, basket_id):
+        return BasketItem.objects.filter(
+            basket_id=basket_id
+        ).select_related('variant', *variant_related_fields('variant__'))
+
+    def get_totals(self, basket_id):
+        if not DB_PRICES:
+            return super(DatabaseBasketBackend, self).get_totals(basket_id)
+        totals = BasketItem.objects.filter(basket_id=basket_id).aggregate(
+            line_count=Count('id'),
+            unit_count=Sum('quantity'),
+            subtotal=Sum(ExpressionWrapper(
+                F('quantity') * F('variant__base_price'),
+                output_field=DecimalField(max_digits=12, decimal_places=2)
+            ))
+        )
+        totals['unit_count'] = totals['unit_count'] or 0
+        totals['subtotal'] = totals['subtotal'] or Decimal(0)
+        return totals
+
+    def add_item(self, basket_id, variant_id, quantity=1):
+        if supports_upsert():
+            upsert_item(basket_id, variant_id, quantity)
+            return
+        # Increment in place; only insert if the line doesn't exist yet.
+        # A concurrent insert of the same line is caught by the unique
+        # constraint and turned into an increment.
+        lines = BasketItem.objects.filter(basket_id=basket_id, variant_id=variant_id)
+        if lines.update(quantity=F('quantity') + quantity):
+            return
+        try:
+            with transaction.atomic():
+                BasketItem.objects.create(basket_id=basket_id, variant_id=variant_id, quantity=quantity)
+        except IntegrityError:
+            lines.update(quantity=F('quantity') + quantity)
+
+    def remove_item(self, basket_id, variant_id):
+        BasketItem.objects.filter(basket_id=basket_id, variant_id=variant_id).delete()
+
+    def item_quantity(self, basket_id, variant_id):
+        quantity = BasketItem.objects.filter(
+            basket_id=basket_id, variant_id=variant_id
+        ).values_list('quantity', flat=True).first()
+        return quantity or 0
+
+    def get_quantities(self, basket_id):
+        return dict(BasketItem.objects.filter(
+            basket_id=basket_id
+        ).values_list('variant_id', 'quantity'))
+
+    def lock_quantities(self, basket_id):
+        """Like ``get_quantities`` but locks the rows of the basket until
+        the end of the transaction
+        """
+        return dict(BasketItem.objects.select_for_update().filter(
+            basket_id=basket_id
+        ).values_list('variant_id', 'quantity'))
+
+    def replace(self, basket_id, items):
+        with transaction.atomic():
+            current = self.lock_quantities(basket_id)
+            return self.write_changes(basket_id, current, merge_quantities(items))
+
+    def apply(self, basket_id, operations):
+        with transaction.atomic():
+            current = self.lock_quantities(basket_id)
+            return self.write_changes(basket_id, current, apply_operations(current, operations))
+
+    def write_changes(self, basket_id, current, quantities):
+        """Change the basket from the ``current`` quantities to ``quantities``
+        with at most one insert, one update and one delete
+        """
+        added = [variant_id for variant_id in quantities if variant_id not in current]
+        removed = [variant_id for variant_id in current if variant_id not in quantities]
+        changed = {
+            variant_id: quantity for variant_id, quantity in quantities.items()
+            if variant_id in current and current[variant_id] != quantity
+        }
+        lines = BasketItem.objects.filter(basket_id=basket_id)
+        if removed:
+            lines.filter(variant_id__in=removed).delete()
+        if changed:
+            lines.filter(variant_id__in=changed).update(quantity=Case(
+                *[When(variant_id=variant_id, then=Value(quantity)) for variant_id, quantity in changed.items()],
+                output_field=IntegerField()
+            ))
+        if added:
+            BasketItem.objects.bulk_create([
+                BasketItem(basket_id=basket_id, variant_id=variant_id, quantity=quantities[variant_id])
+                for variant_id in added
+            ])
+        return bool(added or removed or changed)
+
+    def clear(self, basket_id):
+        BasketItem.objects.filter(basket_id=basket_id).delete()
+
+    def persist(self, basket_id):
+        return self.get_items(basket_id)
+
+
+class CacheBasketBackend(BasketBackend):
+    """
+    Stores baskets in Django's cache framework.
+
+    Each basket is a single cache entry holding a list of
+    ``(variant_id, quantity, added_at)`` tuples, so browsing and adding
+    to the basket never touches the database. The basket is only copied
+    to ``BasketItem`` rows by ``persist``, when checkout starts.
+
+    The cache alias and expiry are configured by the ``BASKET_CACHE_ALIAS``
+    and ``BASKET_CACHE_TIMEOUT`` settings.
+    """
+    key_prefix = 'longclaw:basket:'
+
+    def __init__(self):
+        self.cache = caches[settings.BASKET_CACHE_ALIAS]
+        self.timeout = settings.BASKET_CACHE_TIMEOUT
+
+    def get_cache_key(self, basket_id):
+        return '{}{}'.format(self.key_prefix, basket_id)
+
+    def load(self, basket_id):
+        """Return the raw ``(variant_id, quantity, added_at)`` tuples
+        """
+        return self.cache.get(self.get_cache_key(basket_id)) or []
+
+    def store(self, basket_id, lines):
+        if lines:
+            self.cache.set(self.get_cache_key(basket_id), lines, self.timeout)
+        else:
+            self.cache.delete(self.get_cache_key(basket_id))
+
+    def get_items(self, basket_id):
+        lines = self.load(basket_id)
+        variants = ProductVariant.objects.select_related(
+            *variant_related_fields()
+        ).in_bulk([line[0] for line in lines])
+        items = []
+        for variant_id, quantity, added_at in lines:
+            variant = variants.get(variant_id)
+            # The variant may have been deleted since it was added
+            if variant is not None:
+                items.append(BasketItem(
+                    basket_id=basket_id,
+                    variant=variant,
+                    quantity=quantity,
+                    date_added=added_at
+                ))
+        return items
+
+    def add_item(self, basket_id, variant_id, quantity=1):
+        lines = self.load(basket_id)
+        for i, (line_variant_id, line_quantity, added_at) in enumerate(lines):
+            if line_variant_id == variant_id:
+                lines[i] = (variant_id, line_quantity + quantity, added_at)
+                break
+        else:
+            lines.append((variant_id, quantity, timezone.now()))
+        self.store(basket_id, lines)
+
+    def remove_item(self, basket_id, variant_id):
+        lines = self.load(basket_id)
+        self.store(basket_id, [line for line in lines if line[0] != variant_id])
+
+    def item_quantity(self, basket_id, variant_id):
+        for line_variant_id, quantity, _ in self.load(basket_id):
+            if line_variant_id == variant_id:
+                return quantity
+        return 0
+
+    def get_quantities(self, basket_id):
+        return {variant_id: quantity for variant_id, quantity, _ in self.load(basket_id)}
+
+    def replace(self, basket_id, items):
+        lines = self.load(basket_id)
+        quantities = merge_quantities(items)
+        if quantities == {variant_id: quantity for variant_id, quantity, _ in lines}:
+            return False
+        # Keep the date added of lines which are still in the basket
+        now = timezone.now()
+        added = {variant_id: added_at for variant_id, _, added_at in lines}
+        self.store(basket_id, [
+            (variant_id, quantity, added.get(variant_id, now))
+            for variant_id, quantity in quantities.items()
+        ])
+        return True
+
+    def clear(self, basket_id):
+        self.cache.delete(self.get_cache_key(basket_id))
+        # Remove anything written by a checkout which was started but not completed
+        BasketItem.objects.filter(basket_id=basket_id).delete()
+
+    def persist(self, basket_id):
+        BasketItem.objects.filter(basket_id=basket_id).delete()
+        # Built from ``get_items`` so lines for deleted variants are dropped
+        BasketItem.objects.bulk_create(self.get_items(basket_id))
+        return BasketItem.objects.filter(
+            basket_id=basket_id
+        ).select_related('variant', *variant_related_fields('variant__'))
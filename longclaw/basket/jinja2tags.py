@@ -4,8 +4,16 @@ from jinja2.ext import Extension
 
 from django.template.loader import get_template
 
-from .templatetags.basket_tags import get_basket_items
-from .utils import get_basket_items
+from .utils import get_basket_summary
+
+
+def basket_items(context):
+    """
+    Return the BasketItems in the current basket.
+    The basket is only loaded once per request.
+    """
+    summary, _ = get_basket_summary(context['request'])
+    return summary.items
 
 
 def add_to_basket_btn(variant_id, btn_class="btn btn-default", btn_text="Add To Basket"):
@@ -25,7 +33,7 @@ class LongClawBasketExtension(Extension):
         super(LongClawBasketExtension, self).__init__(environment)
 
         self.environment.globals.update({
-            'basket': jinja2.contextfunction(get_basket_items),
+            'basket': jinja2.contextfunction(basket_items),
             'add_to_basket_btn': add_to_basket_btn,
         })
 
@@ -1,25 +1,85 @@
 import datetime
+import time
 from django.core.management import BaseCommand
+from django.db import transaction
 from longclaw.basket.models import BasketItem
+from longclaw.coupon.models import Discount
+from longclaw.shipping.models import ShippingRate
 
 class Command(BaseCommand):
     """Remove old BasketItems.
     This command can be used in conjunction with e.g. a cron job
     to stop your database being polluted with abandoned basket items.
+
+    Items are deleted in batches of consecutive primary keys, each in its
+    own transaction, so that large tables are not locked for long.
+    Once a basket has no items left, its shipping rates and unused
+    discounts are deleted too.
     """
     help = "Remove baskets older than the given number of days"
 
     def add_arguments(self, parser):
         parser.add_argument('older_than_days', type=int)
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of basket items to delete per transaction')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would be deleted without deleting anything')
 
     # A command must define handle()
     def handle(self, *args, **options):
         days_old = options['older_than_days']
         today = datetime.date.today()
         date = today - datetime.timedelta(days=days_old)
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+
+        stale = BasketItem.objects.filter(date_added__lt=date)
+        counts = {'items': 0, 'rates': 0, 'discounts': 0}
+        cleaned = set()
+        last_pk = None
+        elapsed = 0
+
+        while True:
+            remaining = stale.order_by('pk')
+            if last_pk is not None:
+                remaining = remaining.filter(pk__gt=last_pk)
+            pks = list(remaining.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            batch = stale.filter(pk__gte=pks[0], pk__lte=pks[-1])
+            last_pk = pks[-1]
+
+            start = time.monotonic()
+            with transaction.atomic():
+                basket_ids = set(batch.values_list('basket_id', flat=True))
+                if not dry_run:
+                    batch.delete()
+                counts['items'] += len(pks)
+
+                # Baskets with items that are not stale are still in use
+                orphaned = basket_ids - cleaned - set(BasketItem.objects.filter(
+                    basket_id__in=basket_ids, date_added__gte=date
+                ).values_list('basket_id', flat=True))
+                cleaned.update(orphaned)
+                rates = ShippingRate.objects.filter(basket_id__in=orphaned)
+                discounts = Discount.objects.filter(basket_id__in=orphaned, consumed=False)
+                if dry_run:
+                    counts['rates'] += rates.count()
+                    counts['discounts'] += discounts.count()
+                else:
+                    counts['rates'] += rates.delete()[1].get(ShippingRate._meta.label, 0)
+                    counts['discounts'] += discounts.delete()[1].get(Discount._meta.label, 0)
+            elapsed += time.monotonic() - start
 
-        qrs = BasketItem.objects.filter(date_added__lt=date)
-        count = qrs.count()
-        qrs.delete()
+            if options['sleep']:
+                time.sleep(options['sleep'])
 
-        self.stdout.write(self.style.SUCCESS("Deleted {} basket items".format(count)))
+        rate = counts['items'] / elapsed if elapsed else 0
+        verb = "Would delete" if dry_run else "Deleted"
+        self.stdout.write(self.style.SUCCESS(
+            "{} {} basket items, {} shipping rates and {} discounts in {:.1f}s ({:.0f} rows/sec)".format(
+                verb, counts['items'], counts['rates'], counts['discounts'], elapsed, rate
+            )
+        ))
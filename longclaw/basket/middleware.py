@@ -0,0 +1,28 @@
+from django.conf import settings
+
+from longclaw.settings import BASKET_ID_COOKIE, BASKET_ID_COOKIE_AGE
+from longclaw.basket.utils import BASKET_ID_ATTR, BASKET_ID_NEW_ATTR, BASKET_ID_COOKIE_SALT
+
+
+class BasketCookieMiddleware:
+    """
+    Sets the signed basket id cookie when a basket id was issued
+    during the request. Only needed when ``BASKET_ID_COOKIE`` is set.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if BASKET_ID_COOKIE and getattr(request, BASKET_ID_NEW_ATTR, False):
+            response.set_signed_cookie(
+                BASKET_ID_COOKIE,
+                getattr(request, BASKET_ID_ATTR),
+                salt=BASKET_ID_COOKIE_SALT,
+                max_age=BASKET_ID_COOKIE_AGE,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax'
+            )
+        return response
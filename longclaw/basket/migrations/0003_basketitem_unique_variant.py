@@ -0,0 +1,33 @@
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_items(apps, schema_editor):
+    """Merge basket lines for the same variant into one,
+    so that the unique constraint can be added
+    """
+    BasketItem = apps.get_model('basket', 'BasketItem')
+    duplicates = BasketItem.objects.order_by().values('basket_id', 'variant').annotate(
+        lines=Count('id'),
+        total_quantity=Sum('quantity'),
+        first_id=Min('id')
+    ).filter(lines__gt=1)
+    for duplicate in duplicates:
+        lines = BasketItem.objects.filter(basket_id=duplicate['basket_id'], variant=duplicate['variant'])
+        lines.exclude(id=duplicate['first_id']).delete()
+        lines.update(quantity=duplicate['total_quantity'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('basket', '0002_auto_20210628_2225'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='basketitem',
+            constraint=models.UniqueConstraint(fields=('basket_id', 'variant'), name='basket_unique_variant'),
+        ),
+    ]
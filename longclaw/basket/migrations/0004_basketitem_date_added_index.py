@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('basket', '0003_basketitem_unique_variant'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='basketitem',
+            name='date_added',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
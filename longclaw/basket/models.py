@@ -1,14 +1,23 @@
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from longclaw.settings import PRODUCT_VARIANT_MODEL
+from longclaw.basket.signals import basket_modified
+from longclaw.basket.utils import bump_basket_version
 
 class BasketItem(models.Model):
     basket_id = models.CharField(max_length=32)
-    date_added = models.DateTimeField(auto_now_add=True)
+    date_added = models.DateTimeField(auto_now_add=True, db_index=True)
     quantity = models.IntegerField(default=1)
     variant = models.ForeignKey(PRODUCT_VARIANT_MODEL, unique=False, on_delete=models.CASCADE)
 
     class Meta:
         ordering = ['date_added']
+        constraints = [
+            # Also serves as the index for looking up a basket's items
+            models.UniqueConstraint(fields=['basket_id', 'variant'], name='basket_unique_variant'),
+        ]
 
     def __str__(self):
         return "{}x {}".format(self.quantity, self.variant)
@@ -25,18 +34,32 @@ class BasketItem(models.Model):
     def increase_quantity(self, quantity=1):
         """ Increase the quantity of this product in the basket
         """
-        self.quantity += quantity
-        self.save()
+        BasketItem.objects.filter(pk=self.pk).update(quantity=F('quantity') + quantity)
+        self.refresh_from_db(fields=['quantity'])
+        # ``update`` doesn't send ``post_save``
+        basket_modified.send(sender=BasketItem, basket_id=self.basket_id)
 
     def decrease_quantity(self, quantity=1):
+        """ Decrease the quantity of this product in the basket,
+        removing it once the quantity reaches zero
         """
-        """
-        self.quantity -= quantity
-        if self.quantity <= 0:
-            self.delete()
+        BasketItem.objects.filter(pk=self.pk).update(quantity=F('quantity') - quantity)
+        deleted, _ = BasketItem.objects.filter(pk=self.pk, quantity__lte=0).delete()
+        if deleted:
+            self.quantity = 0
         else:
-            self.save()
+            self.refresh_from_db(fields=['quantity'])
+        basket_modified.send(sender=BasketItem, basket_id=self.basket_id)
     
     @property
     def product(self):
         return self.variant
+
+
+@receiver(post_save, sender=BasketItem)
+def update_basket_version(sender, instance, **kwargs):
+    """Items saved outside of the basket backends (e.g. in the admin)
+    change the basket too. There is no ``post_delete`` receiver, so
+    that the backends can still delete items in a single query.
+    """
+    bump_basket_version(basket_id=instance.basket_id)
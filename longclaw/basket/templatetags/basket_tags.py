@@ -1,15 +1,16 @@
 from django import template
-from longclaw.basket.utils import get_basket_items
+from longclaw.basket.utils import get_basket_summary
 
 register = template.Library()
 
 @register.simple_tag(takes_context=True)
 def basket(context):
     """
-    Return the BasketItems in the current basket
+    Return the BasketItems in the current basket.
+    The basket is only loaded once per request.
     """
-    items, _ = get_basket_items(context["request"])
-    return items
+    summary, _ = get_basket_summary(context["request"])
+    return summary.items
 
 
 @register.inclusion_tag('longclaw/basket/add_to_basket.html')
@@ -1,4 +1,6 @@
+import datetime
 import mock
+from django.http import HttpResponse
 from django.test.client import RequestFactory
 from django.test import TestCase
 try:
@@ -6,12 +8,18 @@ try:
 except ImportError:
     from django.core.urlresolvers import reverse_lazy
 from django.core.management import call_command
+from django.utils import timezone
 from django.utils.six import StringIO
 
-from longclaw.tests.utils import LongclawTestCase, BasketItemFactory, ProductVariantFactory, catch_signal
-from longclaw.basket.utils import basket_id
+from longclaw.tests.utils import (
+    LongclawTestCase, BasketItemFactory, ProductVariantFactory, ShippingRateFactory, catch_signal
+)
+from longclaw.shipping.models import ShippingRate
+from longclaw.basket.utils import BASKET_ID_SESSION_KEY, basket_fingerprint, basket_id, get_basket_summary
+from longclaw.basket.backends import CacheBasketBackend, DatabaseBasketBackend
 from longclaw.basket.templatetags import basket_tags
 from longclaw.basket.context_processors import stripe_key
+from longclaw.basket.middleware import BasketCookieMiddleware
 from longclaw.basket.models import BasketItem
 
 from .signals import basket_modified
@@ -28,6 +36,29 @@ class CommandTests(TestCase):
         call_command('remove_stale_baskets', '1', stdout=out)
         self.assertIn('Deleted 0 basket items', out.getvalue())
 
+    def test_remove_stale_baskets_in_batches(self):
+        """Stale items are removed along with the shipping rates of
+        baskets left empty
+        """
+        old = timezone.now() - datetime.timedelta(days=10)
+        for _ in range(3):
+            BasketItemFactory(basket_id='stale')
+        BasketItemFactory(basket_id='current')
+        BasketItem.objects.filter(basket_id='stale').update(date_added=old)
+        ShippingRateFactory(basket_id='stale')
+        ShippingRateFactory(basket_id='current')
+
+        out = StringIO()
+        call_command('remove_stale_baskets', '1', '--dry-run', stdout=out)
+        self.assertIn('Would delete 3 basket items, 1 shipping rates', out.getvalue())
+        self.assertEqual(BasketItem.objects.count(), 4)
+
+        out = StringIO()
+        call_command('remove_stale_baskets', '1', '--batch-size', '2', stdout=out)
+        self.assertIn('Deleted 3 basket items, 1 shipping rates', out.getvalue())
+        self.assertEqual(list(BasketItem.objects.values_list('basket_id', flat=True)), ['current'])
+        self.assertEqual(list(ShippingRate.objects.values_list('basket_id', flat=True)), ['current'])
+
 
 class BasketTest(LongclawTestCase):
     """Round trip API tests
@@ -139,6 +170,95 @@ class BasketModifiedSignalTest(LongclawTestCase):
             signal=basket_modified,
         )
 
+    def test_batch(self):
+        """
+        Test a batch of operations sends a single signal
+        """
+        variant = ProductVariantFactory()
+        operations = [
+            {'op': 'add', 'variant_id': variant.id, 'quantity': 2},
+            {'op': 'add', 'variant_id': self.item.variant.id},
+            {'op': 'set', 'variant_id': variant.id, 'quantity': 5},
+        ]
+        with catch_signal(basket_modified) as handler:
+            response = self.post_test(operations, 'longclaw_basket_batch', format='json')
+
+        self.assertEqual(handler.call_count, 1)
+        quantities = {item['variant']['id']: item['quantity'] for item in response.data}
+        self.assertEqual(quantities, {variant.id: 5, self.item.variant.id: 1})
+
+    def test_batch_without_changes(self):
+        """
+        Test no signal is sent when a batch leaves the basket as it was
+        """
+        operations = [{'op': 'remove', 'variant_id': self.item.variant.id}]
+        with catch_signal(basket_modified) as handler:
+            self.post_test(operations, 'longclaw_basket_batch', format='json')
+
+        handler.assert_not_called()
+
+    def test_batch_invalid_operation(self):
+        operations = [{'op': 'multiply', 'variant_id': self.item.variant.id}]
+        response = self.post_test(operations, 'longclaw_basket_batch', format='json',
+                                  success_expected=False)
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_invalid_variant_and_quantity(self):
+        operations = [
+            {'op': 'add', 'variant_id': self.item.variant.id},
+            {'op': 'add', 'variant_id': 999999},
+            {'op': 'add', 'variant_id': self.item.variant.id, 'quantity': -1},
+        ]
+        with catch_signal(basket_modified) as handler:
+            response = self.post_test(operations, 'longclaw_basket_batch', format='json',
+                                      success_expected=False)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2])
+        handler.assert_not_called()
+
+    def test_bulk_update_invalid_items(self):
+        for items in ([{'variant_id': 'abc'}], [{'variant_id': 999999, 'quantity': 1}],
+                      [{'variant_id': self.item.variant.id, 'quantity': 0}]):
+            response = self.put_test(items, 'longclaw_basket_list', format='json',
+                                     success_expected=False)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(BasketItem.objects.get(pk=self.item.pk).quantity, self.item.quantity)
+
+
+@mock.patch('longclaw.basket.middleware.BASKET_ID_COOKIE', 'basket')
+@mock.patch('longclaw.basket.utils.BASKET_ID_COOKIE', 'basket')
+class BasketCookieTest(TestCase):
+
+    def setUp(self):
+        self.middleware = BasketCookieMiddleware(lambda request: HttpResponse())
+
+    def test_new_basket_id(self):
+        request = RequestFactory().get('/')
+        request.session = {}
+        bid = basket_id(request)
+        self.assertEqual(len(bid), 32)
+        self.assertEqual(basket_id(request), bid)
+        self.assertEqual(request.session, {})
+
+        response = self.middleware(request)
+        self.assertIn('basket', response.cookies)
+
+        request = RequestFactory().get('/')
+        request.COOKIES['basket'] = response.cookies['basket'].value
+        self.assertEqual(basket_id(request), bid)
+        self.assertNotIn('basket', self.middleware(request).cookies)
+
+    def test_session_basket_id_honoured(self):
+        request = RequestFactory().get('/')
+        request.session = {BASKET_ID_SESSION_KEY: 'sessionbasket'}
+        self.assertEqual(basket_id(request), 'sessionbasket')
+        self.assertIn('basket', self.middleware(request).cookies)
+
+    def test_tampered_cookie(self):
+        request = RequestFactory().get('/')
+        request.COOKIES['basket'] = 'otherbasket:forged'
+        self.assertNotEqual(basket_id(request), 'otherbasket')
+
 
 class BasketModelTest(TestCase):
 
@@ -157,3 +277,185 @@ class BasketModelTest(TestCase):
         self.item.save()
         self.item.decrease_quantity()
         self.assertEqual(self.item.quantity, 4)
+
+    def test_decrease_quantity_removes_item(self):
+        self.item.decrease_quantity()
+        self.assertFalse(BasketItem.objects.filter(pk=self.item.pk).exists())
+
+    def test_quantity_changes_modify_basket(self):
+        for change in (self.item.increase_quantity, self.item.decrease_quantity):
+            with catch_signal(basket_modified) as handler:
+                change()
+            handler.assert_called_once_with(
+                sender=BasketItem, basket_id=self.item.basket_id, signal=basket_modified
+            )
+
+
+class DatabaseBasketBackendTest(TestCase):
+
+    def setUp(self):
+        self.backend = DatabaseBasketBackend()
+        self.bid = 'dbbasket'
+        self.variant = ProductVariantFactory()
+
+    def test_add_item_merges_lines(self):
+        self.backend.add_item(self.bid, self.variant.id)
+        with self.assertNumQueries(1):
+            self.backend.add_item(self.bid, self.variant.id, 3)
+        item = BasketItem.objects.get(basket_id=self.bid)
+        self.assertEqual(item.quantity, 4)
+
+    @mock.patch('longclaw.basket.backends.supports_upsert', return_value=False)
+    def test_add_item_without_upsert(self, _):
+        self.backend.add_item(self.bid, self.variant.id)
+        self.backend.add_item(self.bid, self.variant.id, 3)
+        item = BasketItem.objects.get(basket_id=self.bid)
+        self.assertEqual(item.quantity, 4)
+
+    def test_item_quantity(self):
+        self.assertEqual(self.backend.item_quantity(self.bid, self.variant.id), 0)
+        self.backend.add_item(self.bid, self.variant.id, 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.item_quantity(self.bid, self.variant.id), 2)
+
+    def test_replace(self):
+        kept, changed, removed, added = [ProductVariantFactory() for _ in range(4)]
+        self.backend.replace(self.bid, [(kept.id, 1), (changed.id, 1), (removed.id, 1)])
+        # Lock and read, then one delete, one update and one insert (plus the savepoint)
+        with self.assertNumQueries(6):
+            self.assertTrue(self.backend.replace(self.bid, [(kept.id, 1), (changed.id, 3), (added.id, 2)]))
+        self.assertEqual(self.backend.get_quantities(self.bid), {kept.id: 1, changed.id: 3, added.id: 2})
+
+    def test_replace_unchanged(self):
+        self.backend.add_item(self.bid, self.variant.id, 2)
+        with self.assertNumQueries(3):
+            self.assertFalse(self.backend.replace(self.bid, [(self.variant.id, 2)]))
+
+    def test_apply(self):
+        other = ProductVariantFactory()
+        self.backend.add_item(self.bid, self.variant.id)
+        changed = self.backend.apply(self.bid, [
+            ('add', self.variant.id, 2),
+            ('set', other.id, 4),
+            ('remove', other.id, 1),
+            ('add', other.id, 1),
+        ])
+        self.assertTrue(changed)
+        self.assertEqual(self.backend.get_quantities(self.bid), {self.variant.id: 3, other.id: 1})
+
+
+class CacheBasketBackendTest(TestCase):
+
+    def setUp(self):
+        self.backend = CacheBasketBackend()
+        self.bid = 'cachebasket'
+        self.variant = ProductVariantFactory()
+        self.variant.refresh_from_db()
+
+    def tearDown(self):
+        self.backend.clear(self.bid)
+
+    def test_add_item(self):
+        self.backend.add_item(self.bid, self.variant.id)
+        self.backend.add_item(self.bid, self.variant.id, 2)
+        self.assertEqual(self.backend.item_quantity(self.bid, self.variant.id), 3)
+        self.assertFalse(BasketItem.objects.filter(basket_id=self.bid).exists())
+
+    def test_get_items(self):
+        self.backend.add_item(self.bid, self.variant.id, 2)
+        items = self.backend.get_items(self.bid)
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0].variant, self.variant)
+        self.assertEqual(items[0].total(), 2 * self.variant.price)
+
+    def test_remove_item(self):
+        self.backend.add_item(self.bid, self.variant.id)
+        self.backend.remove_item(self.bid, self.variant.id)
+        self.assertEqual(self.backend.item_quantity(self.bid, self.variant.id), 0)
+
+    def test_replace(self):
+        other = ProductVariantFactory()
+        self.backend.add_item(self.bid, self.variant.id)
+        self.backend.replace(self.bid, [(other.id, 4)])
+        self.assertEqual(self.backend.item_quantity(self.bid, self.variant.id), 0)
+        self.assertEqual(self.backend.item_quantity(self.bid, other.id), 4)
+
+    def test_persist(self):
+        self.backend.add_item(self.bid, self.variant.id, 2)
+        items = self.backend.persist(self.bid)
+        self.assertEqual(items.count(), 1)
+        self.assertEqual(items[0].quantity, 2)
+
+    def test_clear(self):
+        self.backend.add_item(self.bid, self.variant.id)
+        self.backend.persist(self.bid)
+        self.backend.clear(self.bid)
+        self.assertEqual(self.backend.get_items(self.bid), [])
+        self.assertFalse(BasketItem.objects.filter(basket_id=self.bid).exists())
+
+
+class BasketSummaryTest(TestCase):
+
+    def setUp(self):
+        self.bid = 'summarybasket'
+        for quantity in range(1, 31):
+            BasketItemFactory(basket_id=self.bid, quantity=quantity)
+        self.subtotal = sum(item.total() for item in BasketItem.objects.filter(basket_id=self.bid))
+
+    def test_summary_items_in_one_query(self):
+        summary = DatabaseBasketBackend().get_summary(self.bid)
+        with self.assertNumQueries(1):
+            titles = [item.variant.product.title for item in summary]
+            subtotal = summary.subtotal
+        self.assertEqual(len(titles), 30)
+        self.assertEqual(subtotal, self.subtotal)
+
+    def test_summary_totals_in_one_query(self):
+        summary = DatabaseBasketBackend().get_summary(self.bid)
+        with self.assertNumQueries(1):
+            self.assertEqual(summary.line_count, 30)
+            self.assertEqual(summary.unit_count, sum(range(1, 31)))
+            self.assertEqual(summary.subtotal, self.subtotal)
+
+    def test_empty_summary(self):
+        summary = DatabaseBasketBackend().get_summary('emptybasket')
+        self.assertFalse(summary)
+        self.assertEqual(summary.unit_count, 0)
+        self.assertEqual(summary.subtotal, 0)
+
+    def test_summary_memoised_per_request(self):
+        request = RequestFactory().get('/')
+        request.session = {BASKET_ID_SESSION_KEY: self.bid}
+        context = {'request': request}
+        with self.assertNumQueries(1):
+            for _ in range(3):
+                self.assertEqual(len(basket_tags.basket(context)), 30)
+        summary, _ = get_basket_summary(request)
+        self.assertIs(summary, get_basket_summary(request)[0])
+
+        basket_modified.send(sender=BasketItem, basket_id=self.bid)
+        self.assertIsNot(summary, get_basket_summary(request)[0])
+
+    def test_fingerprint_once_per_version(self):
+        fingerprint = basket_fingerprint(self.bid)
+        with self.assertNumQueries(0):
+            self.assertEqual(basket_fingerprint(self.bid), fingerprint)
+        self.assertNotEqual(basket_fingerprint('otherbasket'), fingerprint)
+
+    def test_fingerprint_changes_with_basket(self):
+        fingerprint = basket_fingerprint(self.bid)
+        item = BasketItem.objects.filter(basket_id=self.bid).first()
+        item.quantity += 1
+        item.save()
+        changed = basket_fingerprint(self.bid)
+        self.assertNotEqual(changed, fingerprint)
+        basket_modified.send(sender=BasketItem, basket_id=self.bid)
+        # Recomputed for the new version, from the same contents
+        self.assertEqual(basket_fingerprint(self.bid), changed)
+
+    def test_fingerprint_changes_with_price(self):
+        fingerprint = basket_fingerprint(self.bid)
+        variant = BasketItem.objects.filter(basket_id=self.bid).first().variant
+        variant.base_price += 1
+        variant.save()
+        self.assertNotEqual(basket_fingerprint(self.bid), fingerprint)
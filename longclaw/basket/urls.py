@@ -9,6 +9,10 @@ basket_list = api.BasketViewSet.as_view({
     'put': 'bulk_update'
 })
 
+basket_batch = api.BasketViewSet.as_view({
+    'post': 'batch'
+})
+
 basket_detail = api.BasketViewSet.as_view({
     'delete': 'destroy'
 })
@@ -25,6 +29,7 @@ PREFIX = API_URL_PREFIX + 'basket/'
 urlpatterns = [
     path('basket/', views.BasketView.as_view(), name='longclaw_basket'),
     path(PREFIX, basket_list, name='longclaw_basket_list'),
+    path(PREFIX + 'batch/', basket_batch, name='longclaw_basket_batch'),
     path(PREFIX + 'count/', total_items, name='longclaw_basket_total_items'),
     path(PREFIX + '<int:variant_id>/', basket_detail, name='longclaw_basket_detail'),
     path(PREFIX + '<int:variant_id>/count/', item_count, name='longclaw_basket_item_count'),
@@ -1,22 +1,82 @@
-import random
-from longclaw.basket.models import BasketItem
+import hashlib
+import secrets
+import threading
+import uuid
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from longclaw.settings import (
+    BASKET_BACKEND, BASKET_CACHE_ALIAS, BASKET_CACHE_TIMEOUT, BASKET_ID_COOKIE, PRODUCT_VARIANT_MODEL
+)
+from longclaw.basket.signals import basket_modified
 
 BASKET_ID_SESSION_KEY = 'basket_id'
 
-_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz1234567890!@#$%^&*()'
+BASKET_ID_COOKIE_SALT = 'longclaw.basket'
+
+# Request attributes used to pass the basket id from a signed cookie
+# to ``BasketCookieMiddleware``
+BASKET_ID_ATTR = '_longclaw_basket_id'
+BASKET_ID_NEW_ATTR = '_longclaw_basket_id_new'
+
+# Request attribute which holds the memoised ``BasketSummary``
+BASKET_SUMMARY_ATTR = '_longclaw_basket_summary'
+
+BASKET_VERSION_KEY = 'longclaw:basket-version:{}'
+BASKET_FINGERPRINT_KEY = 'longclaw:basket-fingerprint:{}'
+# Changes whenever a product variant (e.g. its price) is saved
+PRICES_VERSION_KEY = 'longclaw:variant-prices-version'
+
+_BACKEND = None
+
+# Counts basket modifications in this thread so that a summary memoised
+# earlier in the request can tell it is out of date
+_modifications = threading.local()
+
+
+def get_basket_backend():
+    """
+    Return the basket storage backend specified by the
+    ``BASKET_BACKEND`` setting
+    """
+    global _BACKEND
+    if _BACKEND is None:
+        _BACKEND = import_string(BASKET_BACKEND)()
+    return _BACKEND
+
 
 def basket_id(request):
+    if BASKET_ID_COOKIE:
+        return _cookie_basket_id(request)
     if not hasattr(request, 'session'):
         request.session = {}
     if request.session.get(BASKET_ID_SESSION_KEY, '') == '':
         request.session[BASKET_ID_SESSION_KEY] = _generate_basket_id()
     return request.session[BASKET_ID_SESSION_KEY]
 
+def _cookie_basket_id(request):
+    """
+    Get the basket id from the signed ``BASKET_ID_COOKIE`` cookie,
+    falling back to a basket id stored in the session. A new id is
+    generated if there is neither; the middleware then sets the cookie.
+    The session is never written to.
+    """
+    http_request = getattr(request, '_request', request)
+    bid = getattr(http_request, BASKET_ID_ATTR, None)
+    if bid:
+        return bid
+    bid = http_request.get_signed_cookie(BASKET_ID_COOKIE, default=None, salt=BASKET_ID_COOKIE_SALT)
+    if not bid:
+        session = getattr(http_request, 'session', None) or {}
+        bid = session.get(BASKET_ID_SESSION_KEY) or _generate_basket_id()
+        setattr(http_request, BASKET_ID_NEW_ATTR, True)
+    setattr(http_request, BASKET_ID_ATTR, bid)
+    return bid
+
 def _generate_basket_id():
-    basket_id = ''
-    for i in range(32):
-        basket_id += _CHARS[random.randint(0, len(_CHARS)-1)]
-    return basket_id
+    # 24 random bytes encode to exactly 32 url-safe characters
+    return secrets.token_urlsafe(24)
 
 
 def get_basket_items(request):
@@ -24,32 +84,118 @@ def get_basket_items(request):
     Get all items in the basket
     """
     bid = basket_id(request)
-    return BasketItem.objects.filter(basket_id=bid), bid
+    return get_basket_backend().get_items(bid), bid
+
+def _modification_count():
+    return getattr(_modifications, 'count', 0)
+
+@receiver(basket_modified)
+def invalidate_basket_summary(sender, **kwargs):
+    """Mark basket summaries memoised in this thread as out of date
+    """
+    _modifications.count = _modification_count() + 1
+
+def basket_version(bid):
+    """
+    Return a token which changes whenever the basket (or its discount)
+    is modified, for use in cache keys of data derived from the basket
+    """
+    cache = caches[BASKET_CACHE_ALIAS]
+    key = BASKET_VERSION_KEY.format(bid)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, BASKET_CACHE_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+@receiver(basket_modified)
+def bump_basket_version(sender=None, basket_id=None, **kwargs):
+    """Give the basket a new version
+    """
+    caches[BASKET_CACHE_ALIAS].set(BASKET_VERSION_KEY.format(basket_id), uuid.uuid4().hex, BASKET_CACHE_TIMEOUT)
+
+def prices_version():
+    """Return a token which changes whenever a product variant is modified
+    """
+    cache = caches[BASKET_CACHE_ALIAS]
+    version = cache.get(PRICES_VERSION_KEY)
+    if version is None:
+        cache.add(PRICES_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(PRICES_VERSION_KEY)
+    return version
+
+@receiver(post_save, sender=PRODUCT_VARIANT_MODEL)
+@receiver(post_delete, sender=PRODUCT_VARIANT_MODEL)
+def bump_prices_version(sender=None, **kwargs):
+    caches[BASKET_CACHE_ALIAS].set(PRICES_VERSION_KEY, uuid.uuid4().hex, None)
+
+def basket_fingerprint(bid, items=None):
+    """
+    Return a hash of the variant id, quantity and price of each item in
+    the basket. It is computed once per basket version, from ``items``
+    if they have already been loaded, and kept until the basket or a
+    product variant (e.g. its price) changes.
+    """
+    cache = caches[BASKET_CACHE_ALIAS]
+    version = (basket_version(bid), prices_version())
+    key = BASKET_FINGERPRINT_KEY.format(bid)
+    stored = cache.get(key)
+    if stored is not None and stored[0] == version:
+        return stored[1]
+    if items is None:
+        items = get_basket_backend().get_items(bid)
+    lines = sorted((item.variant_id, item.quantity, str(item.variant.price)) for item in items)
+    fingerprint = hashlib.sha1(repr(lines).encode()).hexdigest()
+    cache.set(key, (version, fingerprint), BASKET_CACHE_TIMEOUT)
+    return fingerprint
+
+def get_basket_summary(request):
+    """
+    Get a ``BasketSummary`` of the basket; its items (with variants and
+    products already loaded), line count, unit count and subtotal.
+
+    The summary is loaded once per request and shared by every caller
+    until the basket is modified (``basket_modified`` is sent).
+    """
+    bid = basket_id(request)
+    # DRF wraps the HttpRequest; memoise on the underlying request so
+    # views, template tags and the API share the summary
+    http_request = getattr(request, '_request', request)
+    memoised = getattr(http_request, BASKET_SUMMARY_ATTR, None)
+    if memoised is not None:
+        summary, count = memoised
+        if summary.basket_id == bid and count == _modification_count():
+            return summary, bid
+    summary = get_basket_backend().get_summary(bid)
+    setattr(http_request, BASKET_SUMMARY_ATTR, (summary, _modification_count()))
+    return summary, bid
+
+def persist_basket(request):
+    """
+    Make sure the basket is stored in the database, returning
+    the ``BasketItem`` queryset. Call this when checkout starts.
+    """
+    bid = basket_id(request)
+    return get_basket_backend().persist(bid), bid
 
 def destroy_basket(request):
     """Delete all items in the basket
     """
-    items, bid = get_basket_items(request)
-    for item in items:
-        item.delete()
+    bid = basket_id(request)
+    get_basket_backend().clear(bid)
+    invalidate_basket_summary(None)
+    bump_basket_version(basket_id=bid)
     return bid
 
 
 def basket_total(bid):
-    basket_items = BasketItem.objects.filter(basket_id=bid)
-    total = 0
-    for item in basket_items:
-        total += item.total()
-    return total
+    return get_basket_backend().get_totals(bid)['subtotal']
 
 
 
 def add_to_basket(bid, variant, quantity=1):
-    try:
-        basket_item = BasketItem.objects.get(basket_id=bid, variant=variant)
-        basket_item.increase_quantity(quantity)
-    except BasketItem.DoesNotExist:
-        basket_item = BasketItem.objects.create(basket_id=bid, variant=variant, quantity=quantity)
-
-    return BasketItem.objects.filter(basket_id=bid)
-
+    backend = get_basket_backend()
+    backend.add_item(bid, variant.id, quantity)
+    invalidate_basket_summary(None)
+    bump_basket_version(basket_id=bid)
+    return backend.get_items(bid)
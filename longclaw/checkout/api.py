@@ -1,14 +1,15 @@
 """
 Shipping logic and payment capture API
 """
-from django.utils import timezone
-from django.db import transaction
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework import permissions, status
 from rest_framework.response import Response
-from longclaw.basket.utils import destroy_basket
-from longclaw.checkout.utils import create_order, GATEWAY
+from longclaw.checkout.utils import create_order, finalise_order, GATEWAY
 from longclaw.checkout.errors import PaymentError
+from longclaw.checkout.idempotency import idempotent
+from longclaw.checkout.quote import get_quote
+from longclaw.shipping.utils import InvalidShippingDestination
+from longclaw.products.stock import InsufficientStock
 
 @api_view(['GET'])
 @permission_classes([permissions.AllowAny])
@@ -20,9 +21,29 @@ def create_token(request):
     token = GATEWAY.get_token(request)
     return Response({'token': token}, status=status.HTTP_200_OK)
 
-@transaction.atomic
+@api_view(['GET'])
+@permission_classes([permissions.AllowAny])
+def checkout_quote(request):
+    """
+    Get the subtotal, shipping options, discount and totals of the basket.
+    The optional ``country_code`` or ``destination`` (address id) parameters
+    select the shipping options, and ``shipping_rate_name`` the option
+    included in the totals.
+    """
+    try:
+        quote = get_quote(
+            request,
+            country_code=request.query_params.get('country_code'),
+            destination=request.query_params.get('destination'),
+            shipping_option=request.query_params.get('shipping_rate_name')
+        )
+    except InvalidShippingDestination as e:
+        return Response(data={"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(data=quote, status=status.HTTP_200_OK)
+
 @api_view(['POST'])
 @permission_classes([permissions.AllowAny])
+@idempotent
 def create_order_with_token(request):
     """
     Create an order using an existing transaction ID.
@@ -41,24 +62,24 @@ def create_order_with_token(request):
                         status=status.HTTP_400_BAD_REQUEST)
 
     # Create the order
-    order = create_order(
-        email,
-        request,
-        addresses=address,
-        shipping_option=shipping_option,
-    )
+    try:
+        order = create_order(
+            email,
+            request,
+            addresses=address,
+            shipping_option=shipping_option,
+        )
+    except InsufficientStock as e:
+        return Response(data={"message": str(e), "variant_ids": e.variant_ids},
+                        status=status.HTTP_409_CONFLICT)
 
-    order.payment_date = timezone.now()
-    order.transaction_id = transaction_id
-    order.save()
-    # Once the order has been successfully taken, we can empty the basket
-    destroy_basket(request)
+    finalise_order(order, request, transaction_id)
 
     return Response(data={"order_id": order.id}, status=status.HTTP_201_CREATED)
 
-@transaction.atomic
 @api_view(['POST'])
 @permission_classes([permissions.AllowAny])
+@idempotent
 def capture_payment(request):
     """
     Capture the payment for a basket and create an order
@@ -79,6 +100,11 @@ def capture_payment(request):
 
     'email': Email address of the customer
     'shipping': The shipping rate (in the sites' currency)
+
+    The payment gateway is called outside of any database transaction;
+    see ``longclaw.checkout.utils.create_order``.
+    Retries sent with the same ``Idempotency-Key`` header get the
+    original response; see ``longclaw.checkout.idempotency``.
     """
     # get request data
     address = request.data['address']
@@ -86,13 +112,17 @@ def capture_payment(request):
     shipping_option = request.data.get('shipping_option', None)
 
     # Capture the payment
-    order = create_order(
-        email,
-        request,
-        addresses=address,
-        shipping_option=shipping_option,
-        capture_payment=True
-    )
+    try:
+        order = create_order(
+            email,
+            request,
+            addresses=address,
+            shipping_option=shipping_option,
+            capture_payment=True
+        )
+    except InsufficientStock as e:
+        return Response(data={"message": str(e), "variant_ids": e.variant_ids},
+                        status=status.HTTP_409_CONFLICT)
     response = Response(data={"order_id": order.id},
                         status=status.HTTP_201_CREATED)
 
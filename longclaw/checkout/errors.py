@@ -2,3 +2,8 @@
 class PaymentError(Exception):
     def __init__(self, message):
         self.message = str(message)
+
+
+class GatewayUnavailable(PaymentError):
+    """Raised instead of calling a payment provider which keeps failing
+    """
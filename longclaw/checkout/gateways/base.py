@@ -1,12 +1,154 @@
-from longclaw.checkout.errors import PaymentError
+import threading
+import time
 from decimal import Decimal
 
+from longclaw import settings
+from longclaw.checkout.errors import GatewayUnavailable, PaymentError
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling a payment gateway which keeps failing.
+
+    After ``threshold`` consecutive failures the breaker opens and calls
+    fail immediately. Once ``recovery_timeout`` seconds have passed one
+    trial call is let through; if the provider answers (even with an
+    error such as a declined payment) the breaker closes again,
+    otherwise it stays open for another ``recovery_timeout`` seconds.
+    The state is kept per process.
+    """
+
+    def __init__(self, threshold, recovery_timeout):
+        self.threshold = threshold
+        self.recovery_timeout = recovery_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.recovery_timeout:
+                # Let a single trial call through
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
 class BasePayment(object):
     """
     Provides the interface for payment backends and
     can function as a dummy backend for testing.
+
+    Gateways which talk to a payment provider create their client in
+    ``create_client``; it is created once, on first use, and shared by
+    every thread. Calls to the provider go through ``call``, which
+    retries calls that are safe to repeat and stops calling a provider
+    which keeps failing (see ``CircuitBreaker``).
     """
 
+    # Errors raised by the client when the provider could not be reached
+    # or is failing (e.g. connection errors, timeouts and server errors),
+    # as opposed to the payment being declined
+    transient_errors = ()
+
+    # Errors after which it is unknown whether the provider took the
+    # payment (e.g. a timeout once the request was sent); the order is
+    # left 'Awaiting Payment' to be checked against the provider
+    ambiguous_errors = ()
+
+    _client = None
+    _breaker = None
+    _lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        """The (connect, read) timeout in seconds for calls to the provider
+        """
+        return (settings.PAYMENT_GATEWAY_CONNECT_TIMEOUT, settings.PAYMENT_GATEWAY_READ_TIMEOUT)
+
+    def create_client(self):
+        """
+        Create the client used to call the payment provider, with
+        ``timeout`` (and connection pooling, where the provider's SDK
+        supports it). Should be overridden in gateway implementations.
+        """
+        return None
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self.create_client()
+        return self._client
+
+    @property
+    def breaker(self):
+        if self._breaker is None:
+            with self._lock:
+                if self._breaker is None:
+                    self._breaker = CircuitBreaker(
+                        settings.PAYMENT_GATEWAY_FAILURE_THRESHOLD,
+                        settings.PAYMENT_GATEWAY_RECOVERY_TIMEOUT
+                    )
+        return self._breaker
+
+    def close(self):
+        """Close the client's connections; a new client is created on next use
+        """
+        with self._lock:
+            client, self._client = self._client, None
+        if hasattr(client, 'close'):
+            client.close()
+
+    def call(self, func, *args, idempotent=False, **kwargs):
+        """
+        Call ``func`` (a client method) with ``args`` and ``kwargs``.
+        Calls which are ``idempotent`` are retried, with exponential
+        backoff, when they fail with one of ``transient_errors``.
+        Raises ``GatewayUnavailable`` without calling the provider
+        while the circuit breaker is open.
+        """
+        retries = settings.PAYMENT_GATEWAY_MAX_RETRIES if idempotent else 0
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise GatewayUnavailable(
+                    'The payment provider is currently unavailable, please try again later'
+                )
+            try:
+                result = func(*args, **kwargs)
+            except self.transient_errors:
+                self.breaker.record_failure()
+                if attempt >= retries:
+                    raise
+                time.sleep(settings.PAYMENT_GATEWAY_RETRY_BACKOFF * 2 ** attempt)
+                attempt += 1
+            except Exception:
+                # The provider answered (e.g. declined the payment)
+                self.breaker.record_success()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
     def create_payment(self, request, amount, description='', metadata={}):
         """
         Dummy function for creating a payment through a payment gateway.
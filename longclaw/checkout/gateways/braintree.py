@@ -1,26 +1,60 @@
 import braintree
+from braintree.exceptions import (
+    GatewayTimeoutError,
+    RequestTimeoutError,
+    ServerError,
+    ServiceUnavailableError,
+    TooManyRequestsError,
+)
+
+# Errors after which a sale may or may not have been made
+AMBIGUOUS_ERRORS = (
+    GatewayTimeoutError,
+    TimeoutError,
+)
+from braintree.exceptions.http import ConnectionError, TimeoutError
 from longclaw import settings
 from longclaw.configuration.models import Configuration
 from longclaw.checkout.errors import PaymentError
 from longclaw.checkout.gateways import BasePayment
 
+# Errors raised when Braintree could not be reached or is failing
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    GatewayTimeoutError,
+    RequestTimeoutError,
+    ServerError,
+    ServiceUnavailableError,
+    TimeoutError,
+    TooManyRequestsError,
+)
+
+
 class BraintreePayment(BasePayment):
     """
     Create a payment using Braintree
     """
-    def __init__(self):
+    transient_errors = TRANSIENT_ERRORS
+    ambiguous_errors = AMBIGUOUS_ERRORS
+
+    def create_client(self):
         if settings.BRAINTREE_SANDBOX:
             env = braintree.Environment.Sandbox
         else:
             env = braintree.Environment.Production
-        braintree.Configuration.configure(env,
-                                          merchant_id=settings.BRAINTREE_MERCHANT_ID,
-                                          public_key=settings.BRAINTREE_PUBLIC_KEY,
-                                          private_key=settings.BRAINTREE_PRIVATE_KEY)
+        # A gateway of its own, rather than the global braintree configuration
+        return braintree.BraintreeGateway(braintree.Configuration(
+            env,
+            merchant_id=settings.BRAINTREE_MERCHANT_ID,
+            public_key=settings.BRAINTREE_PUBLIC_KEY,
+            private_key=settings.BRAINTREE_PRIVATE_KEY,
+            timeout=self.timeout[1]
+        ))
 
     def create_payment(self, request, amount, description='', metadata={}):
         nonce = request.POST.get('payment_method_nonce')
-        result = braintree.Transaction.sale({
+        # Not retried; a sale can't be repeated safely
+        result = self.call(self.client.transaction.sale, {
             "amount": str(amount),
             "payment_method_nonce": nonce,
             "options": {
@@ -33,7 +67,7 @@ class BraintreePayment(BasePayment):
 
     def get_token(self, request=None):
         # Generate client token
-        return braintree.ClientToken.generate()
+        return self.call(self.client.client_token.generate, idempotent=True)
 
     def client_js(self):
         return (
@@ -43,7 +77,7 @@ class BraintreePayment(BasePayment):
         )
 
     def issue_refund(self, identifier, amount):
-        result = braintree.Transaction.refund(identifier, amount)
+        result = self.call(self.client.transaction.refund, identifier, amount)
         return result.is_success
 
 
@@ -51,13 +85,23 @@ class PaypalVZeroPayment(BasePayment):
     """
     Create a payment using the Paypal/Braintree v.zero SDK
     """
-    def __init__(self):
-        self.gateway = braintree.BraintreeGateway(access_token=settings.VZERO_ACCESS_TOKEN)
+    transient_errors = TRANSIENT_ERRORS
+    ambiguous_errors = AMBIGUOUS_ERRORS
+
+    def create_client(self):
+        return braintree.BraintreeGateway(
+            access_token=settings.VZERO_ACCESS_TOKEN,
+            timeout=self.timeout[1]
+        )
+
+    @property
+    def gateway(self):
+        return self.client
 
     def create_payment(self, request, amount, description=''):
         config = Configuration.for_request(request)
         nonce = request.POST.get('payment_method_nonce')
-        result = self.gateway.transaction.sale({
+        result = self.call(self.gateway.transaction.sale, {
             "amount": str(amount),
             "payment_method_nonce": nonce,
             "merchant_account_id": config.currency,
@@ -72,7 +116,7 @@ class PaypalVZeroPayment(BasePayment):
         return result.transaction.order_id
 
     def get_token(self, request):
-        return self.gateway.client_token.generate()
+        return self.call(self.gateway.client_token.generate, idempotent=True)
 
     def client_js(self):
         return (
@@ -1,5 +1,10 @@
 import math
+import uuid
 import stripe
+try:
+    from stripe import RequestsClient
+except ImportError:
+    from stripe.http_client import RequestsClient
 from longclaw.settings import STRIPE_SECRET_KEY
 from longclaw.configuration.models import Configuration
 from longclaw.checkout.errors import PaymentError
@@ -10,13 +15,47 @@ class StripePayment(BasePayment):
     """
     Create a payment using stripe
     """
+    transient_errors = (
+        stripe.error.APIConnectionError,
+        stripe.error.APIError,
+        stripe.error.RateLimitError,
+    )
+    # The connection may have failed after the charge was sent
+    ambiguous_errors = (
+        stripe.error.APIConnectionError,
+    )
+
     def __init__(self):
-        stripe.api_key = STRIPE_SECRET_KEY
+        self.api_key = STRIPE_SECRET_KEY
+
+    def create_client(self):
+        # A client of its own, with a pooled HTTP client, rather than the
+        # library's global configuration (``stripe.api_key`` and
+        # ``stripe.default_http_client``)
+        return stripe.StripeClient(
+            self.api_key,
+            http_client=RequestsClient(timeout=self.timeout),
+            max_network_retries=0,  # Retried by ``call``
+        )
+
+    def request(self, method, *args, **params):
+        """
+        Call a method of the gateway's ``StripeClient`` by name, e.g.
+        ``request('charges.create', amount=100)``. Every request is sent
+        with an idempotency key, so it is retried safely if Stripe can't
+        be reached.
+        """
+        func = getattr(self.client, 'v1', self.client)
+        for name in method.split('.'):
+            func = getattr(func, name)
+        options = {'idempotency_key': uuid.uuid4().hex}
+        return self.call(func, *args, params=params, options=options, idempotent=True)
 
     def create_payment(self, request, amount, description='', metadata={}):
         try:
             currency = Configuration.for_request(request).currency
-            charge = stripe.Charge.create(
+            charge = self.request(
+                'charges.create',
                 amount=int(math.ceil(amount * 100)),  # Amount in pence
                 currency=currency.lower(),
                 source=request.POST.get('stripeToken'),
@@ -26,6 +65,8 @@ class StripePayment(BasePayment):
             return charge.id
         except stripe.error.CardError as error:
             raise PaymentError(error.user_message)
+        except (PaymentError,) + self.ambiguous_errors:
+            raise
         except Exception as e:
             raise PaymentError(f'An unexpected error occured: {str(e)}')
             # raise PaymentError('An unexpected error occured, please try again')
@@ -33,7 +74,8 @@ class StripePayment(BasePayment):
     def get_token(self, request):
         """ Create a stripe token for a card
         """
-        return stripe.Token.create(
+        return self.request(
+            'tokens.create',
             card={
                 "number": request.POST["number"],
                 "exp_month": request.POST["exp_month"],
@@ -44,8 +86,28 @@ class StripePayment(BasePayment):
         )
 
     def issue_refund(self, identifier, amount):
-        result = stripe.Refund.create(
+        result = self.request(
+            'refunds.create',
             charge=identifier,
             amount=int(math.ceil(amount * 100))
         )
         return result.status == 'succeeded'
+
+
+_stripe_gateway = None
+
+
+def get_stripe_gateway():
+    """
+    Return the ``StripePayment`` gateway, for calls to Stripe outside of
+    checkout (e.g. customers and subscriptions). This is the payment
+    gateway itself when it is Stripe, so they share the client and
+    circuit breaker.
+    """
+    global _stripe_gateway
+    from longclaw.utils import GATEWAY
+    if isinstance(GATEWAY, StripePayment):
+        return GATEWAY
+    if _stripe_gateway is None:
+        _stripe_gateway = StripePayment()
+    return _stripe_gateway
@@ -0,0 +1,121 @@
+"""
+Idempotency keys for the checkout API.
+
+A client sends an ``Idempotency-Key`` header with a checkout request and
+may safely retry it with the same key. The first request with a key runs
+the view and stores its response in the cache (``CHECKOUT_IDEMPOTENCY_CACHE_ALIAS``)
+for ``CHECKOUT_IDEMPOTENCY_TIMEOUT`` seconds; retries get the stored
+response without creating another order or calling the payment gateway.
+
+A retry which arrives while the first request is still running waits
+(up to ``CHECKOUT_IDEMPOTENCY_WAIT`` seconds) for its response. Keys are
+scoped to the endpoint and the basket, and reusing a key with a different
+request body is rejected.
+"""
+import hashlib
+import json
+import time
+import uuid
+from functools import wraps
+
+from django.core.cache import caches
+from rest_framework import status
+from rest_framework.response import Response
+
+from longclaw import settings
+from longclaw.basket.utils import basket_id
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+KEY_MAX_LENGTH = 255
+
+# Seconds before the lock of a request which never finished (e.g. its
+# process was killed) expires, letting a retry run the request again
+LOCK_TIMEOUT = 5 * 60
+
+# Seconds between checks for the response of an in-flight request
+POLL_INTERVAL = 0.1
+
+key_prefix = 'longclaw:idempotency:'
+
+
+def get_cache():
+    return caches[settings.CHECKOUT_IDEMPOTENCY_CACHE_ALIAS]
+
+
+def get_cache_key(request, key):
+    scope = '{}:{}:{}'.format(request.path, basket_id(request), key)
+    return key_prefix + hashlib.sha256(scope.encode()).hexdigest()
+
+
+def fingerprint(request):
+    """A hash of the request body, to detect a key reused for another request
+    """
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def replay(stored, request_fingerprint):
+    if stored['fingerprint'] != request_fingerprint:
+        return Response(
+            {'message': 'This {} was used with a different request'.format(IDEMPOTENCY_HEADER)},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+    response = Response(stored['data'], status=stored['status'])
+    response[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def idempotent(view):
+    """
+    Make a function based API view idempotent for requests which
+    send an ``Idempotency-Key`` header. Requests without the header
+    are not affected.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view(request, *args, **kwargs)
+        if len(key) > KEY_MAX_LENGTH:
+            return Response(
+                {'message': '{} must be at most {} characters'.format(IDEMPOTENCY_HEADER, KEY_MAX_LENGTH)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        cache = get_cache()
+        cache_key = get_cache_key(request, key)
+        lock_key = cache_key + ':lock'
+        request_fingerprint = fingerprint(request)
+        token = uuid.uuid4().hex
+
+        deadline = time.monotonic() + settings.CHECKOUT_IDEMPOTENCY_WAIT
+        while True:
+            stored = cache.get(cache_key)
+            if stored is not None:
+                return replay(stored, request_fingerprint)
+            # Only one request with the key runs at a time
+            if cache.add(lock_key, token, LOCK_TIMEOUT):
+                break
+            if time.monotonic() >= deadline:
+                return Response(
+                    {'message': 'A request with this {} is still in progress'.format(IDEMPOTENCY_HEADER)},
+                    status=status.HTTP_409_CONFLICT
+                )
+            time.sleep(POLL_INTERVAL)
+
+        try:
+            response = view(request, *args, **kwargs)
+            # Errors (exceptions) are not stored, so the request can be retried
+            cache.set(cache_key, {
+                'fingerprint': request_fingerprint,
+                'status': response.status_code,
+                'data': response.data,
+            }, settings.CHECKOUT_IDEMPOTENCY_TIMEOUT)
+        finally:
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+        return response
+
+    return wrapper
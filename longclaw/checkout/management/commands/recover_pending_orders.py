@@ -0,0 +1,37 @@
+import datetime
+from django.core.management import BaseCommand
+from django.utils import timezone
+from longclaw.checkout.utils import pending_orders, release_pending_orders
+from longclaw.settings import CHECKOUT_PENDING_TIMEOUT
+
+class Command(BaseCommand):
+    """Give back the stock of orders left 'Awaiting Payment'.
+    Orders are reserved before the payment is taken; if the process dies
+    before the payment is recorded, or the gateway doesn't answer, the order
+    stays 'Awaiting Payment' with its stock reserved. Run this regularly
+    (e.g. with a cron job), then check the orders it lists against the payment
+    gateway; each payment's description includes the order id.
+    """
+    help = "Release the stock of orders which have been awaiting payment for too long"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-minutes', type=int, default=CHECKOUT_PENDING_TIMEOUT,
+                            help='Release orders whose checkout started more than this many minutes ago')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report the orders which would be released without changing them')
+
+    def handle(self, *args, **options):
+        older_than = timezone.now() - datetime.timedelta(minutes=options['older_than_minutes'])
+        if options['dry_run']:
+            order_ids = list(pending_orders(older_than).exclude(basket_id=None).values_list('id', flat=True))
+            self.stdout.write(self.style.SUCCESS("Would release {} orders: {}".format(
+                len(order_ids), ', '.join(str(order_id) for order_id in order_ids)
+            )))
+            return
+        count = release_pending_orders(older_than)
+        self.stdout.write(self.style.SUCCESS("Released the stock of {} orders awaiting payment".format(count)))
+        order_ids = list(pending_orders(older_than).values_list('id', flat=True))
+        if order_ids:
+            self.stdout.write(self.style.WARNING("Check the payments of orders {} against the gateway".format(
+                ', '.join(str(order_id) for order_id in order_ids)
+            )))
@@ -0,0 +1,129 @@
+"""
+Checkout quotes: the subtotal, shipping options, discount and totals of a
+basket, calculated together so a checkout page needs a single request.
+
+Quotes are cached (``CHECKOUT_QUOTE_CACHE_ALIAS``) under the basket's
+version and the destination address's version, which change whenever the
+basket, its discount or the address is modified. Changes to shipping
+rates, coupons or the shop configuration are picked up once the cached
+quote expires after ``CHECKOUT_QUOTE_TIMEOUT`` seconds.
+"""
+import hashlib
+
+from django.core.cache import caches
+
+from longclaw import settings
+from longclaw.basket.utils import basket_id, basket_version, get_basket_summary
+from longclaw.configuration.models import Configuration
+from longclaw.coupon.models import Discount
+from longclaw.coupon.utils import discount_total
+from longclaw.shipping.models import Address, ShippingRate
+from longclaw.shipping.serializers import ShippingRateSerializer
+from longclaw.shipping.utils import InvalidShippingDestination, address_version, get_shipping_options
+
+key_prefix = 'longclaw:quote:'
+
+
+def get_cache():
+    return caches[settings.CHECKOUT_QUOTE_CACHE_ALIAS]
+
+
+def get_cache_key(bid, shop_settings, country_code=None, destination=None, shipping_option=None):
+    parts = [bid, basket_version(bid), shop_settings.pk, country_code or '', shipping_option or '']
+    if destination:
+        parts.extend([destination, address_version(destination)])
+    scope = ':'.join(str(part) for part in parts)
+    return key_prefix + hashlib.sha256(scope.encode()).hexdigest()
+
+
+def default_shipping_rate(shop_settings):
+    """The shipping rate shown before a destination is known
+    """
+    shipping_rate = ShippingRate.objects.first()
+    if shipping_rate:
+        return shipping_rate.rate
+    return shop_settings.default_shipping_rate
+
+
+def discount_data(discount, total):
+    if not discount:
+        return None
+    _, saved = discount_total(total, discount)
+    coupon = discount.coupon
+    return {
+        'id': discount.id,
+        'code': coupon.code,
+        'type': coupon.discount_type,
+        'value': coupon.discount_value,
+        'description': coupon.description,
+        'saved': saved,
+    }
+
+
+def calculate_quote(request, shop_settings, country_code=None, destination=None, shipping_option=None):
+    summary, bid = get_basket_summary(request)
+
+    shipping_options = []
+    shipping_rate = None
+    if country_code or destination:
+        if destination:
+            try:
+                destination = Address.objects.select_related('country').get(pk=destination)
+            except (Address.DoesNotExist, ValueError):
+                raise InvalidShippingDestination("Address not found")
+        rates, report = get_shipping_options(
+            shop_settings, country_code=country_code, basket_id=bid, destination=destination
+        )
+        rates = list(rates)
+        incomplete = bool(report['late'] or report['failed'])
+        shipping_options = ShippingRateSerializer(rates, many=True).data
+        selected = [rate for rate in rates if rate.name == shipping_option] or rates[:1]
+        if selected:
+            shipping_option = selected[0].name
+            shipping_rate = selected[0].rate
+        else:
+            shipping_option = None
+            if shop_settings.default_shipping_enabled:
+                shipping_rate = shop_settings.default_shipping_rate
+    else:
+        shipping_option = None
+        shipping_rate = default_shipping_rate(shop_settings)
+        incomplete = False
+
+    subtotal = summary.subtotal
+    total = subtotal + (shipping_rate or 0)
+    discount = Discount.objects.filter(basket_id=bid, order=None).select_related('coupon').last()
+    grand_total, _ = discount_total(total, discount)
+    return {
+        'line_count': summary.line_count,
+        'unit_count': summary.unit_count,
+        'subtotal': subtotal,
+        'shipping_options': list(shipping_options),
+        'shipping_options_incomplete': incomplete,
+        'shipping_option': shipping_option,
+        'shipping_rate': shipping_rate,
+        'discount': discount_data(discount, total),
+        'total': total,
+        'grand_total': grand_total,
+    }
+
+
+def get_quote(request, country_code=None, destination=None, shipping_option=None):
+    """
+    Return the quote for the basket of the request. ``destination`` is the
+    id of the shipping address; if neither it nor ``country_code`` is given
+    the quote uses the default shipping rate.
+    Raises ``InvalidShippingDestination`` if the address does not exist or
+    is required for the rates of the country.
+    """
+    shop_settings = Configuration.for_request(request)
+    bid = basket_id(request)
+    cache = get_cache()
+    cache_key = get_cache_key(bid, shop_settings, country_code, destination, shipping_option)
+    quote = cache.get(cache_key)
+    if quote is None:
+        quote = calculate_quote(request, shop_settings, country_code, destination, shipping_option)
+        # Quotes missing the rates of late or failed processors aren't kept
+        if not quote['shipping_options_incomplete']:
+            cache.set(cache_key, quote, settings.CHECKOUT_QUOTE_TIMEOUT)
+    return quote
@@ -1,7 +1,18 @@
+import datetime
+import json
 import uuid
+import mock
+from django.core.management import call_command
+from django.db import connection
+from django.utils import timezone
 from django.utils.encoding import force_text
+from django.utils.six import StringIO
 from django.test import TestCase
 from django.test.client import RequestFactory
+from django.core.cache import cache
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
 from wagtail.core.models import Site
 try:
     from django.urls import reverse_lazy
@@ -16,10 +27,24 @@ from longclaw.tests.utils import (
     OrderFactory
 )
 from longclaw.shipping.models import ShippingRate
-from longclaw.checkout.utils import create_order
+from longclaw.checkout.utils import create_order, finalise_order
+from longclaw.products.models import StockReservation
+from longclaw.products.stock import InsufficientStock
+from longclaw.utils import ProductVariant
+from longclaw.checkout.errors import GatewayUnavailable, PaymentError
+from longclaw.checkout.gateways import BasePayment
+from longclaw.checkout.gateways.base import CircuitBreaker
+from longclaw.checkout import idempotency
+from longclaw.checkout.api import checkout_quote
+from longclaw.checkout.quote import get_quote
+from longclaw.coupon.models import Coupon, Discount
+from longclaw.basket.signals import basket_modified
+from longclaw.shipping.signals import address_modified
+from longclaw.orders.models import Order
 from longclaw.checkout.forms import CheckoutForm
 from longclaw.checkout.views import CheckoutView
 from longclaw.checkout.templatetags import longclawcheckout_tags as tags
+from longclaw.basket.models import BasketItem
 from longclaw.basket.utils import basket_id
 
 
@@ -84,6 +109,299 @@ class CheckoutApiTest(LongclawTestCase):
         self.get_test('longclaw_checkout_token')
 
 
+class StagedCheckoutTest(TestCase):
+
+    def setUp(self):
+        self.request = RequestFactory().post('/')
+        self.request.session = {}
+        self.basket_id = basket_id(self.request)
+        BasketItemFactory(basket_id=self.basket_id)
+        BasketItemFactory(basket_id=self.basket_id)
+        self.address = AddressFactory()
+
+    def checkout(self):
+        return create_order(
+            'test@test.com',
+            self.request,
+            shipping_address=self.address,
+            billing_address=self.address,
+            capture_payment=True
+        )
+
+    def test_payment_outside_transaction(self):
+        savepoints = len(connection.savepoint_ids)
+
+        def create_payment(request, amount, description=''):
+            # The order has been reserved and no transaction is open
+            self.assertEqual(len(connection.savepoint_ids), savepoints)
+            order = Order.objects.get()
+            self.assertEqual(order.status, Order.PENDING)
+            self.assertEqual(amount, order.items_total)
+            self.assertIn('#{}'.format(order.id), description)
+            return 'transaction'
+
+        with mock.patch('longclaw.checkout.utils.GATEWAY.create_payment', side_effect=create_payment):
+            order = self.checkout()
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.SUBMITTED)
+        self.assertEqual(order.transaction_id, 'transaction')
+        self.assertIsNotNone(order.payment_date)
+        self.assertEqual(order.items.count(), 2)
+        self.assertFalse(BasketItem.objects.filter(basket_id=self.basket_id).exists())
+
+    def test_payment_failure(self):
+        with mock.patch('longclaw.checkout.utils.GATEWAY.create_payment',
+                        side_effect=PaymentError('Card declined')):
+            order = self.checkout()
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.FAILURE)
+        self.assertEqual(order.status_note, 'Card declined')
+        self.assertTrue(BasketItem.objects.filter(basket_id=self.basket_id).exists())
+
+    def limit_stock(self):
+        variant_ids = BasketItem.objects.filter(basket_id=self.basket_id).values_list('variant_id', flat=True)
+        stock = ProductVariant.objects.filter(id__in=list(variant_ids))
+        stock.update(stock=1)
+        return stock
+
+    @mock.patch('longclaw.checkout.utils.STOCK_RESERVATIONS', True)
+    def test_gateway_error_fails_order(self):
+        stock = self.limit_stock()
+        with mock.patch('longclaw.checkout.utils.GATEWAY.transient_errors', (ConnectionError,), create=True), \
+                mock.patch('longclaw.checkout.utils.GATEWAY.create_payment', side_effect=ConnectionError()):
+            order = self.checkout()
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.FAILURE)
+        self.assertEqual(order.status_note, 'The payment provider could not be reached')
+        self.assertEqual(list(stock.values_list('stock', flat=True)), [1, 1])
+        self.assertFalse(StockReservation.objects.exists())
+
+    @mock.patch('longclaw.checkout.utils.STOCK_RESERVATIONS', True)
+    def test_unexpected_gateway_error_fails_order(self):
+        stock = self.limit_stock()
+        with mock.patch('longclaw.checkout.utils.GATEWAY.create_payment', side_effect=RuntimeError()):
+            with self.assertRaises(RuntimeError):
+                self.checkout()
+        order = Order.objects.get()
+        self.assertEqual(order.status, Order.FAILURE)
+        self.assertEqual(list(stock.values_list('stock', flat=True)), [1, 1])
+
+    @mock.patch('longclaw.checkout.utils.STOCK_RESERVATIONS', True)
+    def test_gateway_timeout_leaves_order_pending(self):
+        stock = self.limit_stock()
+        with mock.patch('longclaw.checkout.utils.GATEWAY.ambiguous_errors', (TimeoutError,), create=True), \
+                mock.patch('longclaw.checkout.utils.GATEWAY.create_payment', side_effect=TimeoutError()):
+            order = self.checkout()
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.PENDING)
+        self.assertEqual(order.status_note, 'The payment could not be confirmed')
+        # The payment may have been taken, so the stock stays reserved
+        self.assertEqual(list(stock.values_list('stock', flat=True)), [0, 0])
+        self.assertEqual(StockReservation.objects.filter(basket_id=self.basket_id).count(), 2)
+
+    @mock.patch('longclaw.checkout.utils.STOCK_RESERVATIONS', True)
+    def test_prepaid_order_takes_stock(self):
+        variants = [item.variant for item in BasketItem.objects.filter(basket_id=self.basket_id)]
+        ProductVariant.objects.filter(id__in=[variant.id for variant in variants]).update(stock=1)
+        order = create_order('test@test.com', self.request, shipping_address=self.address,
+                             billing_address=self.address)
+        finalise_order(order, self.request, 'transaction')
+        stock = ProductVariant.objects.filter(id__in=[variant.id for variant in variants])
+        self.assertEqual(list(stock.values_list('stock', flat=True)), [0, 0])
+        self.assertFalse(StockReservation.objects.exists())
+
+    @mock.patch('longclaw.checkout.utils.STOCK_RESERVATIONS', True)
+    def test_prepaid_order_insufficient_stock(self):
+        variant = BasketItem.objects.filter(basket_id=self.basket_id).first().variant
+        ProductVariant.objects.filter(id=variant.id).update(stock=0)
+        with self.assertRaises(InsufficientStock):
+            create_order('test@test.com', self.request, shipping_address=self.address,
+                         billing_address=self.address)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(ProductVariant.objects.get(id=variant.id).stock, 0)
+
+    @mock.patch('longclaw.checkout.utils.STOCK_RESERVATIONS', True)
+    def test_recover_pending_orders(self):
+        stock = self.limit_stock()
+        with mock.patch('longclaw.checkout.utils.GATEWAY.create_payment', side_effect=KeyboardInterrupt()):
+            with self.assertRaises(KeyboardInterrupt):
+                self.checkout()
+        stale = Order.objects.get()
+        Order.objects.filter(id=stale.id).update(created_date=timezone.now() - datetime.timedelta(hours=1))
+        recent = OrderFactory(status=Order.PENDING, basket_id='recent')
+        out = StringIO()
+        call_command('recover_pending_orders', '--dry-run', stdout=out)
+        self.assertIn('Would release 1 orders: {}'.format(stale.id), out.getvalue())
+        self.assertEqual(list(stock.values_list('stock', flat=True)), [0, 0])
+        call_command('recover_pending_orders', stdout=out)
+        self.assertIn('Released the stock of 1 orders awaiting payment', out.getvalue())
+        self.assertIn('Check the payments of orders {} against the gateway'.format(stale.id), out.getvalue())
+        self.assertEqual(list(stock.values_list('stock', flat=True)), [1, 1])
+        stale.refresh_from_db()
+        recent.refresh_from_db()
+        # The payment may have been taken, so the order isn't failed
+        self.assertEqual(stale.status, Order.PENDING)
+        self.assertIsNone(stale.basket_id)
+        self.assertEqual(recent.basket_id, 'recent')
+
+        call_command('recover_pending_orders', stdout=out)
+        self.assertIn('Released the stock of 0 orders awaiting payment', out.getvalue())
+
+    @mock.patch('longclaw.checkout.utils.STOCK_RESERVATIONS', True)
+    def test_recover_pending_orders_keeps_newer_checkout(self):
+        stock = self.limit_stock()
+        with mock.patch('longclaw.checkout.utils.GATEWAY.create_payment', side_effect=KeyboardInterrupt()):
+            with self.assertRaises(KeyboardInterrupt):
+                self.checkout()
+        stale = Order.objects.get()
+        Order.objects.filter(id=stale.id).update(created_date=timezone.now() - datetime.timedelta(hours=1))
+        # The basket was checked out again, replacing its reservations
+        OrderFactory(status=Order.PENDING, basket_id=self.basket_id)
+        call_command('recover_pending_orders', stdout=StringIO())
+        self.assertEqual(list(stock.values_list('stock', flat=True)), [0, 0])
+
+
+class IdempotencyTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.calls = []
+
+        @api_view(['POST'])
+        @idempotency.idempotent
+        def view(request):
+            self.calls.append(request.data)
+            return Response({'order_id': len(self.calls)}, status=201)
+        self.view = view
+
+    def post(self, data, key='key', basket='basket'):
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        request = APIRequestFactory().post('/checkout/', data, format='json', **headers)
+        request.session = {'basket_id': basket}
+        return self.view(request)
+
+    def test_replay(self):
+        first = self.post({'email': 'a@test.com'})
+        second = self.post({'email': 'a@test.com'})
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second[idempotency.REPLAYED_HEADER], 'true')
+
+    def test_keys_are_scoped(self):
+        self.post({}, key='key')
+        self.post({}, key='other')
+        self.post({}, key='key', basket='other')
+        self.post({}, key=None)
+        self.post({}, key=None)
+        self.assertEqual(len(self.calls), 5)
+
+    def test_key_reused_with_different_body(self):
+        self.post({'email': 'a@test.com'})
+        response = self.post({'email': 'b@test.com'})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_waits_for_in_flight_request(self):
+        request = APIRequestFactory().post('/checkout/', {}, format='json')
+        request.session = {'basket_id': 'basket'}
+        cache_key = idempotency.get_cache_key(request, 'key')
+        cache.add(cache_key + ':lock', 'other request')
+
+        def finish_other_request(seconds):
+            cache.set(cache_key, {
+                'fingerprint': idempotency.fingerprint(mock.Mock(data={})),
+                'status': 201,
+                'data': {'order_id': 7},
+            })
+
+        with mock.patch('longclaw.checkout.idempotency.time.sleep', side_effect=finish_other_request) as sleep:
+            response = self.post({})
+        sleep.assert_called_once()
+        self.assertEqual(response.data, {'order_id': 7})
+        self.assertEqual(self.calls, [])
+
+    def test_in_flight_timeout(self):
+        request = APIRequestFactory().post('/checkout/', {}, format='json')
+        request.session = {'basket_id': 'basket'}
+        cache.add(idempotency.get_cache_key(request, 'key') + ':lock', 'other request')
+        with mock.patch('longclaw.checkout.idempotency.settings.CHECKOUT_IDEMPOTENCY_WAIT', 0):
+            response = self.post({})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.calls, [])
+
+
+class QuoteTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.request = RequestFactory().get('/')
+        self.request.session = {}
+        self.request.site = Site.find_for_request(self.request)
+        self.basket_id = basket_id(self.request)
+        self.item = BasketItemFactory(basket_id=self.basket_id)
+        self.address = AddressFactory()
+        self.rate = ShippingRate.objects.create(name='standard', rate=5, carrier='c', description='d')
+        self.rate.countries.add(self.address.country)
+
+    def test_quote(self):
+        quote = get_quote(self.request, country_code=self.address.country.pk)
+        self.assertAlmostEqual(float(quote['subtotal']), self.item.total())
+        self.assertEqual(quote['shipping_option'], 'standard')
+        self.assertEqual(quote['shipping_rate'], 5)
+        self.assertEqual(len(quote['shipping_options']), 1)
+        self.assertAlmostEqual(float(quote['grand_total']), self.item.total() + 5)
+        self.assertIsNone(quote['discount'])
+
+    def test_quote_is_cached(self):
+        get_quote(self.request, country_code=self.address.country.pk)
+        with mock.patch('longclaw.checkout.quote.calculate_quote') as calculate:
+            get_quote(self.request, country_code=self.address.country.pk)
+        calculate.assert_not_called()
+
+    def test_basket_modified(self):
+        get_quote(self.request, country_code=self.address.country.pk)
+        item = BasketItemFactory(basket_id=self.basket_id)
+        basket_modified.send(sender=BasketItem, basket_id=self.basket_id)
+        request = RequestFactory().get('/')
+        request.session = self.request.session
+        request.site = self.request.site
+        quote = get_quote(request, country_code=self.address.country.pk)
+        self.assertAlmostEqual(float(quote['subtotal']), self.item.total() + item.total())
+
+    def test_address_modified(self):
+        get_quote(self.request, destination=self.address.pk)
+        address_modified.send(sender=type(self.address), instance=self.address)
+        with mock.patch('longclaw.checkout.quote.calculate_quote', return_value={'shipping_options_incomplete': False}) as calculate:
+            get_quote(self.request, destination=self.address.pk)
+        calculate.assert_called_once()
+
+    def test_discount(self):
+        get_quote(self.request, country_code=self.address.country.pk)
+        coupon = Coupon.objects.create(
+            code='SAVE',
+            discount_type_stream_field=json.dumps([{'type': 'dollar', 'value': {'dollar': '2.00'}}])
+        )
+        Discount.objects.create(coupon=coupon, basket_id=self.basket_id)
+        quote = get_quote(self.request, country_code=self.address.country.pk)
+        self.assertEqual(quote['discount']['code'], 'SAVE')
+        self.assertEqual(quote['discount']['saved'], 2)
+        self.assertAlmostEqual(float(quote['grand_total']), self.item.total() + 3)
+
+    def test_quote_api(self):
+        request = RequestFactory().get('/', {'destination': self.address.pk})
+        request.session = self.request.session
+        response = checkout_quote(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['shipping_rate'], 5)
+
+    def test_quote_api_invalid_destination(self):
+        request = RequestFactory().get('/', {'destination': 0})
+        request.session = self.request.session
+        response = checkout_quote(request)
+        self.assertEqual(response.status_code, 400)
+
+
 class CheckoutApiShippingTest(LongclawTestCase):
     def setUp(self):
         self.shipping_address = AddressFactory()
@@ -267,3 +585,95 @@ class GatewayTests(TestCase):
     def test_js_tag(self):
         js = tags.gateway_client_js()
         self.assertIsInstance(js, (tuple, list))
+
+
+class FlakyError(Exception):
+    pass
+
+
+class FlakyPayment(BasePayment):
+    transient_errors = (FlakyError,)
+
+
+@mock.patch('longclaw.checkout.gateways.base.settings.PAYMENT_GATEWAY_RETRY_BACKOFF', 0)
+class GatewayClientTests(TestCase):
+
+    def setUp(self):
+        self.gateway = FlakyPayment()
+
+    def test_client_is_created_once(self):
+        with mock.patch.object(FlakyPayment, 'create_client', return_value=object()) as create_client:
+            self.assertIs(self.gateway.client, self.gateway.client)
+        create_client.assert_called_once()
+
+    def test_idempotent_calls_are_retried(self):
+        func = mock.Mock(side_effect=[FlakyError(), FlakyError(), 'ok'])
+        self.assertEqual(self.gateway.call(func, 1, idempotent=True, key='a'), 'ok')
+        self.assertEqual(func.call_count, 3)
+        func.assert_called_with(1, key='a')
+
+    def test_other_calls_are_not_retried(self):
+        func = mock.Mock(side_effect=FlakyError())
+        with self.assertRaises(FlakyError):
+            self.gateway.call(func)
+        self.assertEqual(func.call_count, 1)
+
+    def test_declines_are_not_retried(self):
+        func = mock.Mock(side_effect=ValueError())
+        with self.assertRaises(ValueError):
+            self.gateway.call(func, idempotent=True)
+        self.assertEqual(func.call_count, 1)
+        self.assertEqual(self.gateway.breaker.failures, 0)
+
+    @mock.patch('longclaw.checkout.gateways.base.settings.PAYMENT_GATEWAY_FAILURE_THRESHOLD', 2)
+    def test_circuit_breaker(self):
+        func = mock.Mock(side_effect=FlakyError())
+        for _ in range(2):
+            with self.assertRaises(FlakyError):
+                self.gateway.call(func)
+        self.assertTrue(self.gateway.breaker.is_open)
+        with self.assertRaises(GatewayUnavailable):
+            self.gateway.call(func)
+        self.assertEqual(func.call_count, 2)
+
+    def test_circuit_breaker_recovers(self):
+        breaker = CircuitBreaker(threshold=1, recovery_timeout=30)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        breaker.opened_at -= 30
+        # One trial call is let through
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+
+    @mock.patch('longclaw.checkout.gateways.base.settings.PAYMENT_GATEWAY_FAILURE_THRESHOLD', 1)
+    def test_circuit_breaker_closes_when_provider_answers(self):
+        with self.assertRaises(FlakyError):
+            self.gateway.call(mock.Mock(side_effect=FlakyError()))
+        self.gateway.breaker.opened_at -= self.gateway.breaker.recovery_timeout
+        # The trial call is declined, but the provider answered
+        with self.assertRaises(ValueError):
+            self.gateway.call(mock.Mock(side_effect=ValueError()))
+        self.assertFalse(self.gateway.breaker.is_open)
+        self.assertEqual(self.gateway.call(mock.Mock(return_value='ok')), 'ok')
+
+    def test_stripe_requests_are_retried_with_one_idempotency_key(self):
+        import stripe
+        from longclaw.checkout.gateways.stripe import StripePayment
+        gateway = StripePayment()
+        gateway._client = mock.Mock(spec=['refunds'])
+        create = gateway._client.refunds.create
+        create.side_effect = [stripe.error.APIConnectionError('timeout'), mock.Mock(status='succeeded')]
+        self.assertTrue(gateway.issue_refund('ch_1', 10))
+        first, second = create.call_args_list
+        self.assertEqual(first[1]['options']['idempotency_key'], second[1]['options']['idempotency_key'])
+        self.assertEqual(second[1]['params'], {'charge': 'ch_1', 'amount': 1000})
+
+    def test_stripe_client_is_not_global(self):
+        import stripe
+        from longclaw.checkout.gateways.stripe import StripePayment
+        default_http_client = stripe.default_http_client
+        client = StripePayment().create_client()
+        self.assertIsInstance(client, stripe.StripeClient)
+        self.assertIs(stripe.default_http_client, default_http_client)
@@ -1,16 +1,20 @@
+from collections import defaultdict
 from decimal import Decimal
+from django.db import transaction
 from django.utils.module_loading import import_string
 from django.utils import timezone
 from ipware.ip import get_real_ip
 from decimal import Decimal
 
-from longclaw.basket.utils import get_basket_items, destroy_basket
+from longclaw.basket.utils import basket_id, persist_basket, destroy_basket
 from longclaw.shipping.utils import get_shipping_cost
 from longclaw.coupon.utils import discount_total
 from longclaw.checkout.errors import PaymentError
-from longclaw.orders.models import Order, OrderItem
+from longclaw.orders.models import Order
+from longclaw.products.stock import commit_stock, release_stock, reserve_stock
 from longclaw.shipping.models import Address
 from longclaw.configuration.models import Configuration
+from longclaw.settings import STOCK_RESERVATIONS
 from longclaw.utils import GATEWAY
 
 
@@ -24,52 +28,71 @@ def create_order(email,
                  capture_payment=False):
     """
     Create an order from a basket and customer infomation
+
+    When ``capture_payment`` is set, checkout is staged so that no database
+    transaction is open while the payment gateway is called: the order is
+    reserved (``reserve_order``), paid for (``charge_order``), then
+    finalised (``finalise_order``) or failed (``fail_order``). When it is
+    unknown whether the gateway took the payment (one of its
+    ``ambiguous_errors``), the order is left 'Awaiting Payment', with its
+    stock reserved, to be checked against the gateway.
     """
-    basket_items, current_basket_id = get_basket_items(request)
+    order = reserve_order(
+        email,
+        request,
+        addresses=addresses,
+        shipping_address=shipping_address,
+        billing_address=billing_address,
+        shipping_option=shipping_option,
+        pending=capture_payment,
+    )
+
+    if capture_payment:
+        try:
+            transaction_id = charge_order(order, request, discount)
+        except GATEWAY.ambiguous_errors:
+            order.status_note = 'The payment could not be confirmed'
+            order.save(update_fields=['status_note'])
+        except (PaymentError,) + tuple(GATEWAY.transient_errors) as e:
+            fail_checkout(order, str(e) or 'The payment provider could not be reached')
+        except Exception:
+            fail_checkout(order, 'The payment could not be taken')
+            raise
+        else:
+            finalise_order(order, request, transaction_id, discount)
+
+    return order
+
+
+def reserve_order(email,
+                  request,
+                  addresses=None,
+                  shipping_address=None,
+                  billing_address=None,
+                  shipping_option=None,
+                  pending=True):
+    """
+    Create the order and its items from the basket in a short transaction.
+    The order is left 'Awaiting Payment' when ``pending`` is set.
+
+    With ``STOCK_RESERVATIONS`` enabled, the stock of the basket is reserved
+    and ``InsufficientStock`` is raised if there isn't enough. The stock of
+    an order which isn't pending (e.g. paid for outside of longclaw) is
+    taken for good straight away.
+    """
+    basket_items, current_basket_id = persist_basket(request)
 
     if not basket_items:
         raise ValueError('Basket is empty, do not complete order')
-    
-    if addresses:
-        # Longclaw < 0.2 used 'shipping_name', longclaw > 0.2 uses a consistent
-        # prefix (shipping_address_xxxx)
-        try:
-            shipping_name = addresses['shipping_name']
-        except KeyError:
-            shipping_name = addresses['shipping_address_name']
 
+    if addresses:
+        shipping_address, billing_address = create_addresses(addresses)
         shipping_country = addresses['shipping_address_country']
-        if not shipping_country:
-            shipping_country = None
-        shipping_address, _ = Address.objects.get_or_create(name=shipping_name,
-                                                            line_1=addresses[
-                                                                'shipping_address_line1'],
-                                                            city=addresses[
-                                                                'shipping_address_city'],
-                                                            postcode=addresses[
-                                                                'shipping_address_zip'],
-                                                            country=shipping_country)
-        shipping_address.save()
-        try:
-            billing_name = addresses['billing_name']
-        except KeyError:
-            billing_name = addresses['billing_address_name']
-        billing_country = addresses['shipping_address_country']
-        if not billing_country:
-            billing_country = None
-        billing_address, _ = Address.objects.get_or_create(name=billing_name,
-                                                           line_1=addresses[
-                                                               'billing_address_line1'],
-                                                           city=addresses[
-                                                               'billing_address_city'],
-                                                           postcode=addresses[
-                                                               'billing_address_zip'],
-                                                           country=billing_country)
-        billing_address.save()
     else:
         shipping_country = shipping_address.country
 
-    ip_address = get_real_ip(request)
+    # Shipping rate processors may call external services,
+    # so rates are looked up before the transaction starts
     if shipping_country and shipping_option:
         site_settings = Configuration.for_request(request)
         shipping_rate = get_shipping_cost(
@@ -82,62 +105,176 @@ def create_order(email,
     else:
         shipping_rate = Decimal(0)
 
-    order = Order(
-        email=email,
-        ip_address=ip_address,
-        shipping_address=shipping_address,
-        billing_address=billing_address,
-        shipping_rate=shipping_rate,
-    )
-    if request.user.account:
-        order.account = request.user.account
-    order.save()
-
-    # Create the order items & compute total
-    total = 0
-    for item in basket_items:
-        total += item.total()
-        order_item = OrderItem(
-            product=item.variant,
-            base_product_id=item.variant.product.id,
-            product_variant_id=item.variant.id,
-            product_variant_price=item.variant.price,
-            product_variant_ref=item.variant.ref,
-            product_variant_title=item.variant.get_product_title(),
-            quantity=item.quantity,
-            order=order,
+    with transaction.atomic():
+        if STOCK_RESERVATIONS:
+            lines = defaultdict(int)
+            for item in basket_items:
+                lines[item.variant_id] += item.quantity
+            reserve_stock(current_basket_id, lines)
+            if not pending:
+                commit_stock(current_basket_id, lines)
+
+        order = Order(
+            email=email,
+            ip_address=get_real_ip(request),
+            shipping_address=shipping_address,
+            billing_address=billing_address,
+            shipping_rate=shipping_rate,
+            basket_id=current_basket_id,
         )
-        order_item.save()
-    
+        if pending:
+            order.status = order.PENDING
+        account = getattr(getattr(request, 'user', None), 'account', None)
+        if account:
+            order.account = account
+        order.save()
+
+        # Create the order items & compute total
+        order.add_items((item.variant, item.quantity) for item in basket_items)
+
+    return order
+
+
+def create_addresses(addresses):
+    """Get or create the shipping and billing ``Address`` from checkout data
+    """
+    # Longclaw < 0.2 used 'shipping_name', longclaw > 0.2 uses a consistent
+    # prefix (shipping_address_xxxx)
+    try:
+        shipping_name = addresses['shipping_name']
+    except KeyError:
+        shipping_name = addresses['shipping_address_name']
+
+    shipping_country = addresses['shipping_address_country']
+    if not shipping_country:
+        shipping_country = None
+    shipping_address, _ = Address.objects.get_or_create(name=shipping_name,
+                                                        line_1=addresses[
+                                                            'shipping_address_line1'],
+                                                        city=addresses[
+                                                            'shipping_address_city'],
+                                                        postcode=addresses[
+                                                            'shipping_address_zip'],
+                                                        country=shipping_country)
+    shipping_address.save()
+    try:
+        billing_name = addresses['billing_name']
+    except KeyError:
+        billing_name = addresses['billing_address_name']
+    billing_country = addresses['shipping_address_country']
+    if not billing_country:
+        billing_country = None
+    billing_address, _ = Address.objects.get_or_create(name=billing_name,
+                                                       line_1=addresses[
+                                                           'billing_address_line1'],
+                                                       city=addresses[
+                                                           'billing_address_city'],
+                                                       postcode=addresses[
+                                                           'billing_address_zip'],
+                                                       country=billing_country)
+    billing_address.save()
+    return shipping_address, billing_address
+
+
+def payment_amount(order, discount=None):
+    """The amount to charge for an order, including shipping
+    """
+    total = order.items_total
     # Set the relative discount instance (if it exists) to refer to the order
     if discount:
         # last second check that the discount code can still be used
         if not discount.coupon.depleted:
             # Adjust the total by the discount
-            # total, _ = discount_total(total, discount)
-            # total = Decimal(total)
             total -= discount.value
+    return total + order.shipping_rate
 
-    if capture_payment:
-        desc = 'Payment from {} for order id #{}'.format(email, order.id)
-        try:
-            transaction_id = GATEWAY.create_payment(request,
-                                                    total + shipping_rate,
-                                                    description=desc)
-            order.payment_date = timezone.now()
-            order.transaction_id = transaction_id
-
-            # Payment has succeeded, so consume the discount code used
-            if discount:
-                if not discount.coupon.depleted:
-                    discount.consume(order)
-            
-            # Once the order has been successfully taken, we can empty the basket
-            destroy_basket(request)
-        except PaymentError as e:
-            order.status = order.FAILURE
-            order.status_note = str(e)
 
-        order.save()
+def charge_order(order, request, discount=None):
+    """
+    Take the payment for a reserved order through the payment gateway,
+    returning the transaction id. Must be called outside of a transaction,
+    so no connection or row locks are held during the gateway call.
+    Raises ``PaymentError`` if the payment fails.
+    """
+    desc = 'Payment from {} for order id #{}'.format(order.email, order.id)
+    return GATEWAY.create_payment(request, payment_amount(order, discount), description=desc)
+
+
+def finalise_order(order, request, transaction_id, discount=None):
+    """
+    Record the payment of an order in a short transaction,
+    consume the discount code used and empty the basket
+    """
+    # The stock of orders which weren't pending was taken by ``reserve_order``
+    was_pending = order.status == order.PENDING
+    with transaction.atomic():
+        order.status = order.SUBMITTED
+        order.payment_date = timezone.now()
+        order.transaction_id = transaction_id
+        order.save(update_fields=['status', 'payment_date', 'transaction_id'])
+
+        # Payment has succeeded, so consume the discount code used
+        if discount:
+            if not discount.coupon.depleted:
+                discount.consume(order)
+
+        if STOCK_RESERVATIONS and was_pending:
+            lines = defaultdict(int)
+            for variant_id, quantity in order.items.values_list('product_variant_id', 'quantity'):
+                lines[variant_id] += quantity
+            commit_stock(basket_id(request), lines)
 
+    # Once the order has been successfully taken, we can empty the basket
+    destroy_basket(request)
     return order
+
+
+def fail_order(order, note):
+    """Mark an order as failed, e.g. when its payment is declined
+    """
+    order.status = order.FAILURE
+    order.status_note = note[:Order._meta.get_field('status_note').max_length]
+    order.save(update_fields=['status', 'status_note'])
+    return order
+
+
+def fail_checkout(order, note):
+    """Fail an order whose payment was not taken and give back its reserved stock
+    """
+    fail_order(order, note)
+    if STOCK_RESERVATIONS:
+        release_stock(order.basket_id)
+
+
+def pending_orders(older_than):
+    """Orders which have been 'Awaiting Payment' since before ``older_than``,
+    i.e. whose checkout was interrupted or whose payment could not be confirmed
+    """
+    return Order.objects.filter(status=Order.PENDING, created_date__lt=older_than)
+
+
+def release_pending_orders(older_than):
+    """
+    Give back the stock reserved by the orders in ``pending_orders``.
+    The orders stay 'Awaiting Payment', since their payment may have been
+    taken, until they are checked against the gateway. The reservations of
+    a basket which has been checked out again belong to its newer order.
+    Returns the number of orders whose stock was released.
+    """
+    released = 0
+    for order in pending_orders(older_than).exclude(basket_id=None):
+        with transaction.atomic():
+            claimed = Order.objects.filter(
+                id=order.id, status=Order.PENDING, basket_id=order.basket_id
+            ).update(
+                basket_id=None,
+                status_note=order.status_note or 'Checkout was interrupted before the payment was confirmed',
+            )
+            if not claimed:
+                continue
+            released += 1
+            if STOCK_RESERVATIONS and not Order.objects.filter(
+                basket_id=order.basket_id, created_date__gt=order.created_date
+            ).exists():
+                release_stock(order.basket_id)
+    return released
@@ -10,13 +10,12 @@ except ImportError:
 
 from longclaw.shipping.forms import AddressForm
 from longclaw.checkout.forms import CheckoutForm
+from longclaw.checkout.quote import get_quote
 from longclaw.checkout.utils import create_order
-from longclaw.basket.utils import get_basket_items, basket_id
+from longclaw.products.stock import InsufficientStock
+from longclaw.basket.utils import get_basket_summary
 from longclaw.orders.models import Order
 from longclaw.coupon.models import Discount
-from longclaw.coupon.utils import discount_total
-from longclaw.shipping.models.rates import ShippingRate
-from longclaw.configuration.models import Configuration
 
 from django.apps import apps
 from longclaw.settings import ORDER_MODEL
@@ -36,7 +35,7 @@ class CheckoutView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super(CheckoutView, self).get_context_data(**kwargs)
-        items, _ = get_basket_items(self.request)
+        summary, bid = get_basket_summary(self.request)
         
         site = getattr(self.request, 'site', None)
         context['checkout_form'] = self.checkout_form(
@@ -49,23 +48,21 @@ class CheckoutView(TemplateView):
             self.request.POST or None,
             prefix='billing',
             site=site)
-        context['basket'] = items
+        context['basket'] = summary.items
         
-        shipping_rate = ShippingRate.objects.first()
-        if shipping_rate:
-            default_shipping_rate = shipping_rate.rate
-        else:
-            default_shipping_rate = Configuration.objects.first().default_shipping_rate
-        total_price = sum(item.total() for item in items)
-        discount = Discount.objects.filter(basket_id=basket_id(self.request), order=None).last()
-        discount_total_price, discount_total_saved = discount_total(total_price + default_shipping_rate, discount)
+        quote = get_quote(self.request)
+        default_shipping_rate = quote['shipping_rate']
+        total_price = quote['subtotal']
+        discount = Discount.objects.filter(basket_id=bid, order=None).last()
+        discount_total_price = quote['grand_total']
+        discount_total_saved = quote['discount']['saved'] if quote['discount'] else 0
         context['total_price'] = total_price
         context['discount'] = discount
         context['discount_total_price'] = round(discount_total_price, 2)
         context['discount_total_saved'] = round(discount_total_saved, 2)
         context['default_shipping_rate'] = round(default_shipping_rate, 2)
         context['discount_plus_shipping'] = round(discount_total_price + default_shipping_rate, 2)
-        context['total_plus_shipping'] = round(total_price + default_shipping_rate, 2)
+        context['total_plus_shipping'] = round(quote['total'], 2)
         return context
 
     def post(self, request, *args, **kwargs):
@@ -99,6 +96,9 @@ class CheckoutView(TemplateView):
                     discount=discount,
                     capture_payment=True
                 )
+            except InsufficientStock as e:
+                context['stock_error'] = str(e)
+                return super(CheckoutView, self).render_to_response(context)
             except ValueError: 
                 # Something went wrong, no items in basket?
                 return super(CheckoutView, self).render_to_response(context)
@@ -113,7 +113,7 @@ class CheckoutView(TemplateView):
                     context['checkout_form'] = checkout_form
                     context['shipping_form'] = shipping_form
                     context['discount'] = discount
-                    if order.status == order.FAILURE:
+                    if order.status in (order.FAILURE, order.PENDING):
                         context['payment_error'] = order.status_note
                     return super(CheckoutView, self).render_to_response(context)
                 
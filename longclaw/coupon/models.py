@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 
 from wagtail.core import blocks
@@ -7,6 +9,7 @@ from wagtail.core.fields import StreamField
 from wagtail.admin.edit_handlers import FieldPanel, StreamFieldPanel
 
 from longclaw.settings import PRODUCT_VARIANT_MODEL
+from longclaw.basket.utils import bump_basket_version
 from longclaw.orders.models import Order
 from longclaw.configuration.models import Configuration
 
@@ -125,3 +128,26 @@ class Discount(models.Model):
 
     class Meta:
         ordering = ['created',]
+
+
+@receiver(post_save, sender=Discount)
+@receiver(post_delete, sender=Discount)
+def update_order_discount(sender, instance, **kwargs):
+    """The discount is part of the totals stored on the order
+    """
+    if not instance.order_id:
+        return
+    if Discount.order.is_cached(instance):
+        order = instance.order
+    else:
+        order = Order.objects.filter(pk=instance.order_id).first()
+    if order is not None:
+        order.update_totals()
+
+
+@receiver(post_save, sender=Discount)
+@receiver(post_delete, sender=Discount)
+def update_basket_version(sender, instance, **kwargs):
+    """The discount is part of the checkout quote of its basket
+    """
+    bump_basket_version(basket_id=instance.basket_id)
@@ -2,7 +2,7 @@ from django.http import HttpResponse, JsonResponse
 from django.utils import timezone
 
 from longclaw.coupon.models import Coupon, Discount
-from longclaw.basket.utils import get_basket_items, basket_id
+from longclaw.basket.utils import get_basket_summary, basket_id
 from longclaw.coupon.utils import discount_total
 from longclaw.shipping.models.rates import ShippingRate
 
@@ -54,7 +54,7 @@ def verify_discount_code(request):
                 })
             
 
-            items, bid = get_basket_items(request)
+            summary, bid = get_basket_summary(request)
 
             # check if the current basket id already has a discount associated with it
             # get (or create) the Discount object 
@@ -77,7 +77,7 @@ def verify_discount_code(request):
                 discount.save()
 
             # get the total price from the items in the basket and run them through the discount
-            total_price = sum(item.total() for item in items)
+            total_price = summary.subtotal
 
             if shipping_rate_id := request.POST.get('shipping'):
                 try:
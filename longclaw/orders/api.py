@@ -1,13 +1,24 @@
 from rest_framework.decorators import action 
+from rest_framework.exceptions import ValidationError
 from rest_framework import permissions, status, viewsets, filters
 from rest_framework.response import Response
-from rest_framework.pagination import LimitOffsetPagination
-from longclaw.orders.serializers import OrderSerializer
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+from rest_framework.settings import api_settings
+from longclaw.orders.models import ArchivedOrder
+from longclaw.orders.serializers import ArchivedOrderSerializer, OrderSerializer
+from longclaw.orders.search import search_orders
+from longclaw.orders import bulk
 
 from collections import OrderedDict
+from urllib.parse import parse_qs, urlparse
 
 from django.apps import apps
-from longclaw.settings import ORDER_MODEL
+from django.core.exceptions import FieldDoesNotExist
+from django.http import Http404, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.dateparse import parse_date
+from longclaw.orders.export import EXPORT_FORMATS, export_lines, export_queryset, export_rows
+from longclaw.settings import ORDER_MODEL, ORDER_API_CURSOR_PAGINATION
 Order = apps.get_model(*ORDER_MODEL.split('.'))
 
 
@@ -41,12 +52,99 @@ class OrderLimitOffsetPagination(LimitOffsetPagination):
         return Response(od)
 
 
+class OrderSearchFilter(filters.SearchFilter):
+    """
+    Searches orders using the search index instead of
+    ``icontains`` lookups on ``search_fields``
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        search_terms = self.get_search_terms(request)
+        if not search_terms:
+            return queryset
+        return search_orders(queryset, ' '.join(search_terms))
+
+
+class OrderCursorPagination(CursorPagination):
+    """
+    Pages through orders by their position in the ordering (newest first
+    unless another ordering is requested) instead of an offset, so that
+    deep pages are as fast as the first.
+
+    The response has the same shape as ``OrderLimitOffsetPagination``, with
+    ``next_params``/``previous_params`` holding the ``cursor`` and ``limit``.
+    The total ``count`` is only calculated when requested with ``count=true``.
+    """
+    ordering = ('-created_date', '-id')
+    page_size = api_settings.PAGE_SIZE or 100
+    page_size_query_param = 'limit'
+    max_page_size = 1000
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ('true', '1'):
+            self.count = queryset.count()
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_ordering(self, request, queryset, view):
+        """
+        Use the ``ordering`` requested from the OrderingFilter, if any,
+        always ending with ``id`` so orders with equal values keep their
+        place. Nullable fields can't be used to page through orders.
+        """
+        ordering = self.ordering
+        for backend in getattr(view, 'filter_backends', []):
+            if hasattr(backend, 'get_ordering'):
+                requested = backend().get_ordering(request, queryset, view)
+                if requested:
+                    ordering = tuple(requested)
+                    break
+
+        for field_name in ordering:
+            field_name = field_name.lstrip('-')
+            if field_name in ('id', 'pk'):
+                continue
+            try:
+                field = queryset.model._meta.get_field(field_name)
+            except FieldDoesNotExist:
+                field = None
+            if field is None or field.null:
+                raise ValidationError({'ordering': "Orders can't be paged by '{}'".format(field_name)})
+
+        if ordering[-1].lstrip('-') not in ('id', 'pk'):
+            ordering += ('-id' if ordering[-1].startswith('-') else 'id',)
+        return ordering
+
+    def get_link_params(self, link):
+        if not link:
+            return None
+        query = parse_qs(urlparse(link).query)
+        return {
+            self.cursor_query_param: query[self.cursor_query_param][0],
+            self.page_size_query_param: self.page_size
+        }
+
+    def get_paginated_response(self, data):
+        next_link = self.get_next_link()
+        previous_link = self.get_previous_link()
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('next', next_link),
+            ('next_params', self.get_link_params(next_link)),
+            ('previous', previous_link),
+            ('previous_params', self.get_link_params(previous_link)),
+            ('results', data),
+        ]))
+
+
 class OrderViewSet(viewsets.ModelViewSet):
     serializer_class = OrderSerializer
     permission_classes = [permissions.IsAuthenticated]
     queryset = Order.objects.all()
-    pagination_class = OrderLimitOffsetPagination
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
+    pagination_class = OrderCursorPagination if ORDER_API_CURSOR_PAGINATION else OrderLimitOffsetPagination
+    filter_backends = [OrderSearchFilter, filters.OrderingFilter]
+    # Searched through the index maintained by ``longclaw.orders.search``
     search_fields = [
         '=id', 'email', 
         'shipping_address__name', 'shipping_address__city',
@@ -58,13 +156,30 @@ class OrderViewSet(viewsets.ModelViewSet):
         - status (integer)
             - Is the status code of the available statuses, e.g. "Awaiting dispatch" is code 1
         '''
-        queryset = super().get_queryset()
+        queryset = self.get_serializer_class().setup_eager_loading(super().get_queryset())
         status = self.request.query_params.get('status')
         if status is not None:
             queryset = queryset.filter(status=status)
         
         return queryset
 
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        # Rendering a thumbnail for every item on every order is too costly for listings
+        if self.action == 'list':
+            context['thumbnails'] = False
+        return context
+
+    def retrieve(self, request, *args, **kwargs):
+        """Retrieve an order, looking in the archive
+        if it is no longer in the orders table
+        """
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            archived = get_object_or_404(ArchivedOrder, pk=kwargs['pk'])
+            return Response(ArchivedOrderSerializer(archived, context=self.get_serializer_context()).data)
+
     @action(detail=True, methods=['post'])
     def refund_order(self, request, pk):
         """Refund the order specified by the pk
@@ -89,6 +204,91 @@ class OrderViewSet(viewsets.ModelViewSet):
         order = order.unfulfill()
         return Response(self.get_serializer(order).data)
 
+    def bulk_response(self, request, apply, **kwargs):
+        """Apply a bulk action to the ``ids`` list in the request body,
+        responding with a report of the outcome for each order
+        """
+        order_ids = request.data.get('ids')
+        if not isinstance(order_ids, list) or not order_ids:
+            return Response({'message': "'ids' must be a list of order ids"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            order_ids = list(OrderedDict.fromkeys(int(order_id) for order_id in order_ids))
+        except (TypeError, ValueError):
+            return Response({'message': "'ids' must be a list of order ids"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        report = apply(order_ids, **kwargs)
+        succeeded = sum(1 for result in report if result['success'])
+        return Response(OrderedDict([
+            ('succeeded', succeeded),
+            ('failed', len(report) - succeeded),
+            ('results', report),
+        ]))
+
+    @action(detail=False, methods=['post'])
+    def bulk_fulfill(self, request):
+        """Mark the orders in ``ids`` as fulfilled
+        """
+        return self.bulk_response(request, bulk.fulfill)
+
+    @action(detail=False, methods=['post'])
+    def bulk_unfulfill(self, request):
+        """Unmark the orders in ``ids`` as fulfilled
+        """
+        return self.bulk_response(request, bulk.unfulfill)
+
+    @action(detail=False, methods=['post'])
+    def bulk_cancel(self, request):
+        """Cancel the orders in ``ids``, refunding them
+        unless ``refund`` is false
+        """
+        refund = request.data.get('refund', True) not in (False, 'false', '0', 0)
+        return self.bulk_response(request, bulk.cancel, refund_orders=refund)
+
+    @action(detail=False, methods=['post'])
+    def bulk_refund(self, request):
+        """Refund the orders in ``ids``
+        """
+        return self.bulk_response(request, bulk.refund)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """Stream orders as CSV or NDJSON, one row per order item.
+        Accepts ``from`` and ``to`` dates (YYYY-MM-DD, inclusive), a ``status``
+        and an ``export_format`` of 'csv' (the default) or 'ndjson'.
+        """
+        export_format = request.query_params.get('export_format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return Response({'message': "Unknown export format '{}'".format(export_format)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        dates = {}
+        for key, param in (('from_date', 'from'), ('to_date', 'to')):
+            value = request.query_params.get(param)
+            if not value:
+                continue
+            try:
+                dates[key] = parse_date(value)
+            except ValueError:
+                dates[key] = None
+            if dates[key] is None:
+                return Response({'message': 'Dates must be formatted YYYY-MM-DD'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        order_status = request.query_params.get('status')
+        if order_status is not None:
+            statuses = {str(value): value for value, _ in Order.ORDER_STATUSES}
+            if order_status not in statuses:
+                return Response({'message': "Unknown order status '{}'".format(order_status)},
+                                status=status.HTTP_400_BAD_REQUEST)
+            order_status = statuses[order_status]
+
+        queryset = export_queryset(status=order_status, **dates)
+        content_type = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        response = StreamingHttpResponse(export_lines(export_rows(queryset), export_format),
+                                         content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="orders.{}"'.format(export_format)
+        return response
+
     @action(detail=False, methods=['get'])
     def order_statuses(self, request):
         return Response({value: text for value, text in Order.ORDER_STATUSES}, status=200)
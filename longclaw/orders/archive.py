@@ -0,0 +1,201 @@
+"""
+Move old orders out of the ``Order`` and ``OrderItem`` tables into
+``ArchivedOrder``, and back again.
+
+Only orders which are no longer being processed (i.e. are not
+'Submitted', 'Awaiting Payment' or 'Refunding') are archived. Each archived order
+keeps its id, and its items and discounts are stored as JSON snapshots
+on the archived order, so the hot tables only hold recent orders. The
+discounts are deleted, so they can't be applied to their basket again,
+and recreated when the order is restored.
+"""
+import datetime
+from decimal import Decimal
+
+from django.apps import apps
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from longclaw.coupon.models import Coupon, Discount
+from longclaw.coupon.utils import discount_total
+from longclaw.orders.models import ArchivedOrder, OrderItem, suspend_total_updates
+from longclaw.orders.search import update_search_index
+from longclaw.settings import ORDER_MODEL
+from longclaw.utils import ProductVariant
+
+# Fields copied between ``Order`` and ``ArchivedOrder``
+ORDER_FIELDS = (
+    'id', 'payment_date', 'created_date', 'status', 'status_note', 'transaction_id',
+    'email', 'ip_address', 'shipping_address_id', 'billing_address_id', 'shipping_rate',
+    'receipt_email_sent', 'total_paid', 'account_id', 'is_subscription_order',
+    'items_total', 'item_count', 'discount_amount', 'final_payment',
+)
+
+# Fields of each order item kept in the snapshot
+ITEM_FIELDS = (
+    'id', 'product_id', 'base_product_id', 'product_variant_id', 'product_variant_price',
+    'product_variant_ref', 'product_variant_title', 'quantity', 'date_created', 'date_modified',
+)
+
+
+def get_order_model():
+    return apps.get_model(*ORDER_MODEL.split('.'))
+
+
+def archive_cutoff(days):
+    return timezone.now() - datetime.timedelta(days=days)
+
+
+def archivable_orders(cutoff):
+    """Orders created before ``cutoff`` which are no longer being processed
+    """
+    Order = get_order_model()
+    return Order.objects.filter(created_date__lt=cutoff).exclude(
+        status__in=[Order.SUBMITTED, Order.PENDING, Order.REFUNDING]
+    )
+
+
+def item_snapshot(item):
+    snapshot = {field: item[field] for field in ITEM_FIELDS}
+    snapshot['product_variant_price'] = str(item['product_variant_price'])
+    for field in ('date_created', 'date_modified'):
+        snapshot[field] = item[field].isoformat() if item[field] else None
+    return snapshot
+
+
+def restore_item(order_id, snapshot):
+    item = OrderItem(order_id=order_id, **snapshot)
+    item.date_created = parse_datetime(snapshot['date_created']) if snapshot['date_created'] else None
+    item.date_modified = parse_datetime(snapshot['date_modified']) if snapshot['date_modified'] else None
+    return item
+
+
+def discount_snapshot(discount, order):
+    total, _ = discount_total(order.items_total + (order.shipping_rate or 0), discount)
+    return {
+        'id': discount.id,
+        'coupon_id': discount.coupon_id,
+        'coupon_code': discount.coupon.code,
+        'discount_value': discount.coupon.discount_string(discount.coupon.discount_value),
+        'discount_total': str(total),
+        'basket_id': discount.basket_id,
+        'created': discount.created.isoformat(),
+        'consumed': discount.consumed,
+        'consumed_date': discount.consumed_date.isoformat() if discount.consumed_date else None,
+        'value': str(discount.value),
+    }
+
+
+def restore_discount(order_id, snapshot):
+    return Discount(
+        id=snapshot['id'],
+        order_id=order_id,
+        coupon_id=snapshot['coupon_id'],
+        basket_id=snapshot['basket_id'],
+        created=parse_datetime(snapshot['created']),
+        consumed=snapshot['consumed'],
+        consumed_date=parse_datetime(snapshot['consumed_date']) if snapshot['consumed_date'] else None,
+        value=Decimal(snapshot['value']),
+    )
+
+
+def archive_order_batch(orders):
+    """Archive a list of orders in a single transaction, returning
+    the number archived
+    """
+    Order = get_order_model()
+    order_ids = [order.id for order in orders]
+    items = {order_id: [] for order_id in order_ids}
+    discounts = {order_id: [] for order_id in order_ids}
+    for item in OrderItem.objects.filter(order_id__in=order_ids).order_by('id').values('order_id', *ITEM_FIELDS):
+        items[item['order_id']].append(item_snapshot(item))
+    orders_by_id = {order.id: order for order in orders}
+    for discount in Discount.objects.filter(order_id__in=order_ids).select_related('coupon').order_by('created'):
+        discounts[discount.order_id].append(discount_snapshot(discount, orders_by_id[discount.order_id]))
+
+    with transaction.atomic():
+        ArchivedOrder.objects.bulk_create([
+            ArchivedOrder(
+                items=items[order.id],
+                discounts=discounts[order.id],
+                **{field: getattr(order, field) for field in ORDER_FIELDS}
+            )
+            for order in orders
+        ])
+        with suspend_total_updates():
+            OrderItem.objects.filter(order_id__in=order_ids).delete()
+            discount_ids = list(Discount.objects.filter(order_id__in=order_ids).values_list('id', flat=True))
+            Order.objects.filter(id__in=order_ids).delete()
+            # Deleting the orders detaches their discounts, which would
+            # then apply to their basket again; they live in the snapshot
+            Discount.objects.filter(id__in=discount_ids).delete()
+    return len(orders)
+
+
+def archive_orders(cutoff, batch_size=500):
+    """Archive every order created before ``cutoff`` which is no longer
+    being processed, ``batch_size`` orders per transaction.
+    Return the number of orders archived.
+    """
+    orders = archivable_orders(cutoff).order_by('pk')
+    count = 0
+    last_pk = 0
+    while True:
+        batch = list(orders.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        count += archive_order_batch(batch)
+        last_pk = batch[-1].pk
+    return count
+
+
+def restore_orders(archived_orders):
+    """Move archived orders (an ``ArchivedOrder`` queryset) back into the
+    ``Order`` and ``OrderItem`` tables, returning the number restored
+    """
+    Order = get_order_model()
+    archived_orders = list(archived_orders)
+    if not archived_orders:
+        return 0
+
+    orders = []
+    items = []
+    discounts = []
+    for archived in archived_orders:
+        orders.append(Order(**{field: getattr(archived, field) for field in ORDER_FIELDS}))
+        items.extend(restore_item(archived.id, item) for item in archived.items)
+        discounts.extend(restore_discount(archived.id, discount) for discount in archived.discounts)
+
+    # Variants and coupons deleted since the orders were archived
+    variant_ids = set(ProductVariant.objects.filter(
+        id__in={item.product_id for item in items if item.product_id}
+    ).values_list('id', flat=True))
+    for item in items:
+        if item.product_id not in variant_ids:
+            item.product_id = None
+    coupon_ids = set(Coupon.objects.filter(
+        id__in={discount.coupon_id for discount in discounts}
+    ).values_list('id', flat=True))
+    discounts = [discount for discount in discounts if discount.coupon_id in coupon_ids]
+    # ``auto_now``/``auto_now_add`` fields are overwritten when the rows
+    # are inserted, so the original dates are put back afterwards
+    created_dates = [order.created_date for order in orders]
+    item_dates = [(item.date_created, item.date_modified) for item in items]
+
+    with transaction.atomic():
+        Order.objects.bulk_create(orders)
+        OrderItem.objects.bulk_create(items)
+        for order, created_date in zip(orders, created_dates):
+            order.created_date = created_date
+        for item, (date_created, date_modified) in zip(items, item_dates):
+            item.date_created = date_created
+            item.date_modified = date_modified
+        Order.objects.bulk_update(orders, ['created_date'])
+        OrderItem.objects.bulk_update(items, ['date_created', 'date_modified'])
+        Discount.objects.bulk_create(discounts)
+        ArchivedOrder.objects.filter(id__in=[order.id for order in orders]).delete()
+
+    for order in Order.objects.filter(id__in=[order.id for order in orders]).select_related('shipping_address'):
+        update_search_index(order)
+    return len(orders)
@@ -0,0 +1,189 @@
+"""
+Apply status changes to many orders at once.
+
+Each action returns a report with one result per requested order id,
+in the order they were requested:
+
+    {'id': 1, 'success': True, 'status': 2, 'message': ''}
+
+Status changes are written with a single ``update()`` per outcome, so
+``post_save`` is not sent for the updated orders. Each action only changes
+orders whose current status allows it; the others are reported as
+failures. Gateway refunds are
+issued concurrently on a pool of ``ORDER_REFUND_WORKERS`` threads; the
+threads only talk to the gateway, all database access happens in the
+calling thread.
+"""
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from django.apps import apps
+
+from longclaw.settings import ORDER_MODEL, ORDER_REFUND_WORKERS
+
+
+def get_order_model():
+    return apps.get_model(*ORDER_MODEL.split('.'))
+
+
+def _now():
+    return datetime.strftime(datetime.now(), "%b %d %Y %H:%M:%S")
+
+
+def _result(order_id, success, status=None, message=''):
+    return {'id': order_id, 'success': success, 'status': status, 'message': message}
+
+
+def _report(order_ids, results):
+    """Order ``results`` (a dict by order id) like ``order_ids``;
+    ids with no result were not found
+    """
+    return [
+        results.get(order_id) or _result(order_id, False, message='Order not found')
+        for order_id in order_ids
+    ]
+
+
+def set_status(order_ids, status, sources):
+    """Set the status of the given orders whose status is one of
+    ``sources`` with a single query; other orders are not changed
+    and are reported as failures
+    """
+    Order = get_order_model()
+    labels = dict(Order.ORDER_STATUSES)
+    found = dict(Order.objects.filter(id__in=order_ids).values_list('id', 'status'))
+    Order.objects.filter(id__in=list(found), status__in=sources).update(status=status)
+    # The statuses of orders changed by another request meanwhile
+    # are reported as they are now
+    current = dict(Order.objects.filter(id__in=list(found)).values_list('id', 'status'))
+    results = {}
+    for order_id, previous in found.items():
+        now = current.get(order_id, previous)
+        if previous in sources and now == status:
+            results[order_id] = _result(order_id, True, status)
+        else:
+            results[order_id] = _result(order_id, False, now, "An order which is '{}' can't be made '{}'".format(
+                labels.get(now, now), labels[status]
+            ))
+    return _report(order_ids, results)
+
+
+def fulfill(order_ids):
+    """Mark the given submitted orders as fulfilled
+    """
+    Order = get_order_model()
+    return set_status(order_ids, Order.FULFILLED, [Order.SUBMITTED, Order.FULFILLED])
+
+
+def unfulfill(order_ids):
+    """Unmark the given fulfilled orders as fulfilled
+    """
+    Order = get_order_model()
+    return set_status(order_ids, Order.SUBMITTED, [Order.FULFILLED, Order.SUBMITTED])
+
+
+def _issue_refund(gateway, transaction_id, amount):
+    try:
+        if gateway.issue_refund(transaction_id, amount):
+            return True, ''
+        return False, 'The gateway declined the refund'
+    except Exception as err:
+        return False, str(err) or err.__class__.__name__
+
+
+def _claim(orders):
+    """Move the given orders (a dict of their ids by status) to REFUNDING
+    if they still have that status, so no other request refunds them at the
+    same time, with one query per status. Return the ids of the orders claimed.
+    """
+    Order = get_order_model()
+    # Tells the orders claimed by this request from those claimed by others
+    token = 'Refund claimed by {}'.format(uuid.uuid4().hex)
+    for status, ids in orders.items():
+        Order.objects.filter(id__in=ids, status__in=[status]).update(status=Order.REFUNDING, status_note=token)
+    return set(Order.objects.filter(status=Order.REFUNDING, status_note=token).values_list('id', flat=True))
+
+
+def refund(order_ids, max_workers=None):
+    """Issue full refunds for the given orders.
+    Only orders which have been paid (submitted, fulfilled or cancelled,
+    with a transaction id) are refunded. The orders are claimed (see
+    ``_claim``) before the gateway is called, so concurrent requests
+    never refund an order twice; orders whose refund fails get their
+    previous status back.
+    """
+    from longclaw.utils import GATEWAY
+    Order = get_order_model()
+    refundable = [Order.SUBMITTED, Order.FULFILLED, Order.CANCELLED]
+    orders = Order.objects.filter(id__in=order_ids).values_list(
+        'id', 'status', 'transaction_id', 'items_total'
+    )
+    results = {}
+    candidates = []
+    for order_id, status, transaction_id, amount in orders:
+        if status == Order.REFUNDED:
+            message = 'The order has already been refunded'
+        elif status == Order.REFUNDING:
+            message = 'The order is being refunded'
+        elif status not in refundable:
+            message = 'The order has not been paid'
+        elif not transaction_id:
+            message = 'The order has no transaction to refund'
+        else:
+            candidates.append((order_id, status, transaction_id, amount))
+            continue
+        results[order_id] = _result(order_id, False, status, message)
+
+    by_status = {}
+    for order_id, status, _, _ in candidates:
+        by_status.setdefault(status, []).append(order_id)
+    claimed = _claim(by_status) if by_status else set()
+    pending = []
+    for order in candidates:
+        if order[0] in claimed:
+            pending.append(order)
+        else:
+            results[order[0]] = _result(order[0], False, order[1], 'The order was changed by another request')
+
+    if pending:
+        workers = min(max_workers or ORDER_REFUND_WORKERS, len(pending))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outcomes = executor.map(
+                lambda order: _issue_refund(GATEWAY, order[2], order[3]), pending
+            )
+            for (order_id, status, _, _), (success, message) in zip(pending, outcomes):
+                if success:
+                    status = Order.REFUNDED
+                results[order_id] = _result(order_id, success, status, message)
+
+    now = _now()
+    refunded = [order_id for order_id, _, _, _ in pending if results[order_id]['success']]
+    if refunded:
+        Order.objects.filter(id__in=refunded).update(
+            status=Order.REFUNDED, status_note="Refunded on {}".format(now)
+        )
+    failed = {}
+    for order_id, status, _, _ in pending:
+        if not results[order_id]['success']:
+            failed.setdefault(status, []).append(order_id)
+    for status, ids in failed.items():
+        Order.objects.filter(id__in=ids).update(status=status, status_note="Refund failed on {}".format(now))
+    return _report(order_ids, results)
+
+
+def cancel(order_ids, refund_orders=True, max_workers=None):
+    """Cancel the given orders, optionally refunding them first.
+    When refunding, orders whose refund fails are left as they are.
+    """
+    Order = get_order_model()
+    if not refund_orders:
+        return set_status(order_ids, Order.CANCELLED, [Order.SUBMITTED, Order.FULFILLED, Order.CANCELLED])
+
+    report = refund(order_ids, max_workers=max_workers)
+    cancelled = [result['id'] for result in report if result['success']]
+    Order.objects.filter(id__in=cancelled, status=Order.REFUNDED).update(status=Order.CANCELLED)
+    for result in report:
+        if result['success']:
+            result['status'] = Order.CANCELLED
+    return report
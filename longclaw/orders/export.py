@@ -0,0 +1,111 @@
+"""
+Export orders as one flattened row per order item, in CSV or
+newline delimited JSON.
+
+Rows are read from the database in chunks and written one at a time,
+so memory use does not grow with the number of orders exported.
+"""
+import csv
+import datetime
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from longclaw.coupon.models import Discount
+from longclaw.orders.models import OrderItem
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+
+# (column name, ``OrderItem`` lookup) for each exported column
+EXPORT_COLUMNS = (
+    ('order_id', 'order_id'),
+    ('created_date', 'order__created_date'),
+    ('payment_date', 'order__payment_date'),
+    ('status', 'order__status'),
+    ('email', 'order__email'),
+    ('transaction_id', 'order__transaction_id'),
+    ('items_total', 'order__items_total'),
+    ('shipping_rate', 'order__shipping_rate'),
+    ('discount_amount', 'order__discount_amount'),
+    ('final_payment', 'order__final_payment'),
+    ('coupon_code', 'coupon_code'),
+    ('shipping_name', 'order__shipping_address__name'),
+    ('shipping_line_1', 'order__shipping_address__line_1'),
+    ('shipping_line_2', 'order__shipping_address__line_2'),
+    ('shipping_city', 'order__shipping_address__city'),
+    ('shipping_postcode', 'order__shipping_address__postcode'),
+    ('shipping_country', 'order__shipping_address__country'),
+    ('item_id', 'id'),
+    ('product_variant_id', 'product_variant_id'),
+    ('product_variant_ref', 'product_variant_ref'),
+    ('product_variant_title', 'product_variant_title'),
+    ('product_variant_price', 'product_variant_price'),
+    ('quantity', 'quantity'),
+)
+
+COLUMN_NAMES = [name for name, _ in EXPORT_COLUMNS]
+
+
+def export_queryset(from_date=None, to_date=None, status=None):
+    """The order items to export, as ``values_list`` tuples in the order
+    of ``EXPORT_COLUMNS``. Dates are inclusive and filter on the date the
+    order was created.
+    """
+    coupon_code = Discount.objects.filter(
+        order=OuterRef('order_id')
+    ).order_by('created').values('coupon__code')[:1]
+    items = OrderItem.objects.annotate(coupon_code=Subquery(coupon_code))
+    if from_date:
+        items = items.filter(order__created_date__gte=start_of_day(from_date))
+    if to_date:
+        items = items.filter(order__created_date__lt=start_of_day(to_date + datetime.timedelta(days=1)))
+    if status is not None:
+        items = items.filter(order__status=status)
+    return items.order_by('order_id', 'id').values_list(*[lookup for _, lookup in EXPORT_COLUMNS])
+
+
+def start_of_day(date):
+    value = datetime.datetime.combine(date, datetime.time.min)
+    if settings.USE_TZ:
+        value = timezone.make_aware(value)
+    return value
+
+
+def export_rows(queryset, chunk_size=2000):
+    """Yield a dict per order item
+    """
+    for values in queryset.iterator(chunk_size=chunk_size):
+        yield dict(zip(COLUMN_NAMES, values))
+
+
+class Echo:
+    """A file-like object which returns what is written to it,
+    so ``csv.writer`` can be used to produce lines one at a time
+    """
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(COLUMN_NAMES)
+    for row in rows:
+        yield writer.writerow([row[name] for name in COLUMN_NAMES])
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+def export_lines(rows, export_format):
+    """Render rows as lines of ``export_format`` (one of ``EXPORT_FORMATS``)
+    """
+    if export_format == 'csv':
+        return csv_lines(rows)
+    if export_format == 'ndjson':
+        return ndjson_lines(rows)
+    raise ValueError('Unknown export format {}'.format(export_format))
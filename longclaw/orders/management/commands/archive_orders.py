@@ -0,0 +1,28 @@
+from django.core.management import BaseCommand
+from longclaw.orders.archive import archivable_orders, archive_cutoff, archive_orders
+from longclaw.settings import ORDER_ARCHIVE_DAYS
+
+class Command(BaseCommand):
+    """Move old orders into the archive.
+    Orders which are no longer being processed are moved out of the
+    ``Order`` and ``OrderItem`` tables, keeping them small.
+    Run with e.g. a daily cron job.
+    """
+    help = "Archive orders older than ORDER_ARCHIVE_DAYS (or the given number of days)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=ORDER_ARCHIVE_DAYS,
+                            help='Archive orders created more than this many days ago')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of orders to archive per transaction')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report how many orders would be archived without archiving them')
+
+    def handle(self, *args, **options):
+        cutoff = archive_cutoff(options['older_than_days'])
+        if options['dry_run']:
+            count = archivable_orders(cutoff).count()
+            self.stdout.write(self.style.SUCCESS("Would archive {} orders".format(count)))
+            return
+        count = archive_orders(cutoff, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS("Archived {} orders".format(count)))
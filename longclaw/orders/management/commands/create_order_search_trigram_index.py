@@ -0,0 +1,26 @@
+from django.core.management import BaseCommand, CommandError
+from django.db import connections, router
+from longclaw.orders.models import OrderSearchTerm
+from longclaw.orders.search import create_trigram_index, drop_trigram_index
+
+class Command(BaseCommand):
+    """Create the trigram index used by order search when
+    ``ORDER_SEARCH_TRIGRAM`` is set. PostgreSQL only; run it once,
+    after migrating, on sites which opt in to trigram matching.
+    """
+    help = "Create (or drop) the pg_trgm index of order search terms"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drop', action='store_true',
+                            help='Drop the index instead of creating it')
+
+    def handle(self, *args, **options):
+        connection = connections[router.db_for_write(OrderSearchTerm)]
+        if connection.vendor != 'postgresql':
+            raise CommandError("Trigram indexes are only supported on PostgreSQL")
+        if options['drop']:
+            drop_trigram_index(connection)
+            self.stdout.write(self.style.SUCCESS("Dropped the order search trigram index"))
+            return
+        create_trigram_index(connection)
+        self.stdout.write(self.style.SUCCESS("Created the order search trigram index"))
@@ -0,0 +1,33 @@
+import datetime
+from django.core.management import BaseCommand
+from longclaw.orders.export import EXPORT_FORMATS, export_lines, export_queryset, export_rows
+
+def date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+class Command(BaseCommand):
+    """Export orders, one row per order item.
+    Rows are streamed, so any number of orders can be exported.
+    """
+    help = "Export orders as CSV or NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='from_date', type=date,
+                            help='Only orders created on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--to', dest='to_date', type=date,
+                            help='Only orders created on or before this date (YYYY-MM-DD)')
+        parser.add_argument('--status', type=int, help='Only orders with this status')
+        parser.add_argument('--format', dest='export_format', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('--output', help='File to write to (defaults to stdout)')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Number of rows to fetch from the database at a time')
+
+    def handle(self, *args, **options):
+        queryset = export_queryset(options['from_date'], options['to_date'], options['status'])
+        lines = export_lines(export_rows(queryset, options['chunk_size']), options['export_format'])
+        if options['output']:
+            with open(options['output'], 'w', newline='') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
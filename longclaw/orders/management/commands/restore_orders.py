@@ -0,0 +1,33 @@
+from django.core.management import BaseCommand, CommandError
+from longclaw.orders.archive import restore_orders
+from longclaw.orders.models import ArchivedOrder
+
+class Command(BaseCommand):
+    """Move archived orders back into the ``Order`` and ``OrderItem`` tables.
+    """
+    help = "Restore the given archived orders, or all of them with --all"
+
+    def add_arguments(self, parser):
+        parser.add_argument('order_ids', nargs='*', type=int)
+        parser.add_argument('--all', action='store_true',
+                            help='Restore every archived order')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of orders to restore per transaction')
+
+    def handle(self, *args, **options):
+        if not options['order_ids'] and not options['all']:
+            raise CommandError("Give the ids of the orders to restore, or --all")
+        archived = ArchivedOrder.objects.order_by('pk')
+        if options['order_ids']:
+            archived = archived.filter(id__in=options['order_ids'])
+
+        count = 0
+        last_pk = 0
+        while True:
+            batch = list(archived.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            count += restore_orders(batch)
+            last_pk = batch[-1].pk
+
+        self.stdout.write(self.style.SUCCESS("Restored {} orders".format(count)))
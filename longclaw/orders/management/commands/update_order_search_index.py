@@ -0,0 +1,23 @@
+from django.core.management import BaseCommand
+from longclaw.orders.models import Order
+from longclaw.orders.search import update_search_index
+
+class Command(BaseCommand):
+    """Rebuild the search index of orders.
+    Run this once after upgrading to index existing orders;
+    orders are indexed automatically when they are saved afterwards.
+    """
+    help = "Rebuild the search index of all orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of orders to load per query')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.select_related('shipping_address').order_by('pk')
+        count = 0
+        for order in orders.iterator(chunk_size=options['batch_size']):
+            update_search_index(order)
+            count += 1
+
+        self.stdout.write(self.style.SUCCESS("Indexed {} orders".format(count)))
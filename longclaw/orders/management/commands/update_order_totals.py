@@ -0,0 +1,38 @@
+from django.core.management import BaseCommand
+from django.db.models import Count
+from longclaw.orders.models import Order, items_total
+
+class Command(BaseCommand):
+    """Recalculate the totals stored on orders.
+    Run this once after upgrading to populate the totals of existing
+    orders; they are kept up to date automatically afterwards.
+    """
+    help = "Recalculate the stored totals of all orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of orders to update per query')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        orders = Order.objects.order_by('pk').annotate(
+            calculated_items_total=items_total('items__'),
+            calculated_item_count=Count('items')
+        ).prefetch_related('discounts__coupon')
+
+        count = 0
+        last_pk = 0
+        while True:
+            batch = list(orders.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            for order in batch:
+                discounts = list(order.discounts.all())
+                order.set_totals(order.calculated_items_total,
+                                 order.calculated_item_count,
+                                 discounts[0] if discounts else None)
+            Order.objects.bulk_update(batch, Order.TOTAL_FIELDS)
+            count += len(batch)
+            last_pk = batch[-1].pk
+
+        self.stdout.write(self.style.SUCCESS("Updated the totals of {} orders".format(count)))
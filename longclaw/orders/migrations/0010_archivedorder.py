@@ -0,0 +1,41 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0005_auto_20220511_1246'),
+        ('shipping', '0006_auto_20210921_0534'),
+        ('orders', '0009_order_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedOrder',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('payment_date', models.DateTimeField(blank=True, null=True)),
+                ('created_date', models.DateTimeField()),
+                ('status', models.IntegerField(choices=[(1, 'Submitted'), (2, 'Fulfilled'), (3, 'Cancelled'), (4, 'Refunded'), (5, 'Payment Failed')])),
+                ('status_note', models.CharField(blank=True, max_length=128, null=True)),
+                ('transaction_id', models.CharField(blank=True, max_length=256, null=True)),
+                ('email', models.EmailField(blank=True, db_index=True, max_length=128, null=True)),
+                ('ip_address', models.GenericIPAddressField(blank=True, null=True)),
+                ('shipping_rate', models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True)),
+                ('receipt_email_sent', models.BooleanField(default=False)),
+                ('total_paid', models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True)),
+                ('is_subscription_order', models.BooleanField(default=False)),
+                ('items_total', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('item_count', models.IntegerField(default=0)),
+                ('discount_amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('final_payment', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('items', models.JSONField(default=list)),
+                ('discounts', models.JSONField(default=list)),
+                ('archived_date', models.DateTimeField(auto_now_add=True)),
+                ('account', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='account.account')),
+                ('billing_address', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='shipping.address')),
+                ('shipping_address', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='shipping.address')),
+            ],
+        ),
+    ]
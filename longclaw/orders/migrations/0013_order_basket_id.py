@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0012_order_refunding_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='basket_id',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
@@ -1,25 +1,57 @@
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from decimal import Decimal
 from django.db import models
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Sum
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from longclaw.settings import PRODUCT_VARIANT_MODEL
 from longclaw.shipping.models import Address
+from longclaw.shipping.signals import address_modified
+from longclaw.orders.search import SEARCH_FIELDS, TERM_LENGTH, search_values_key, update_search_index
 # from longclaw.coupon.models import Discount
 from longclaw.coupon.utils import discount_total
 
+# Set while order totals should not be recalculated, e.g. whilst
+# the items of orders being archived are deleted
+_totals_suspended = threading.local()
+
+
+def items_total(prefix=''):
+    """Aggregate for the total price of order items,
+    optionally through a relation (e.g. ``items__``)
+    """
+    return Sum(ExpressionWrapper(
+        F(prefix + 'quantity') * F(prefix + 'product_variant_price'),
+        output_field=DecimalField(max_digits=12, decimal_places=2)
+    ))
+
+
 class Order(models.Model):
     SUBMITTED = 1
     FULFILLED = 2
     CANCELLED = 3
     REFUNDED = 4
     FAILURE = 5
+    # Reserved by checkout while the payment is taken
+    PENDING = 6
+    # Claimed by a bulk refund while the gateway refunds it
+    REFUNDING = 7
     ORDER_STATUSES = ((SUBMITTED, 'Submitted'),
                       (FULFILLED, 'Fulfilled'),
                       (CANCELLED, 'Cancelled'),
                       (REFUNDED, 'Refunded'),
-                      (FAILURE, 'Payment Failed'))
+                      (FAILURE, 'Payment Failed'),
+                      (PENDING, 'Awaiting Payment'),
+                      (REFUNDING, 'Refunding'))
     payment_date = models.DateTimeField(blank=True, null=True)
     created_date = models.DateTimeField(auto_now_add=True)
     status = models.IntegerField(choices=ORDER_STATUSES, default=SUBMITTED)
     status_note = models.CharField(max_length=128, blank=True, null=True)
+    # The basket a checkout order was created from. Cleared by
+    # ``release_pending_orders`` once it has given back the order's stock
+    basket_id = models.CharField(max_length=32, blank=True, null=True)
 
     transaction_id = models.CharField(max_length=256, blank=True, null=True)
 
@@ -46,36 +78,91 @@ class Order(models.Model):
     account = models.ForeignKey('account.Account', related_name='orders', blank=True, null=True, on_delete=models.SET_NULL)
     is_subscription_order = models.BooleanField(default=False)
 
+    # Denormalised from the order items and discount by ``update_totals``
+    TOTAL_FIELDS = ('items_total', 'item_count', 'discount_amount', 'final_payment')
+    items_total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    item_count = models.IntegerField(default=0)
+    discount_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    final_payment = models.DecimalField(max_digits=12, decimal_places=2, default=0,
+                                        help_text='The total price (reduced by any discount applied), plus shipping')
+
     def __str__(self):
         return "Order #{} - {}".format(self.id, self.email)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # So saves which don't change them don't rebuild the search terms
+        instance._search_values = search_values_key(instance)
+        return instance
+
     @property
     def total(self):
         """Total cost of the order
         """
-        total = 0
-        for item in self.items.all():
-            total += item.total
-
-        return round(total, 2)
-    
-    @property
-    def final_payment(self):
-        """ The total payment received
-            This includes the total price (reduced by any discount applied), plus shipping
-        """
-        total = self.total
-        if self.shipping_rate:
-            total += self.shipping_rate
-        if self.discounts.first():
-            total, _ = discount_total(total, self.discounts.first())
-        return round(total, 2)
+        return self.items_total
 
     @property
     def total_items(self):
         """The number of individual items on the order
         """
-        return self.items.count()
+        return self.item_count
+
+    def update_totals(self, commit=True):
+        """Recalculate the stored totals from the order items and discount.
+        Called whenever an order item or discount of the order changes.
+        """
+        totals = self.items.aggregate(items_total=items_total(), item_count=Count('id'))
+        # There should only be one discount, as it is set up currently
+        self.set_totals(totals['items_total'], totals['item_count'], self.discounts.first())
+        if commit and self.pk:
+            self.save_totals()
+        return self
+
+    def save_totals(self):
+        # ``update`` rather than ``save`` so the rest of the order isn't overwritten
+        Order.objects.filter(pk=self.pk).update(**{
+            field: getattr(self, field) for field in self.TOTAL_FIELDS
+        })
+
+    def add_items(self, lines):
+        """Create the items of this (saved) order from ``(variant, quantity)``
+        pairs with a single query, and store the totals calculated from them.
+        Load the variants with their product (see ``variant_related_fields``)
+        so that building the items makes no queries.
+        """
+        items = [
+            OrderItem(
+                order=self,
+                product=variant,
+                base_product_id=variant.product.id,
+                product_variant_id=variant.id,
+                product_variant_price=variant.price,
+                product_variant_ref=variant.ref,
+                product_variant_title=variant.get_product_title(),
+                quantity=quantity,
+            )
+            for variant, quantity in lines
+        ]
+        OrderItem.objects.bulk_create(items)
+        self.set_totals(sum(item.total for item in items), len(items), self.discounts.first())
+        self.save_totals()
+        return items
+
+    def set_totals(self, items_total, item_count, discount=None):
+        """Set the stored totals from already calculated item totals
+        """
+        self.items_total = round(items_total or Decimal(0), 2)
+        self.item_count = item_count
+        total = self.items_total
+        if self.shipping_rate:
+            total += self.shipping_rate
+        if discount:
+            total, _ = discount_total(total, discount)
+            self.discount_amount = discount.value
+        else:
+            self.discount_amount = 0
+        self.final_payment = round(total, 2)
     
     @property
     def order_count(self):
@@ -126,15 +213,7 @@ class Order(models.Model):
         self.shipping_status = new_shipping_status
         self.save()
         return self
-    
-    def discount_amount(self):
-        """Get the amount discounted on the order
-        """
-        discount = self.discounts.first() # There should only be one discount, as it is set up currently
-        if not discount:
-            return 0
-        
-        return discount.value
+
 
 
 class OrderItem(models.Model):
@@ -167,3 +246,110 @@ class OrderItem(models.Model):
     def __str__(self):
         return '{} x {}'.format(self.quantity, self.product_variant_title)
 
+
+class ArchivedOrder(models.Model):
+    """
+    An order moved out of the ``Order`` table by ``longclaw.orders.archive``.
+    The order keeps its id; its items and discount are stored as
+    JSON snapshots rather than as rows.
+    """
+    id = models.IntegerField(primary_key=True)
+    payment_date = models.DateTimeField(blank=True, null=True)
+    created_date = models.DateTimeField()
+    status = models.IntegerField(choices=Order.ORDER_STATUSES)
+    status_note = models.CharField(max_length=128, blank=True, null=True)
+    transaction_id = models.CharField(max_length=256, blank=True, null=True)
+    email = models.EmailField(max_length=128, blank=True, null=True, db_index=True)
+    ip_address = models.GenericIPAddressField(blank=True, null=True)
+    shipping_address = models.ForeignKey(
+        Address, blank=True, null=True, related_name='+', on_delete=models.PROTECT)
+    billing_address = models.ForeignKey(
+        Address, blank=True, null=True, related_name='+', on_delete=models.PROTECT)
+    shipping_rate = models.DecimalField(max_digits=12, decimal_places=2, blank=True, null=True)
+    receipt_email_sent = models.BooleanField(default=False)
+    total_paid = models.DecimalField(max_digits=12, decimal_places=2, blank=True, null=True)
+    account = models.ForeignKey('account.Account', related_name='+', blank=True, null=True, on_delete=models.SET_NULL)
+    is_subscription_order = models.BooleanField(default=False)
+    items_total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    item_count = models.IntegerField(default=0)
+    discount_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    final_payment = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    # Snapshots of the order items and discounts
+    items = models.JSONField(default=list)
+    discounts = models.JSONField(default=list)
+    archived_date = models.DateTimeField(auto_now_add=True)
+
+    ORDER_STATUSES = Order.ORDER_STATUSES
+
+    def __str__(self):
+        return "Archived order #{} - {}".format(self.id, self.email)
+
+    @property
+    def total(self):
+        return self.items_total
+
+    @property
+    def total_items(self):
+        return self.item_count
+
+
+class OrderSearchTerm(models.Model):
+    """
+    A normalised word or value an order can be found by.
+    See ``longclaw.orders.search``.
+    """
+    order = models.ForeignKey(Order, related_name='search_terms', on_delete=models.CASCADE)
+    term = models.CharField(max_length=TERM_LENGTH, db_index=True)
+
+    def __str__(self):
+        return self.term
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def update_order_totals(sender, instance, **kwargs):
+    if getattr(_totals_suspended, 'value', False):
+        return
+    if OrderItem.order.is_cached(instance):
+        order = instance.order
+    else:
+        # The order may already have been deleted, along with its items
+        order = Order.objects.filter(pk=instance.order_id).first()
+    if order is not None:
+        order.update_totals()
+
+
+@contextmanager
+def suspend_total_updates():
+    """Don't recalculate order totals as order items are saved
+    or deleted in this thread, e.g. when they are changed in bulk
+    """
+    previous = getattr(_totals_suspended, 'value', False)
+    _totals_suspended.value = True
+    try:
+        yield
+    finally:
+        _totals_suspended.value = previous
+
+
+@receiver(post_save, sender=Order)
+def update_order_search_index(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    """Index orders when they are created or a searchable field changes,
+    rather than on every save (e.g. of the status)
+    """
+    if raw:
+        return
+    if update_fields is not None and not SEARCH_FIELDS.intersection(update_fields):
+        return
+    values = search_values_key(instance)
+    if not created and getattr(instance, '_search_values', None) == values:
+        return
+    update_search_index(instance, created=created)
+    instance._search_values = values
+
+
+@receiver(address_modified)
+def update_address_orders_search_index(sender, instance, **kwargs):
+    for order in Order.objects.filter(shipping_address=instance).select_related('shipping_address'):
+        update_search_index(order)
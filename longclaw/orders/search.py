@@ -0,0 +1,127 @@
+"""
+Indexed order search.
+
+Each order's email and shipping name and city are normalised into
+``OrderSearchTerm`` rows, which are searched by prefix using the index
+on ``term``. On PostgreSQL, setting ``ORDER_SEARCH_TRIGRAM`` also matches
+terms by trigram similarity (requires ``django.contrib.postgres`` and
+the ``pg_trgm`` index created by ``create_trigram_index``).
+"""
+import operator
+import re
+import unicodedata
+from functools import reduce
+
+from django.db import connections, router
+from django.db.models import Q
+
+from longclaw.settings import ORDER_SEARCH_TRIGRAM
+
+# The maximum length of a search term
+TERM_LENGTH = 64
+
+# Fields of ``Order`` which its terms are built from
+SEARCH_FIELDS = {'email', 'shipping_address', 'shipping_address_id'}
+
+_WORD_SEPARATORS = re.compile(r'[\W_]+')
+
+
+def normalise(text):
+    """Lower case ``text`` and strip its accents
+    """
+    text = unicodedata.normalize('NFKD', str(text).casefold())
+    return ''.join(char for char in text if not unicodedata.combining(char)).strip()
+
+
+def order_search_values(order):
+    """The values an order can be found by
+    """
+    values = [order.email]
+    address = order.shipping_address
+    if address is not None:
+        values.extend([address.name, address.city])
+    return [value for value in values if value]
+
+
+def order_search_terms(order):
+    """Return the set of normalised terms for an order; each value
+    as a whole (e.g. a full email address) and each word in it
+    """
+    terms = set()
+    for value in order_search_values(order):
+        value = normalise(value)
+        terms.add(value[:TERM_LENGTH])
+        terms.update(word[:TERM_LENGTH] for word in _WORD_SEPARATORS.split(value))
+    terms.discard('')
+    return terms
+
+
+def search_values_key(order):
+    """The fields of the order itself which its terms are built from, to
+    tell whether a save changed them. Deferred fields are left out.
+    """
+    return tuple(order.__dict__.get(field) for field in ('email', 'shipping_address_id'))
+
+
+def update_search_index(order, created=False):
+    """Bring the search terms of an order up to date, only writing the
+    terms which changed. ``created`` orders have no terms to compare with.
+    """
+    from longclaw.orders.models import OrderSearchTerm
+    terms = order_search_terms(order)
+    existing = set() if created else set(
+        OrderSearchTerm.objects.filter(order=order).values_list('term', flat=True)
+    )
+    if existing - terms:
+        OrderSearchTerm.objects.filter(order=order, term__in=existing - terms).delete()
+    if terms - existing:
+        OrderSearchTerm.objects.bulk_create([
+            OrderSearchTerm(order=order, term=term) for term in terms - existing
+        ])
+
+
+TRIGRAM_INDEX = 'orders_ordersearchterm_term_trgm'
+
+
+def create_trigram_index(connection):
+    """Create the ``pg_trgm`` extension and the trigram index of search terms
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS {} ON orders_ordersearchterm '
+            'USING gin (term gin_trgm_ops)'.format(TRIGRAM_INDEX)
+        )
+
+
+def drop_trigram_index(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('DROP INDEX IF EXISTS {}'.format(TRIGRAM_INDEX))
+
+
+def use_trigrams():
+    from longclaw.orders.models import OrderSearchTerm
+    connection = connections[router.db_for_read(OrderSearchTerm)]
+    return ORDER_SEARCH_TRIGRAM and connection.vendor == 'postgresql'
+
+
+def search_orders(queryset, query):
+    """Filter ``queryset`` to the orders matching every word in ``query``.
+    A word matches the start of one of an order's terms, or its id.
+    """
+    from longclaw.orders.models import OrderSearchTerm
+    trigrams = use_trigrams()
+    for bit in query.split():
+        term = normalise(bit)[:TERM_LENGTH]
+        if not term:
+            continue
+        lookups = [Q(term__startswith=term)]
+        if trigrams:
+            lookups.append(Q(term__trigram_similar=term))
+        matches = Q(pk__in=OrderSearchTerm.objects.filter(
+            reduce(operator.or_, lookups)
+        ).values('order_id'))
+        if term.isdigit():
+            matches |= Q(pk=int(term))
+        queryset = queryset.filter(matches)
+    return queryset
@@ -1,6 +1,10 @@
+from decimal import Decimal
 from rest_framework import serializers
-from longclaw.orders.models import OrderItem
+from django.db.models import Case, Count, IntegerField, OuterRef, Prefetch, Subquery, When
+from django.db.models.functions import Coalesce
+from longclaw.orders.models import ArchivedOrder, OrderItem
 from longclaw.coupon.models import Discount
+from longclaw.utils import variant_related_fields
 from longclaw.coupon.utils import discount_total
 from longclaw.products.serializers import ProductVariantSerializer
 from longclaw.shipping.serializers import AddressSerializer
@@ -25,36 +29,101 @@ class OrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True)
     shipping_address = AddressSerializer()
     total = serializers.SerializerMethodField()
-    order_count = serializers.ReadOnlyField()
+    order_count = serializers.SerializerMethodField()
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """Load everything the serializer needs with a fixed number of
+        queries, however many orders are serialized
+        """
+        same_email = Order.objects.filter(
+            email=OuterRef('email')
+        ).order_by().values('email').annotate(count=Count('id')).values('count')
+        # ``email = NULL`` matches nothing, but ``order_count`` counts
+        # the orders without an email together
+        no_email = Order.objects.filter(
+            email__isnull=True
+        ).order_by().values('email').annotate(count=Count('id')).values('count')
+        return queryset.select_related('shipping_address').prefetch_related(
+            Prefetch('items', queryset=OrderItem.objects.select_related(
+                'product', *variant_related_fields('product__')
+            )),
+            Prefetch('discounts', queryset=Discount.objects.select_related('coupon')),
+        ).annotate(email_order_count=Case(
+            When(email__isnull=True, then=Subquery(no_email)),
+            default=Coalesce(Subquery(same_email), 0),
+            output_field=IntegerField()
+        ))
 
     def to_representation(self, value):
         rep = super().to_representation(value)
-        try:
-            discount = Discount.objects.get(order=value.id)
-            rep['discount_total'], amount_off = discount_total(value.total + value.shipping_rate, discount)
+        # ``all()`` rather than ``first()`` so prefetched discounts are used
+        discounts = list(value.discounts.all())
+        if discounts:
+            discount = discounts[0]
+            rep['discount_total'], amount_off = discount_total(value.total + (value.shipping_rate or 0), discount)
             rep['discount_value'] = discount.coupon.discount_string(discount.coupon.discount_value)
-        except Discount.DoesNotExist:
+            rep['coupon_code'] = discount.coupon.code
+        else:
             rep['discount_total'] = None
             rep['discount_value'] = None
+            rep['coupon_code'] = None
 
-        discount_amount = value.discount_amount()
-        if discount_amount:
-            rep['discount_amount'] = discount_amount
-        else:
+        if not value.discount_amount:
             rep['discount_amount'] = None
-        
-        rep['coupon_code'] = None
-        if value.discounts.exists():
-            try:
-                rep['coupon_code'] = value.discounts.first().coupon.code
-            except Exception as e:
-                pass
-        
+
         return rep
 
     class Meta:
         model = Order
-        fields = "__all__"
+        # Listed so internal columns aren't exposed by the API
+        fields = (
+            'id', 'items', 'payment_date', 'created_date', 'status', 'status_note',
+            'transaction_id', 'email', 'ip_address', 'shipping_address', 'billing_address',
+            'shipping_rate', 'receipt_email_sent', 'total_paid', 'account',
+            'is_subscription_order', 'items_total', 'item_count', 'discount_amount',
+            'final_payment', 'total', 'order_count',
+        )
 
     def get_total(self, obj):
         return obj.total
+
+    def get_order_count(self, obj):
+        if hasattr(obj, 'email_order_count'):
+            return obj.email_order_count
+        return obj.order_count
+
+
+class ArchivedOrderSerializer(serializers.ModelSerializer):
+    """
+    Serializes an archived order in the same shape as ``OrderSerializer``,
+    with the items and discount taken from their snapshots
+    """
+
+    shipping_address = AddressSerializer()
+    total = serializers.ReadOnlyField()
+    order_count = serializers.SerializerMethodField()
+
+    def to_representation(self, value):
+        rep = super().to_representation(value)
+        rep['items'] = [
+            dict(item, order=value.id, product=None,
+                 total=str(item['quantity'] * Decimal(item['product_variant_price'])))
+            for item in rep['items']
+        ]
+        discount = value.discounts[0] if value.discounts else {}
+        rep['discount_total'] = Decimal(discount['discount_total']) if discount else None
+        rep['discount_value'] = discount.get('discount_value')
+        rep['coupon_code'] = discount.get('coupon_code')
+        if not value.discount_amount:
+            rep['discount_amount'] = None
+        rep['archived'] = True
+        return rep
+
+    class Meta:
+        model = ArchivedOrder
+        exclude = ('discounts',)
+
+    def get_order_count(self, obj):
+        return ArchivedOrder.objects.filter(email=obj.email).count() + \
+            Order.objects.filter(email=obj.email).count()
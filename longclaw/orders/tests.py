@@ -1,5 +1,10 @@
+import csv
+import datetime
+import json
 import mock
+from decimal import Decimal
 from django.test import TestCase
+from django.utils import timezone
 from django.contrib.auth.models import User
 try:
   from django.urls import reverse_lazy
@@ -7,8 +12,20 @@ except ImportError:
   from django.core.urlresolvers import reverse_lazy
 from django.contrib.auth.models import User
 from wagtail.tests.utils import WagtailTestUtils
-from longclaw.tests.utils import LongclawTestCase, OrderFactory
-from longclaw.orders.wagtail_hooks import OrderModelAdmin
+from django.core.management import CommandError, call_command
+from django.utils.six import StringIO
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from longclaw.tests.utils import LongclawTestCase, AddressFactory, OrderFactory, ProductVariantFactory
+from longclaw.coupon.models import Coupon, Discount
+from longclaw.orders.models import ArchivedOrder, Order, OrderItem, OrderSearchTerm
+from longclaw.orders.search import search_orders
+from longclaw.orders import bulk
+from longclaw.shipping.models import Address
+from longclaw.shipping.signals import address_modified
+from longclaw.orders.api import OrderViewSet, OrderCursorPagination
+from longclaw.orders.wagtail_hooks import ArchivedOrderModelAdmin, OrderModelAdmin
+from longclaw.utils import ProductVariant, variant_related_fields
 
 class OrderTests(LongclawTestCase):
 
@@ -39,6 +56,438 @@ class OrderTests(LongclawTestCase):
         self.assertEqual(self.order.status, self.order.CANCELLED)
 
 
+class OrderBulkTests(LongclawTestCase):
+
+    def setUp(self):
+        self.orders = [OrderFactory(transaction_id="FAKE") for _ in range(3)]
+        self.ids = [order.id for order in self.orders]
+        admin = User.objects.create_superuser('admn', 'myemail@test.com', 'password')
+        self.client.force_authenticate(user=admin)
+
+    def statuses(self):
+        return list(Order.objects.filter(id__in=self.ids).order_by('id').values_list('status', flat=True))
+
+    def test_bulk_fulfill(self):
+        response = self.post_test({'ids': self.ids + [0]}, 'longclaw_bulk_fulfill_orders', format='json')
+        self.assertEqual(self.statuses(), [Order.FULFILLED] * 3)
+        self.assertEqual(response.data['succeeded'], 3)
+        self.assertEqual(response.data['failed'], 1)
+        self.assertEqual(response.data['results'][-1]['message'], 'Order not found')
+
+        self.post_test({'ids': self.ids[:1]}, 'longclaw_bulk_unfulfill_orders', format='json')
+        self.assertEqual(self.statuses(), [Order.SUBMITTED, Order.FULFILLED, Order.FULFILLED])
+
+    def test_bulk_refund(self):
+        def issue_refund(identifier, amount):
+            if amount == 1:
+                raise Exception('Gateway unavailable')
+            return True
+
+        Order.objects.filter(id=self.ids[1]).update(items_total=1)
+        with mock.patch('longclaw.utils.GATEWAY.issue_refund', side_effect=issue_refund):
+            response = self.post_test({'ids': self.ids}, 'longclaw_bulk_refund_orders', format='json')
+        self.assertEqual(self.statuses(), [Order.REFUNDED, Order.SUBMITTED, Order.REFUNDED])
+        self.assertEqual([result['success'] for result in response.data['results']], [True, False, True])
+        self.assertEqual(response.data['results'][1]['message'], 'Gateway unavailable')
+        self.assertTrue(Order.objects.get(id=self.ids[1]).status_note.startswith('Refund failed'))
+
+        # Refunded orders are not refunded again
+        with mock.patch('longclaw.utils.GATEWAY.issue_refund') as issue_refund:
+            response = self.post_test({'ids': self.ids[:1]}, 'longclaw_bulk_refund_orders', format='json')
+        issue_refund.assert_not_called()
+        self.assertFalse(response.data['results'][0]['success'])
+
+    def test_bulk_refund_skips_unpaid_orders(self):
+        Order.objects.filter(id=self.ids[0]).update(status=Order.PENDING)
+        Order.objects.filter(id=self.ids[1]).update(transaction_id=None)
+        Order.objects.filter(id=self.ids[2]).update(status=Order.REFUNDING)
+        with mock.patch('longclaw.utils.GATEWAY.issue_refund') as issue_refund:
+            response = self.post_test({'ids': self.ids}, 'longclaw_bulk_refund_orders', format='json')
+        issue_refund.assert_not_called()
+        self.assertEqual(response.data['failed'], 3)
+        self.assertEqual(self.statuses(), [Order.PENDING, Order.SUBMITTED, Order.REFUNDING])
+
+    def test_refund_claims_orders_once(self):
+        Order.objects.filter(id=self.ids[1]).update(status=Order.FULFILLED)
+        orders = {Order.SUBMITTED: [self.ids[0], self.ids[2]], Order.FULFILLED: [self.ids[1]]}
+        with self.assertNumQueries(3):
+            self.assertEqual(bulk._claim(orders), set(self.ids))
+        self.assertEqual(bulk._claim(orders), set())
+        self.assertEqual(self.statuses(), [Order.REFUNDING] * 3)
+
+    def test_bulk_status_changes_check_current_status(self):
+        Order.objects.filter(id=self.ids[1]).update(status=Order.REFUNDING)
+        Order.objects.filter(id=self.ids[2]).update(status=Order.PENDING)
+        response = self.post_test({'ids': self.ids}, 'longclaw_bulk_fulfill_orders', format='json')
+        self.assertEqual(self.statuses(), [Order.FULFILLED, Order.REFUNDING, Order.PENDING])
+        self.assertEqual([result['success'] for result in response.data['results']], [True, False, False])
+        self.assertEqual(response.data['results'][1]['status'], Order.REFUNDING)
+        self.assertEqual(response.data['results'][1]['message'], "An order which is 'Refunding' can't be made 'Fulfilled'")
+
+        response = self.post_test({'ids': self.ids, 'refund': False}, 'longclaw_bulk_cancel_orders', format='json')
+        self.assertEqual(self.statuses(), [Order.CANCELLED, Order.REFUNDING, Order.PENDING])
+        self.assertEqual(response.data['failed'], 2)
+
+        Order.objects.filter(id=self.ids[0]).update(status=Order.REFUNDED)
+        response = self.post_test({'ids': self.ids[:1]}, 'longclaw_bulk_unfulfill_orders', format='json')
+        self.assertEqual(self.statuses()[0], Order.REFUNDED)
+        self.assertEqual(response.data['failed'], 1)
+
+    def test_bulk_cancel(self):
+        with mock.patch('longclaw.utils.GATEWAY.issue_refund', return_value=False):
+            response = self.post_test({'ids': self.ids[:1]}, 'longclaw_bulk_cancel_orders', format='json')
+        self.assertEqual(response.data['failed'], 1)
+        self.post_test({'ids': self.ids, 'refund': False}, 'longclaw_bulk_cancel_orders', format='json')
+        self.assertEqual(self.statuses(), [Order.CANCELLED] * 3)
+
+    def test_invalid_ids(self):
+        response = self.post_test({'ids': 'all'}, 'longclaw_bulk_fulfill_orders',
+                                  format='json', success_expected=False)
+        self.assertEqual(response.status_code, 400)
+
+
+class OrderTotalsTests(TestCase):
+
+    def setUp(self):
+        self.order = OrderFactory(shipping_rate=5)
+
+    def add_item(self, price, quantity):
+        return OrderItem.objects.create(
+            order=self.order,
+            base_product_id=1,
+            product_variant_id=1,
+            product_variant_price=price,
+            product_variant_ref='ref',
+            product_variant_title='Title',
+            quantity=quantity
+        )
+
+    def test_totals_follow_items(self):
+        self.add_item(10, 2)
+        item = self.add_item('2.50', 1)
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual(order.items_total, Decimal('22.50'))
+        self.assertEqual(order.item_count, 2)
+        self.assertEqual(order.final_payment, Decimal('27.50'))
+
+        item.delete()
+        order.refresh_from_db()
+        self.assertEqual(order.items_total, 20)
+        self.assertEqual(order.item_count, 1)
+
+    def test_update_order_totals_command(self):
+        self.add_item(10, 2)
+        Order.objects.update(items_total=0, item_count=0, final_payment=0)
+        out = StringIO()
+        call_command('update_order_totals', stdout=out)
+        self.assertIn('Updated the totals of 1 orders', out.getvalue())
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.items_total, 20)
+        self.assertEqual(self.order.item_count, 1)
+        self.assertEqual(self.order.final_payment, 25)
+
+    def test_add_items(self):
+        variant_ids = [ProductVariantFactory(base_price=price).id for price in (3, 4, 5)]
+        variants = list(ProductVariant.objects.filter(id__in=variant_ids).select_related(
+            *variant_related_fields()).order_by('id'))
+        # Insert the items, look up the discount and store the totals
+        with self.assertNumQueries(3):
+            self.order.add_items((variant, 2) for variant in variants)
+        order = Order.objects.get(pk=self.order.pk)
+        items_total = sum(variant.price * 2 for variant in variants)
+        self.assertEqual(order.items_total, items_total)
+        self.assertEqual(order.item_count, 3)
+        self.assertEqual(order.final_payment, items_total + 5)
+        item = order.items.order_by('id').first()
+        self.assertEqual(item.product_variant_title, variants[0].get_product_title())
+        self.assertEqual(item.base_product_id, variants[0].product.id)
+
+
+class OrderListQueryTests(LongclawTestCase):
+
+    def setUp(self):
+        admin = User.objects.create_superuser('admn', 'myemail@test.com', 'password')
+        self.client.force_authenticate(user=admin)
+        self.coupon = Coupon.objects.create(
+            code='TENOFF',
+            discount_type_stream_field=[('percentage', {'percentage': 10})]
+        )
+
+    def create_orders(self, count):
+        for _ in range(count):
+            order = OrderFactory(email='repeat@test.com', shipping_rate=1)
+            for _ in range(2):
+                variant = ProductVariantFactory()
+                OrderItem.objects.create(
+                    order=order,
+                    product=variant,
+                    base_product_id=variant.product.id,
+                    product_variant_id=variant.id,
+                    product_variant_price=variant.base_price,
+                    product_variant_ref=variant.ref,
+                    product_variant_title=variant.get_product_title(),
+                )
+            Discount.objects.create(coupon=self.coupon, basket_id='basket', order=order)
+
+    def list_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_test('longclaw_all_orders', params={'limit': 100})
+        return response, len(queries)
+
+    def test_constant_queries(self):
+        self.create_orders(2)
+        _, few = self.list_queries()
+        self.create_orders(8)
+        response, many = self.list_queries()
+        self.assertEqual(few, many)
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertEqual(response.data['results'][0]['order_count'], 10)
+        self.assertEqual(response.data['results'][0]['coupon_code'], 'TENOFF')
+
+    def test_order_count_without_email(self):
+        OrderFactory()
+        OrderFactory()
+        response = self.get_test('longclaw_all_orders', params={'limit': 100})
+        self.assertEqual([order['order_count'] for order in response.data['results']], [2, 2])
+
+
+@mock.patch.object(OrderViewSet, 'pagination_class', OrderCursorPagination)
+class OrderCursorPaginationTests(LongclawTestCase):
+
+    def setUp(self):
+        admin = User.objects.create_superuser('admn', 'myemail@test.com', 'password')
+        self.client.force_authenticate(user=admin)
+        self.orders = [OrderFactory() for _ in range(5)]
+
+    def test_walk_pages(self):
+        ids = []
+        params = {'limit': 2}
+        while params:
+            response = self.get_test('longclaw_all_orders', params=params)
+            self.assertIsNone(response.data['count'])
+            ids.extend(order['id'] for order in response.data['results'])
+            params = response.data['next_params']
+        self.assertEqual(ids, [order.id for order in reversed(self.orders)])
+
+    def test_walk_pages_with_ties(self):
+        ids = []
+        params = {'limit': 2, 'ordering': 'status'}
+        while params:
+            response = self.get_test('longclaw_all_orders', params=params)
+            ids.extend(order['id'] for order in response.data['results'])
+            params = response.data['next_params']
+            if params:
+                params['ordering'] = 'status'
+        self.assertEqual(ids, [order.id for order in self.orders])
+
+    def test_nullable_ordering(self):
+        response = self.get_test('longclaw_all_orders', params={'ordering': 'email'},
+                                 success_expected=False)
+        self.assertEqual(response.status_code, 400)
+
+    def test_count(self):
+        response = self.get_test('longclaw_all_orders', params={'limit': 2, 'count': 'true'})
+        self.assertEqual(response.data['count'], 5)
+        self.assertIsNone(response.data['previous_params'])
+        self.assertEqual(response.data['next_params']['limit'], 2)
+
+
+class OrderSearchTests(LongclawTestCase):
+
+    def setUp(self):
+        admin = User.objects.create_superuser('admn', 'myemail@test.com', 'password')
+        self.client.force_authenticate(user=admin)
+        self.order = OrderFactory(
+            email='Jose.Garcia@example.com',
+            shipping_address=AddressFactory(name='José García', city='Málaga')
+        )
+        self.other = OrderFactory(email='someone@test.com', shipping_address=AddressFactory(name='Ann', city='Leeds'))
+
+    def search(self, query):
+        return list(search_orders(Order.objects.all(), query))
+
+    def test_prefix_search(self):
+        self.assertEqual(self.search('gar'), [self.order])
+        self.assertEqual(self.search('jose.garcia@ex'), [self.order])
+        self.assertEqual(self.search('MALAGA jos'), [self.order])
+        self.assertEqual(self.search('malaga leeds'), [])
+        self.assertEqual(self.search(str(self.other.id)), [self.other])
+
+    def test_index_follows_address(self):
+        address = self.other.shipping_address
+        address.city = 'York'
+        address.save()
+        address_modified.send(sender=Address, instance=address)
+        self.assertEqual(self.search('york'), [self.other])
+        self.assertEqual(self.search('leeds'), [])
+
+    def test_index_follows_email(self):
+        order = Order.objects.get(pk=self.other.pk)
+        order.email = 'changed@test.com'
+        order.save()
+        self.assertEqual(self.search('changed'), [self.other])
+        self.assertEqual(self.search('someone'), [])
+
+    def test_saves_without_search_changes(self):
+        order = Order.objects.get(pk=self.order.pk)
+        order.status = Order.FULFILLED
+        with self.assertNumQueries(1):
+            order.save()
+        with self.assertNumQueries(1):
+            order.save(update_fields=['status'])
+        self.assertEqual(self.search('gar'), [self.order])
+
+    def test_api_search(self):
+        response = self.get_test('longclaw_all_orders', params={'search': 'garc', 'limit': 10})
+        self.assertEqual([order['id'] for order in response.data['results']], [self.order.id])
+
+    def test_update_order_search_index_command(self):
+        OrderSearchTerm.objects.all().delete()
+        out = StringIO()
+        call_command('update_order_search_index', stdout=out)
+        self.assertIn('Indexed 2 orders', out.getvalue())
+        self.assertEqual(self.search('ann'), [self.other])
+
+    def test_trigram_index_command(self):
+        if connection.vendor == 'postgresql':
+            self.skipTest('Trigram indexes are supported')
+        with self.assertRaises(CommandError):
+            call_command('create_order_search_trigram_index', stdout=StringIO())
+
+
+class OrderExportTests(LongclawTestCase):
+
+    def setUp(self):
+        admin = User.objects.create_superuser('admn', 'myemail@test.com', 'password')
+        self.client.force_authenticate(user=admin)
+        self.order = OrderFactory(email='export@test.com', shipping_address=AddressFactory(name='Ann'))
+        for ref in ('first', 'second'):
+            OrderItem.objects.create(
+                order=self.order,
+                base_product_id=1,
+                product_variant_id=1,
+                product_variant_price=3,
+                product_variant_ref=ref,
+                product_variant_title='Title',
+                quantity=2
+            )
+        OrderFactory(status=Order.CANCELLED)
+
+    def export(self, params=None):
+        response = self.client.get(reverse_lazy('longclaw_export_orders'), params or {})
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content).decode()
+        if params and params.get('export_format') == 'ndjson':
+            return content.splitlines()
+        return [','.join(row) for row in csv.reader(StringIO(content))]
+
+    def test_csv_export(self):
+        lines = self.export()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('order_id,created_date'))
+        self.assertIn('export@test.com', lines[1])
+        self.assertIn('second', lines[2])
+
+    def test_ndjson_export(self):
+        lines = self.export({
+            'export_format': 'ndjson',
+            'status': Order.SUBMITTED,
+            'from': '2000-01-01'
+        })
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([row['product_variant_ref'] for row in rows], ['first', 'second'])
+        self.assertEqual(rows[0]['shipping_name'], 'Ann')
+
+    def test_invalid_date(self):
+        response = self.get_test('longclaw_export_orders', params={'to': 'yesterday'}, success_expected=False)
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_status(self):
+        response = self.get_test('longclaw_export_orders', params={'status': 'abc'}, success_expected=False)
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_orders_command(self):
+        out = StringIO()
+        call_command('export_orders', '--format', 'ndjson', '--to', '2000-01-01', stdout=out)
+        self.assertEqual(out.getvalue(), '')
+        call_command('export_orders', stdout=out)
+        self.assertEqual(len(list(csv.reader(StringIO(out.getvalue())))), 3)
+
+
+class OrderArchiveTests(LongclawTestCase):
+
+    def setUp(self):
+        admin = User.objects.create_superuser('admn', 'myemail@test.com', 'password')
+        self.client.force_authenticate(user=admin)
+        self.order = OrderFactory(status=Order.FULFILLED, email='old@test.com',
+                                  shipping_address=AddressFactory(name='Ann'))
+        for ref, price in (('first', 3), ('second', 4)):
+            OrderItem.objects.create(
+                order=self.order,
+                base_product_id=1,
+                product_variant_id=1,
+                product_variant_price=price,
+                product_variant_ref=ref,
+                product_variant_title='Title',
+                quantity=2
+            )
+        coupon = Coupon.objects.create(
+            code='TENOFF',
+            discount_type_stream_field=[('percentage', {'percentage': 10})]
+        )
+        self.discount = Discount.objects.create(coupon=coupon, basket_id='basket', order=self.order)
+        self.submitted = OrderFactory()
+        self.created_date = timezone.now() - datetime.timedelta(days=400)
+        Order.objects.filter(id__in=[self.order.id, self.submitted.id]).update(created_date=self.created_date)
+        self.recent = OrderFactory(status=Order.FULFILLED)
+
+    def test_archive_and_restore(self):
+        out = StringIO()
+        call_command('archive_orders', '--older-than-days', '365', stdout=out)
+        self.assertIn('Archived 1 orders', out.getvalue())
+        self.assertEqual(set(Order.objects.values_list('id', flat=True)), {self.submitted.id, self.recent.id})
+        self.assertFalse(OrderItem.objects.filter(order_id=self.order.id).exists())
+
+        archived = ArchivedOrder.objects.get(id=self.order.id)
+        self.assertEqual(archived.item_count, 2)
+        self.assertEqual(archived.items_total, 14)
+        self.assertEqual([item['product_variant_ref'] for item in archived.items], ['first', 'second'])
+        self.assertEqual(archived.discounts[0]['coupon_code'], 'TENOFF')
+        # The discount can't be applied to its basket again
+        self.assertFalse(Discount.objects.filter(id=self.discount.id).exists())
+
+        call_command('restore_orders', str(self.order.id), stdout=out)
+        self.assertIn('Restored 1 orders', out.getvalue())
+        self.assertFalse(ArchivedOrder.objects.exists())
+        order = Order.objects.get(id=self.order.id)
+        self.assertEqual(order.created_date, self.created_date)
+        self.assertEqual(order.final_payment, self.order.final_payment)
+        self.assertEqual(order.items.count(), 2)
+        self.assertEqual(order.discounts.get(), self.discount)
+        self.assertTrue(OrderSearchTerm.objects.filter(order=order, term='ann').exists())
+
+    def test_restore_without_variant(self):
+        variant = ProductVariantFactory()
+        OrderItem.objects.filter(order=self.order).update(product=variant)
+        call_command('archive_orders', stdout=StringIO())
+        variant.delete()
+        call_command('restore_orders', str(self.order.id), stdout=StringIO())
+        items = OrderItem.objects.filter(order_id=self.order.id)
+        self.assertEqual([item.product_id for item in items], [None, None])
+
+    def test_retrieve_archived_order(self):
+        expected = self.get_test('longclaw_orders', {'pk': self.order.id}).data
+        call_command('archive_orders', stdout=StringIO())
+        data = self.get_test('longclaw_orders', {'pk': self.order.id}).data
+        self.assertTrue(data['archived'])
+        for key in ('email', 'status', 'final_payment', 'coupon_code', 'discount_total', 'order_count'):
+            self.assertEqual(data[key], expected[key], key)
+        self.assertEqual([item['total'] for item in data['items']], ['6.00', '8.00'])
+
+        response = self.get_test('longclaw_orders', {'pk': 0}, success_expected=False)
+        self.assertEqual(response.status_code, 404)
+
+
 class TestOrderView(LongclawTestCase, WagtailTestUtils):
 
     def setUp(self):
@@ -53,6 +502,16 @@ class TestOrderView(LongclawTestCase, WagtailTestUtils):
         response = self.client.get(reverse_lazy(name))
         self.assertEqual(response.status_code, 200)
 
+    def test_order_index_search(self):
+        name = self.model_admin.url_helper.get_action_url_name('index')
+        response = self.client.get(reverse_lazy(name), {'q': 'someone'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_archived_order_index_view(self):
+        name = ArchivedOrderModelAdmin().url_helper.get_action_url_name('index')
+        response = self.client.get(reverse_lazy(name), {'q': 'someone'})
+        self.assertEqual(response.status_code, 200)
+
     def test_order_detail_view(self):
         order = OrderFactory()
         name = self.model_admin.url_helper.get_action_url_name('detail')
@@ -25,6 +25,26 @@ get_all_orders = api.OrderViewSet.as_view({
     'get': 'list'
 })
 
+bulk_fulfill_orders = api.OrderViewSet.as_view({
+    'post': 'bulk_fulfill'
+})
+
+bulk_unfulfill_orders = api.OrderViewSet.as_view({
+    'post': 'bulk_unfulfill'
+})
+
+bulk_cancel_orders = api.OrderViewSet.as_view({
+    'post': 'bulk_cancel'
+})
+
+bulk_refund_orders = api.OrderViewSet.as_view({
+    'post': 'bulk_refund'
+})
+
+export_orders = api.OrderViewSet.as_view({
+    'get': 'export'
+})
+
 order_statuses = api.OrderViewSet.as_view({
     'get': 'order_statuses'
 })
@@ -37,6 +57,11 @@ set_order_status = api.OrderViewSet.as_view({
 PREFIX = API_URL_PREFIX + 'order/'
 urlpatterns = [
     path(PREFIX + 'statuses/', order_statuses, name='longclaw_order_statuses'),
+    path(PREFIX + 'bulk/fulfill/', bulk_fulfill_orders, name='longclaw_bulk_fulfill_orders'),
+    path(PREFIX + 'bulk/unfulfill/', bulk_unfulfill_orders, name='longclaw_bulk_unfulfill_orders'),
+    path(PREFIX + 'bulk/cancel/', bulk_cancel_orders, name='longclaw_bulk_cancel_orders'),
+    path(PREFIX + 'bulk/refund/', bulk_refund_orders, name='longclaw_bulk_refund_orders'),
+    path(PREFIX + 'export/', export_orders, name='longclaw_export_orders'),
     path(PREFIX + '<int:pk>/status/<int:status_code>/', set_order_status, name='longclaw_set_order_status'),
     path(PREFIX + '<int:pk>/', orders, name='longclaw_orders'),
     path(PREFIX + '<int:pk>/fulfill/', fulfill_order, name='longclaw_fulfill_order'),
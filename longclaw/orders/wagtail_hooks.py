@@ -5,12 +5,15 @@ from django.conf.urls import url
 from wagtail.contrib.modeladmin.options import (
     ModelAdmin, modeladmin_register
 )
-from wagtail.contrib.modeladmin.helpers import ButtonHelper
+from wagtail.contrib.modeladmin.helpers import ButtonHelper, PermissionHelper
+from wagtail.contrib.modeladmin.helpers.search import BaseSearchHandler, DjangoORMSearchHandler
 from wagtail.contrib.modeladmin.views import InspectView
 
 from rest_framework.renderers import JSONRenderer
 
-from longclaw.orders.serializers import OrderSerializer
+from longclaw.orders.search import search_orders
+from longclaw.orders.models import ArchivedOrder
+from longclaw.orders.serializers import ArchivedOrderSerializer, OrderSerializer
 from longclaw.settings import API_URL_PREFIX
 
 from django.apps import apps
@@ -96,6 +99,20 @@ class DetailView(InspectView):
         return 'longclaw/orders_detail.html'
 
 
+class ArchivedDetailView(DetailView):
+    order_serializer = ArchivedOrderSerializer
+
+
+class OrderSearchHandler(BaseSearchHandler):
+    """Search orders using the search index
+    """
+
+    def search_queryset(self, queryset, search_term, **kwargs):
+        if not search_term:
+            return queryset
+        return search_orders(queryset, search_term)
+
+
 class OrderModelAdmin(ModelAdmin):
     model = Order
     menu_order = 100
@@ -103,8 +120,9 @@ class OrderModelAdmin(ModelAdmin):
     add_to_settings_menu = False
     exclude_from_explorer = False
     list_display = ('id', 'status', 'email',
-                    'payment_date', 'total_items', 'final_payment') # 'total')
+                    'payment_date', 'item_count', 'final_payment') # 'total')
     list_filter = ('status', 'payment_date')
+    search_handler_class = OrderSearchHandler
     inspect_view_enabled = True
     detail_view_class = DetailView
     button_helper_class = OrderButtonHelper
@@ -132,4 +150,31 @@ class OrderModelAdmin(ModelAdmin):
         )
         return urls
 
+
+class ReadOnlyPermissionHelper(PermissionHelper):
+
+    def user_can_create(self, user):
+        return False
+
+    def user_can_edit_obj(self, user, obj):
+        return False
+
+    def user_can_delete_obj(self, user, obj):
+        return False
+
+
+class ArchivedOrderModelAdmin(OrderModelAdmin):
+    """Read only listing of archived orders
+    """
+    model = ArchivedOrder
+    menu_label = 'Archived orders'
+    menu_icon = 'folder-inverse'
+    menu_order = 200
+    permission_helper_class = ReadOnlyPermissionHelper
+    search_handler_class = DjangoORMSearchHandler
+    search_fields = ('email',)
+    detail_view_class = ArchivedDetailView
+
+
 modeladmin_register(OrderModelAdmin)
+modeladmin_register(ArchivedOrderModelAdmin)
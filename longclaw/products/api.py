@@ -0,0 +1,40 @@
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework import permissions, status
+from rest_framework.response import Response
+from longclaw.products.stock import stock_levels
+
+# The most variants which can be checked in one request
+MAX_VARIANTS = 500
+
+
+@api_view(['GET'])
+@permission_classes([permissions.AllowAny])
+def stock_availability(request):
+    """
+    Check the stock of many variants with one query.
+    ``variants`` is a comma separated list of variant ids, each optionally
+    followed by ``:<quantity>`` (default 1), e.g. ``?variants=1:2,5,9:3``.
+    Responds with the stock of each variant and whether the quantity is available.
+    """
+    lines = {}
+    try:
+        for line in request.query_params.get('variants', '').split(','):
+            if not line:
+                continue
+            variant_id, _, quantity = line.partition(':')
+            lines[int(variant_id)] = int(quantity or 1)
+    except ValueError:
+        return Response({"message": "variants must be a list of <id> or <id>:<quantity>"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if len(lines) > MAX_VARIANTS:
+        return Response({"message": "At most {} variants can be checked at once".format(MAX_VARIANTS)},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    levels = stock_levels(lines.keys())
+    return Response({
+        variant_id: {
+            'stock': levels.get(variant_id, 0),
+            'available': levels.get(variant_id, 0) >= quantity,
+        }
+        for variant_id, quantity in lines.items()
+    }, status=status.HTTP_200_OK)
@@ -0,0 +1,18 @@
+from django.core.management import BaseCommand
+from longclaw.products.stock import release_expired_reservations
+
+class Command(BaseCommand):
+    """Give back the stock of expired reservations.
+    Stock is reserved when checkout starts; if the checkout is abandoned
+    its reservation expires after STOCK_RESERVATION_TIMEOUT minutes.
+    Run this regularly, e.g. with a cron job every few minutes.
+    """
+    help = "Release stock reservations which have expired"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of reservations to release per transaction')
+
+    def handle(self, *args, **options):
+        count = release_expired_reservations(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS("Released {} stock reservations".format(count)))
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        (settings.PRODUCT_VARIANT_MODEL.split(".")[0], '__first__'),
+        ('products', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('basket_id', models.CharField(db_index=True, max_length=32)),
+                ('quantity', models.IntegerField()),
+                ('expires', models.DateTimeField(db_index=True)),
+                ('variant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.PRODUCT_VARIANT_MODEL)),
+            ],
+        ),
+    ]
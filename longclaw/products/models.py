@@ -1,5 +1,6 @@
 from django.db import models
 from wagtail.core.models import Page
+from longclaw.settings import PRODUCT_VARIANT_MODEL
 
 
 # Abstract base classes a user can use to implement their own product system
@@ -29,7 +30,7 @@ class ProductBase(Page):
     def in_stock(self):
         """ Returns True if any of the product variants are in stock
         """
-        return any(self.variants.filter(stock__gt=0))
+        return self.variants.filter(stock__gt=0).exists()
 
 
 class ProductVariantBase(models.Model):
@@ -71,3 +72,19 @@ class ProductVariantBase(models.Model):
             return self.product.title
         except AttributeError:
             return self.ref
+
+
+class StockReservation(models.Model):
+    """
+    Stock held for a basket during checkout. The reserved quantity has
+    already been taken off the variant's ``stock``; it is given back if the
+    reservation is released, or kept when the order completes.
+    See ``longclaw.products.stock``.
+    """
+    variant = models.ForeignKey(PRODUCT_VARIANT_MODEL, related_name='+', on_delete=models.CASCADE)
+    basket_id = models.CharField(max_length=32, db_index=True)
+    quantity = models.IntegerField()
+    expires = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return '{} x {} for {}'.format(self.quantity, self.variant_id, self.basket_id)
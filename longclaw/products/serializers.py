@@ -15,7 +15,8 @@ class ProductVariantSerializer(serializers.ModelSerializer):
     def to_representation(self, value):
         rep = super().to_representation(value)
         rep['price'] = value.price
-        if value.product.first_image:
+        # Renditions cost a query per variant, so listings can opt out
+        if self.context.get('thumbnails', True) and value.product.first_image:
             rep['thumbnail'] = value.product.first_image.image.get_rendition('width-200').url
         return rep
 
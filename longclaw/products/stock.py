@@ -0,0 +1,155 @@
+"""
+Stock reservations for checkout.
+
+When checkout starts, the quantities in the basket are reserved by taking
+them off each variant's ``stock`` with a conditional ``UPDATE``
+(``stock = stock - n WHERE stock >= n``). Each update only locks the row
+of that variant, and concurrent checkouts can never take the stock below
+zero. A ``StockReservation`` records what was taken:
+
+- ``commit_stock`` keeps the reservations of a completed order (the stock
+  stays decremented) and deletes them;
+- ``release_stock`` gives the stock of a basket's reservations back, e.g.
+  when the payment fails;
+- ``release_expired_reservations`` gives back the stock of reservations
+  which were never committed or released (run it regularly with the
+  ``release_stock_reservations`` command).
+
+``stock`` is therefore always the quantity available to new checkouts.
+Reservations are only made when ``STOCK_RESERVATIONS`` is enabled.
+"""
+import datetime
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from longclaw.products.models import StockReservation
+from longclaw.settings import STOCK_RESERVATION_TIMEOUT
+from longclaw.utils import ProductVariant
+
+
+class InsufficientStock(ValueError):
+    """Raised when there isn't enough stock to reserve a basket
+    """
+
+    def __init__(self, variant_ids):
+        self.variant_ids = variant_ids
+        super().__init__('Not enough stock of variant(s) {}'.format(
+            ', '.join(str(variant_id) for variant_id in variant_ids)
+        ))
+
+
+def stock_levels(variant_ids):
+    """Return a dict of the stock available for each of the given variants
+    """
+    return dict(ProductVariant.objects.filter(id__in=variant_ids).values_list('id', 'stock'))
+
+
+def check_availability(lines):
+    """Return a dict of whether the quantity of each variant in ``lines``
+    (a dict of variant id to quantity) is available, with one query
+    """
+    levels = stock_levels(lines.keys())
+    return {
+        variant_id: levels.get(variant_id, 0) >= quantity
+        for variant_id, quantity in lines.items()
+    }
+
+
+def adjust_stock(changes):
+    """Add the quantity in ``changes`` (a dict of variant id to quantity)
+    to the stock of each variant, in a consistent order to avoid deadlocks
+    """
+    for variant_id, quantity in sorted(changes.items()):
+        if quantity:
+            ProductVariant.objects.filter(id=variant_id).update(stock=F('stock') + quantity)
+
+
+def reserve_stock(basket_id, lines, timeout=None):
+    """
+    Reserve the quantity of each variant in ``lines`` (a dict of variant id
+    to quantity) for a basket, replacing any reservations it already has.
+    Either every line is reserved or, if there is not enough stock of some
+    variants, none are and ``InsufficientStock`` is raised.
+    """
+    timeout = STOCK_RESERVATION_TIMEOUT if timeout is None else timeout
+    expires = timezone.now() + datetime.timedelta(minutes=timeout)
+    with transaction.atomic():
+        previous, _ = _take_reservations(StockReservation.objects.filter(basket_id=basket_id))
+        short = []
+        # Only the difference from the basket's previous reservations is
+        # taken or given back, in a consistent order to avoid deadlocks
+        for variant_id in sorted(set(previous) | set(lines)):
+            change = lines.get(variant_id, 0) - previous.get(variant_id, 0)
+            if change > 0:
+                reserved = ProductVariant.objects.filter(
+                    id=variant_id, stock__gte=change
+                ).update(stock=F('stock') - change)
+                if not reserved:
+                    short.append(variant_id)
+            elif change < 0:
+                adjust_stock({variant_id: -change})
+        if short:
+            # Rolls back the stock already taken
+            raise InsufficientStock(short)
+        return StockReservation.objects.bulk_create([
+            StockReservation(variant_id=variant_id, basket_id=basket_id, quantity=quantity, expires=expires)
+            for variant_id, quantity in lines.items()
+        ])
+
+
+def _take_reservations(reservations):
+    """Delete the reservations in a queryset, returning the quantity
+    reserved of each variant and the number of reservations deleted.
+    Must be called in a transaction.
+    """
+    rows = list(reservations.select_for_update().values_list('id', 'variant_id', 'quantity'))
+    StockReservation.objects.filter(id__in=[row[0] for row in rows]).delete()
+    quantities = defaultdict(int)
+    for _, variant_id, quantity in rows:
+        quantities[variant_id] += quantity
+    return quantities, len(rows)
+
+
+def release_stock(basket_id):
+    """Give back the stock reserved for a basket
+    """
+    with transaction.atomic():
+        reserved, _ = _take_reservations(StockReservation.objects.filter(basket_id=basket_id))
+        adjust_stock(reserved)
+
+
+def commit_stock(basket_id, lines):
+    """
+    Make the stock taken for a basket's completed order permanent.
+    ``lines`` is a dict of the quantity ordered of each variant; any
+    difference from the quantity reserved (e.g. if the reservation had
+    expired) is taken from or given back to the stock.
+    """
+    with transaction.atomic():
+        reserved, _ = _take_reservations(StockReservation.objects.filter(basket_id=basket_id))
+        variant_ids = set(reserved) | set(lines)
+        adjust_stock({
+            variant_id: reserved.get(variant_id, 0) - lines.get(variant_id, 0)
+            for variant_id in variant_ids
+        })
+
+
+def release_expired_reservations(now=None, batch_size=500):
+    """Give back the stock of reservations which have expired,
+    ``batch_size`` per transaction. Returns the number released.
+    """
+    expired = StockReservation.objects.filter(expires__lt=now or timezone.now())
+    count = 0
+    while True:
+        with transaction.atomic():
+            batch = expired.order_by('id')[:batch_size]
+            ids = list(batch.values_list('id', flat=True))
+            if not ids:
+                break
+            reserved, released = _take_reservations(StockReservation.objects.filter(id__in=ids))
+            adjust_stock(reserved)
+        count += released
+    return count
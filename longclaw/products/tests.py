@@ -1,7 +1,17 @@
+import datetime
+
+from django.core.management import call_command
+from django.utils import timezone
+from django.utils.six import StringIO
 from wagtail.tests.utils import WagtailPageTests
 from longclaw.utils import maybe_get_product_model
 from longclaw.tests.testproducts.models import ProductIndex
-from longclaw.tests.utils import ProductVariantFactory
+from longclaw.tests.utils import LongclawTestCase, ProductVariantFactory
+from longclaw.products.models import StockReservation
+from longclaw.products.stock import (
+    InsufficientStock, check_availability, commit_stock, release_expired_reservations,
+    release_stock, reserve_stock
+)
 from longclaw.products.serializers import ProductVariantSerializer
 
 class TestProducts(WagtailPageTests):
@@ -42,3 +52,79 @@ class TestProducts(WagtailPageTests):
     def test_product_title(self):
         variant = ProductVariantFactory()
         self.assertEqual(variant.get_product_title(), variant.product.title)
+
+
+
+class StockReservationTest(LongclawTestCase):
+
+    def setUp(self):
+        self.variant = ProductVariantFactory(stock=5)
+        self.other = ProductVariantFactory(stock=1)
+
+    def stock(self, variant):
+        variant.refresh_from_db()
+        return variant.stock
+
+    def test_reserve(self):
+        reserve_stock('basket', {self.variant.id: 2, self.other.id: 1})
+        self.assertEqual(self.stock(self.variant), 3)
+        self.assertEqual(self.stock(self.other), 0)
+        self.assertEqual(StockReservation.objects.filter(basket_id='basket').count(), 2)
+
+    def test_reserve_again(self):
+        reserve_stock('basket', {self.variant.id: 2, self.other.id: 1})
+        reserve_stock('basket', {self.variant.id: 4})
+        self.assertEqual(self.stock(self.variant), 1)
+        self.assertEqual(self.stock(self.other), 1)
+        self.assertEqual(StockReservation.objects.filter(basket_id='basket').count(), 1)
+
+    def test_insufficient_stock(self):
+        with self.assertRaises(InsufficientStock) as cm:
+            reserve_stock('basket', {self.variant.id: 2, self.other.id: 2})
+        self.assertEqual(cm.exception.variant_ids, [self.other.id])
+        # Nothing is reserved
+        self.assertEqual(self.stock(self.variant), 5)
+        self.assertEqual(self.stock(self.other), 1)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_release(self):
+        reserve_stock('basket', {self.variant.id: 2})
+        release_stock('basket')
+        self.assertEqual(self.stock(self.variant), 5)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_commit(self):
+        reserve_stock('basket', {self.variant.id: 2})
+        commit_stock('basket', {self.variant.id: 3})
+        self.assertEqual(self.stock(self.variant), 2)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_release_expired(self):
+        reserve_stock('basket', {self.variant.id: 2})
+        reserve_stock('other', {self.variant.id: 1}, timeout=-1)
+        self.assertEqual(release_expired_reservations(), 1)
+        self.assertEqual(self.stock(self.variant), 3)
+        self.assertEqual(StockReservation.objects.get().basket_id, 'basket')
+
+    def test_release_command(self):
+        reserve_stock('basket', {self.variant.id: 2}, timeout=-1)
+        out = StringIO()
+        call_command('release_stock_reservations', stdout=out)
+        self.assertIn('Released 1', out.getvalue())
+        self.assertEqual(self.stock(self.variant), 5)
+
+    def test_check_availability(self):
+        availability = check_availability({self.variant.id: 5, self.other.id: 2})
+        self.assertEqual(availability, {self.variant.id: True, self.other.id: False})
+
+    def test_availability_api(self):
+        response = self.get_test('longclaw_stock_availability', params={
+            'variants': '{}:5,{}:2'.format(self.variant.id, self.other.id)
+        })
+        self.assertEqual(response.data[self.variant.id], {'stock': 5, 'available': True})
+        self.assertEqual(response.data[self.other.id], {'stock': 1, 'available': False})
+
+    def test_availability_api_invalid(self):
+        response = self.get_test('longclaw_stock_availability', params={'variants': 'a:b'},
+                                 success_expected=False)
+        self.assertEqual(response.status_code, 400)
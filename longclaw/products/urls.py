@@ -0,0 +1,8 @@
+from django.urls import path
+from longclaw.products import api
+from longclaw.settings import API_URL_PREFIX
+
+PREFIX = API_URL_PREFIX + 'products/'
+urlpatterns = [
+    path(PREFIX + 'stock/', api.stock_availability, name='longclaw_stock_availability'),
+]
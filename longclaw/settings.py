@@ -21,6 +21,83 @@ PRODUCT_VARIANT_MODEL = getattr(
 ORDER_MODEL = getattr(
     settings, 'ORDER_MODEL', 'orders.Order')
 
+# The storage backend for basket contents.
+# Can be 'longclaw.basket.backends.DatabaseBasketBackend' or
+# 'longclaw.basket.backends.CacheBasketBackend'
+# Or a custom implementation
+BASKET_BACKEND = getattr(
+    settings, 'BASKET_BACKEND', 'longclaw.basket.backends.DatabaseBasketBackend')
+
+# Only used by the cache basket backend
+BASKET_CACHE_ALIAS = getattr(settings, 'BASKET_CACHE_ALIAS', 'default')
+BASKET_CACHE_TIMEOUT = getattr(settings, 'BASKET_CACHE_TIMEOUT', 60 * 60 * 24 * 14)
+
+# Set to the name of a cookie to identify baskets with a signed cookie
+# instead of storing the basket id in the session. Baskets already
+# identified by the session are still honoured.
+# Requires 'longclaw.basket.middleware.BasketCookieMiddleware'
+BASKET_ID_COOKIE = getattr(settings, 'BASKET_ID_COOKIE', None)
+BASKET_ID_COOKIE_AGE = getattr(settings, 'BASKET_ID_COOKIE_AGE', 60 * 60 * 24 * 14)
+
+# Page the orders API with a cursor rather than a limit/offset.
+# Deep pages stay fast and the total count is only calculated on request
+ORDER_API_CURSOR_PAGINATION = getattr(settings, 'ORDER_API_CURSOR_PAGINATION', False)
+
+# Also match order searches by trigram similarity. PostgreSQL only;
+# requires 'django.contrib.postgres' and the index created by the
+# ``create_order_search_trigram_index`` command
+ORDER_SEARCH_TRIGRAM = getattr(settings, 'ORDER_SEARCH_TRIGRAM', False)
+
+# The number of refunds to request from the payment gateway
+# concurrently when refunding orders in bulk
+ORDER_REFUND_WORKERS = getattr(settings, 'ORDER_REFUND_WORKERS', 8)
+
+# Orders older than this many days (which are no longer being processed)
+# are moved to the archive by the ``archive_orders`` command
+ORDER_ARCHIVE_DAYS = getattr(settings, 'ORDER_ARCHIVE_DAYS', 365)
+
+# Orders still 'Awaiting Payment' this many minutes after checkout started
+# have their stock released by the ``recover_pending_orders`` command
+CHECKOUT_PENDING_TIMEOUT = getattr(settings, 'CHECKOUT_PENDING_TIMEOUT', 30)
+
+# Responses to checkout API requests sent with an ``Idempotency-Key`` header
+# are kept in this cache for CHECKOUT_IDEMPOTENCY_TIMEOUT seconds. A retry
+# of a request which is still running waits up to CHECKOUT_IDEMPOTENCY_WAIT
+# seconds for its response
+CHECKOUT_IDEMPOTENCY_CACHE_ALIAS = getattr(settings, 'CHECKOUT_IDEMPOTENCY_CACHE_ALIAS', 'default')
+CHECKOUT_IDEMPOTENCY_TIMEOUT = getattr(settings, 'CHECKOUT_IDEMPOTENCY_TIMEOUT', 60 * 60 * 24)
+CHECKOUT_IDEMPOTENCY_WAIT = getattr(settings, 'CHECKOUT_IDEMPOTENCY_WAIT', 30)
+
+# Reserve the stock of the items in the basket when checkout starts, and
+# take it off the variants' stock when the order completes. Checkout fails
+# if there is not enough stock. Reservations which are neither completed
+# nor released are given back after STOCK_RESERVATION_TIMEOUT minutes by
+# the ``release_stock_reservations`` command
+STOCK_RESERVATIONS = getattr(settings, 'STOCK_RESERVATIONS', False)
+STOCK_RESERVATION_TIMEOUT = getattr(settings, 'STOCK_RESERVATION_TIMEOUT', 15)
+
+# Checkout quotes are cached in this cache for CHECKOUT_QUOTE_TIMEOUT
+# seconds, or until the basket or the shipping address is modified
+CHECKOUT_QUOTE_CACHE_ALIAS = getattr(settings, 'CHECKOUT_QUOTE_CACHE_ALIAS', 'default')
+CHECKOUT_QUOTE_TIMEOUT = getattr(settings, 'CHECKOUT_QUOTE_TIMEOUT', 60 * 5)
+
+# Shipping rate processors are run concurrently on up to this many threads
+# (or one after another in the request's thread when set to 0).
+# Rates of processors which take longer than SHIPPING_PROCESSOR_TIMEOUT
+# seconds (or their own ``rates_timeout``) are left out of the response
+SHIPPING_PROCESSOR_WORKERS = getattr(settings, 'SHIPPING_PROCESSOR_WORKERS', 8)
+SHIPPING_PROCESSOR_TIMEOUT = getattr(settings, 'SHIPPING_PROCESSOR_TIMEOUT', 10)
+
+# Each process compiles the static shipping rates into a table, which it
+# uses for at most SHIPPING_RATE_TABLE_TIMEOUT seconds, or until the rates
+# change (when the cache is shared by all processes)
+SHIPPING_RATE_TABLE_TIMEOUT = getattr(settings, 'SHIPPING_RATE_TABLE_TIMEOUT', 30)
+
+# Unsaved rates returned by shipping rate processors (quotes) are kept in
+# this cache for SHIPPING_QUOTE_TIMEOUT seconds instead of in the database
+SHIPPING_QUOTE_CACHE_ALIAS = getattr(settings, 'SHIPPING_QUOTE_CACHE_ALIAS', 'default')
+SHIPPING_QUOTE_TIMEOUT = getattr(settings, 'SHIPPING_QUOTE_TIMEOUT', 60 * 60)
+
 ORDER_LIST_VIEW_URL = '/admin/orders/order/'
 
 # Only required if using Stripe as the payment gateway
@@ -36,4 +113,19 @@ BRAINTREE_PRIVATE_KEY = getattr(settings, 'BRAINTREE_PRIVATE_KEY', '')
 # Only required for using paypal as the payment gateway through braintree v.zero
 VZERO_ACCESS_TOKEN = getattr(settings, 'VZERO_ACCESS_TOKEN', '')
 
+# Seconds to wait for a connection to, and a response from, the payment provider
+PAYMENT_GATEWAY_CONNECT_TIMEOUT = getattr(settings, 'PAYMENT_GATEWAY_CONNECT_TIMEOUT', 5)
+PAYMENT_GATEWAY_READ_TIMEOUT = getattr(settings, 'PAYMENT_GATEWAY_READ_TIMEOUT', 30)
+
+# Payment provider calls which are safe to repeat are retried this many times
+# if the provider can't be reached, waiting PAYMENT_GATEWAY_RETRY_BACKOFF
+# seconds before the first retry and twice as long before each next one
+PAYMENT_GATEWAY_MAX_RETRIES = getattr(settings, 'PAYMENT_GATEWAY_MAX_RETRIES', 2)
+PAYMENT_GATEWAY_RETRY_BACKOFF = getattr(settings, 'PAYMENT_GATEWAY_RETRY_BACKOFF', 0.5)
+
+# After this many consecutive failed calls to the payment provider, calls
+# fail immediately for PAYMENT_GATEWAY_RECOVERY_TIMEOUT seconds
+PAYMENT_GATEWAY_FAILURE_THRESHOLD = getattr(settings, 'PAYMENT_GATEWAY_FAILURE_THRESHOLD', 5)
+PAYMENT_GATEWAY_RECOVERY_TIMEOUT = getattr(settings, 'PAYMENT_GATEWAY_RECOVERY_TIMEOUT', 30)
+
 API_URL_PREFIX = getattr(settings, 'LONGCLAW_API_URL_PREFIX', 'api/')
@@ -1,4 +1,3 @@
-from django.db.models import Q
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework import permissions, status, viewsets
 from rest_framework.response import Response
@@ -9,6 +8,9 @@ from longclaw.basket.utils import basket_id
 from .models import ShippingRateProcessor
 from .signals import address_modified
 
+LATE_PROCESSORS_HEADER = 'Shipping-Processors-Late'
+FAILED_PROCESSORS_HEADER = 'Shipping-Processors-Failed'
+
 class AddressViewSet(viewsets.ModelViewSet):
     """
     Create, list and view Addresses
@@ -107,32 +109,19 @@ def shipping_options(request, country=None):
     except (utils.InvalidShippingCountry, utils.InvalidShippingDestination) as e:
         return Response(data={'message': e.message}, status=status.HTTP_400_BAD_REQUEST)
     
-    country_code = kwargs['country_code']
-    settings = kwargs['settings']
-    bid = kwargs['basket_id']
-    destination = kwargs['destination']
-    
-    processors = ShippingRateProcessor.objects.filter(countries__in=[country_code])
-    if processors:
-        if not destination:
-            return Response(
-                data={
-                    "message": "Destination address is required for rates to {}.".format(country_code)
-                },
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        for processor in processors:
-            processor.get_rates(settings=settings, basket_id=bid, destination=destination)
-    
-    q = Q(countries__in=[country_code]) | Q(basket_id=bid, destination=None)
-    
-    if destination:
-        q.add(Q(destination=destination, basket_id=''), Q.OR)
-        q.add(Q(destination=destination, basket_id=bid), Q.OR)
-    
-    qrs = models.ShippingRate.objects.filter(q)
+    kwargs.pop('name')
+    try:
+        qrs, report = utils.get_shipping_options(**kwargs)
+    except utils.InvalidShippingDestination as e:
+        return Response(data={'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     serializer = serializers.ShippingRateSerializer(qrs, many=True)
-    return Response(
+    response = Response(
         data=serializer.data,
         status=status.HTTP_200_OK
     )
+    # Rates of processors which were late or failed are missing
+    if report['late']:
+        response[LATE_PROCESSORS_HEADER] = ', '.join(str(pk) for pk in report['late'])
+    if report['failed']:
+        response[FAILED_PROCESSORS_HEADER] = ', '.join(str(pk) for pk in report['failed'])
+    return response
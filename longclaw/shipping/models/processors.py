@@ -1,67 +1,125 @@
-import json
 import hashlib
+import time
+import uuid
 
 from django.utils.encoding import force_bytes, force_text
 from django.core.cache import cache
-from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models, transaction
 from django.dispatch import receiver
 
-from longclaw.basket.models import BasketItem
 from longclaw.basket.signals import basket_modified
 from polymorphic.models import PolymorphicModel
 from wagtail.admin.edit_handlers import FieldPanel
 
-from ..serializers.locations import AddressSerializer
 from ..signals import address_modified
+from .rates import ShippingRate
+
+# Seconds between checks for rates being calculated by another request
+RATES_POLL_INTERVAL = 0.1
 
 
 class ShippingRateProcessor(PolymorphicModel):
     countries = models.ManyToManyField('shipping.Country')
     
     rates_cache_timeout = 300
+    # Seconds a request calculating the rates holds their lock. Other
+    # requests for the same rates wait up to this long for them rather
+    # than calling the carrier again
+    rates_lock_timeout = 30
+    # Give requests which would wait the last rates calculated for the
+    # basket and destination instead (stale-while-revalidate)
+    rates_serve_stale = False
+    rates_stale_timeout = 60 * 60
+
     def get_rates(self, settings=None, basket_id=None, destination=None):
+        """
+        Return the rates of ``process_rates``, cached. Unsaved rates it
+        returns are stored as quotes (see ``longclaw.shipping.quotes``)
+        rather than in the database; rates it saved for the same basket
+        and destination last time are deleted first.
+
+        Only one request at a time calculates the rates for a key; the
+        others wait for its rates, or get the stale rates if
+        ``rates_serve_stale`` is set.
+        """
+        from longclaw.shipping.quotes import store_quotes
+
         kwargs = dict(settings=settings, basket_id=basket_id, destination=destination)
         key = self.get_rates_cache_key(**kwargs)
-        rates = cache.get(key)
-        if rates is None:
+        lock_key = key + ':lock'
+        token = uuid.uuid4().hex
+
+        deadline = time.monotonic() + self.rates_lock_timeout
+        while True:
+            rates = cache.get(key)
+            if rates is not None:
+                return rates
+            if cache.add(lock_key, token, self.rates_lock_timeout):
+                break
+            # Another request is calculating the rates
+            if self.rates_serve_stale:
+                rates = cache.get(self.get_stale_rates_cache_key(**kwargs))
+                if rates is not None:
+                    # Until the new quotes replace them
+                    store_quotes(
+                        self, basket_id, destination, rates,
+                        timeout=self.rates_lock_timeout, replace=False
+                    )
+                    return rates
+            if time.monotonic() >= deadline:
+                # Its lock is about to expire, so carry on without it
+                token = None
+                break
+            time.sleep(RATES_POLL_INTERVAL)
+
+        try:
             with transaction.atomic():
+                # Rates this processor saved last time (rather than
+                # returning quotes) are replaced by the new ones
+                ShippingRate.objects.filter(
+                    processor=self, basket_id=basket_id or '', destination=destination
+                ).delete()
                 rates = self.process_rates(**kwargs)
             if rates is not None:
+                store_quotes(self, basket_id, destination, rates)
                 cache.set(key, rates, self.rates_cache_timeout)
+                if self.rates_serve_stale:
+                    cache.set(self.get_stale_rates_cache_key(**kwargs), rates, self.rates_stale_timeout)
+        finally:
+            if token and cache.get(lock_key) == token:
+                cache.delete(lock_key)
         return rates
-    
+
     def get_rates_cache_key(self, **kwargs):
-        from longclaw.basket.serializers import BasketItemSerializer
-        
-        settings = kwargs['settings']
-        origin = settings.shipping_origin
+        """
+        Build the cache key from a fingerprint of the basket's items and the
+        ids and versions of the origin and destination addresses, so the
+        key changes whenever anything the rates are calculated from does.
+        """
+        from longclaw.basket.utils import basket_fingerprint
+        from longclaw.shipping.utils import address_version
+
+        origin_id = getattr(kwargs['settings'], 'shipping_origin_id', None)
         destination = kwargs['destination']
         basket_id = kwargs['basket_id']
-        
-        items = BasketItem.objects.filter(basket_id=basket_id)
-        serialized_items = BasketItemSerializer(items, many=True)
-        
-        serialized_origin = AddressSerializer(origin) or None
-        serialized_destination = AddressSerializer(destination) or None
-        
-        data = {
-            "items": serialized_items.data,
-            "origin": serialized_origin.data,
-            "destination": serialized_destination.data,
-        }
-        
-        raw_key = json.dumps(
-            data,
-            sort_keys=True,
-            indent=4,
-            separators=(',', ': '),
-            cls=DjangoJSONEncoder,
-        )
-        
+
+        parts = [self.pk, basket_id, basket_fingerprint(basket_id)]
+        for address_id in (origin_id, getattr(destination, 'pk', None)):
+            parts.extend([address_id, address_version(address_id) if address_id else None])
+
+        raw_key = ':'.join(force_text(part) for part in parts)
         hashed_key = hashlib.sha1(force_bytes(raw_key)).hexdigest()
-        
+
         return force_text(hashed_key)
     
+    def get_stale_rates_cache_key(self, **kwargs):
+        """
+        The key of the last rates calculated for the basket and destination,
+        which (unlike ``get_rates_cache_key``) stays the same when they change
+        """
+        destination = kwargs['destination']
+        raw_key = 'stale:{}:{}:{}'.format(self.pk, kwargs['basket_id'], getattr(destination, 'pk', None))
+        return force_text(hashlib.sha1(force_bytes(raw_key)).hexdigest())
+
     def process_rates(self, **kwargs):
         raise NotImplementedError()
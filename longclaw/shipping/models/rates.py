@@ -1,11 +1,6 @@
 from django.db import models
-from django.dispatch import receiver
-
-from longclaw.basket.signals import basket_modified
 from wagtail.admin.edit_handlers import FieldPanel
 
-from ..signals import address_modified
-
 
 class ShippingRate(models.Model):
     """
@@ -40,13 +35,3 @@ class ShippingRate(models.Model):
 
     class Meta:
         ordering = ['order_number', 'name',]
-
-
-@receiver(address_modified)
-def clear_address_rates(sender, instance, **kwargs):
-    ShippingRate.objects.filter(destination=instance).delete()
-
-
-@receiver(basket_modified)
-def clear_basket_rates(sender, basket_id, **kwargs):
-    ShippingRate.objects.filter(basket_id=basket_id).delete()
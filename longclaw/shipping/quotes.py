@@ -0,0 +1,89 @@
+"""
+Quotes: the shipping rates a shipping rate processor calculated for a
+basket and destination address.
+
+A processor's ``process_rates`` may return unsaved ``ShippingRate``
+instances instead of saving a row per rate. They are kept in the cache
+(``SHIPPING_QUOTE_CACHE_ALIAS``) for ``SHIPPING_QUOTE_TIMEOUT`` seconds and
+looked up alongside the saved rates by ``get_shipping_options`` and
+``get_shipping_cost``. Keys include a fingerprint of the basket and the
+version of the address, so a quote is never used once either changes;
+old quotes simply expire instead of being deleted. The rate of the quote
+an order is placed with is copied onto the order (``Order.shipping_rate``),
+so quotes never need to be saved.
+"""
+import hashlib
+
+from django.core.cache import caches
+
+from longclaw.basket.utils import basket_fingerprint
+from longclaw.settings import SHIPPING_QUOTE_CACHE_ALIAS, SHIPPING_QUOTE_TIMEOUT
+from longclaw.shipping.models import ShippingRate
+from longclaw.shipping.utils import address_version
+
+key_prefix = 'longclaw:shipping-quotes:'
+
+
+def get_cache():
+    return caches[SHIPPING_QUOTE_CACHE_ALIAS]
+
+
+def get_quotes_keys(processor_ids, basket_id, destination):
+    """Return the cache key of the quotes of each processor, by processor id
+    """
+    destination_id = getattr(destination, 'pk', None)
+    scope = '{}:{}:{}:{}'.format(
+        basket_id,
+        basket_fingerprint(basket_id),
+        destination_id,
+        address_version(destination_id) if destination_id else None,
+    )
+    return {
+        processor_id: key_prefix + hashlib.sha1('{}:{}'.format(processor_id, scope).encode()).hexdigest()
+        for processor_id in processor_ids
+    }
+
+
+def is_quote(rate):
+    return isinstance(rate, ShippingRate) and rate.pk is None
+
+
+def make_quote(rate):
+    """Copy a rate without any related objects, so it pickles small
+    """
+    return ShippingRate(**{
+        field.attname: getattr(rate, field.attname)
+        for field in ShippingRate._meta.concrete_fields
+    })
+
+
+def store_quotes(processor, basket_id, destination, rates, timeout=None, replace=True):
+    """Store the unsaved rates in ``rates`` as the quotes of a processor,
+    for ``timeout`` seconds (``SHIPPING_QUOTE_TIMEOUT`` by default).
+    Unless ``replace`` is set, quotes it already has are kept.
+    """
+    quotes = [make_quote(rate) for rate in rates if is_quote(rate)]
+    if quotes:
+        key = get_quotes_keys([processor.pk], basket_id, destination)[processor.pk]
+        store = get_cache().set if replace else get_cache().add
+        store(key, quotes, SHIPPING_QUOTE_TIMEOUT if timeout is None else timeout)
+    return quotes
+
+
+def get_quotes(processor_ids, basket_id, destination):
+    """Return the stored quotes of the given processors, with one cache lookup
+    """
+    if not processor_ids:
+        return []
+    keys = get_quotes_keys(processor_ids, basket_id, destination)
+    stored = get_cache().get_many(keys.values())
+    return [quote for key in keys.values() for quote in stored.get(key, [])]
+
+
+def find_quote(name, processor_ids, basket_id, destination):
+    """Return the stored quote called ``name``, or None
+    """
+    for quote in get_quotes(processor_ids, basket_id, destination):
+        if quote.name == name:
+            return quote
+    return None
@@ -1,4 +1,7 @@
+from collections import OrderedDict
+
 from rest_framework import serializers
+from rest_framework.relations import PKOnlyObject
 
 from longclaw.shipping.models.rates import ShippingRate
 
@@ -6,3 +9,17 @@ class ShippingRateSerializer(serializers.ModelSerializer):
     class Meta:
         model = ShippingRate
         fields = "__all__"
+
+    def to_representation(self, instance):
+        if instance.pk is not None:
+            return super().to_representation(instance)
+        # Quotes of shipping rate processors aren't saved, so have no countries
+        data = OrderedDict()
+        for field in self._readable_fields:
+            if field.field_name == 'countries':
+                data['countries'] = []
+                continue
+            attribute = field.get_attribute(instance)
+            check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+            data[field.field_name] = None if check_for_none is None else field.to_representation(attribute)
+        return data
@@ -1,16 +1,22 @@
+import time
 import uuid
 import mock
 from decimal import Decimal
 
+from django.core.cache import cache
 from django.utils.encoding import force_text
-from django.test import TestCase
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.test.client import RequestFactory
 from django.forms.models import model_to_dict
 from longclaw.tests.utils import LongclawTestCase, AddressFactory, CountryFactory, ShippingRateFactory, BasketItemFactory, catch_signal
 from longclaw.shipping.api import get_shipping_cost_kwargs
 from longclaw.shipping.forms import AddressForm
 from longclaw.shipping.models import Address, Country
-from longclaw.shipping.utils import get_shipping_cost, InvalidShippingCountry
+from longclaw.shipping.utils import (
+    compile_rate_table, get_shipping_cost, rates_version, run_processors, InvalidShippingCountry, InvalidShippingRate
+)
 from longclaw.shipping.templatetags import longclawshipping_tags
 from longclaw.configuration.models import Configuration
 from longclaw.basket.signals import basket_modified
@@ -19,7 +25,7 @@ from rest_framework import status
 from rest_framework.views import APIView
 from  wagtail.core.models import Site
 
-from .models import Address, ShippingRate, clear_basket_rates, clear_address_rates, ShippingRateProcessor
+from .models import Address, ShippingRate, ShippingRateProcessor
 from .signals import address_modified
 from .serializers import AddressSerializer, ShippingRateSerializer
 
@@ -158,6 +164,53 @@ class ShippingTests(LongclawTestCase):
         result = get_shipping_cost(ls)
         self.assertEqual(ls.default_shipping_rate, result["rate"])
 
+    def test_shipping_cost_rate_table(self):
+        sr = ShippingRateFactory(countries=[self.country])
+        get_shipping_cost(Configuration(), self.country.pk, sr.name)
+        # The compiled table is used until the rates change
+        with self.assertNumQueries(0):
+            result = get_shipping_cost(Configuration(), self.country.pk, sr.name)
+        self.assertEqual(result["rate"], sr.rate)
+
+        sr.rate = 7
+        sr.save()
+        result = get_shipping_cost(Configuration(), self.country.pk, sr.name)
+        self.assertEqual(result["rate"], 7)
+
+        sr.countries.remove(self.country)
+        with self.assertRaises(InvalidShippingRate):
+            get_shipping_cost(Configuration(), self.country.pk, sr.name)
+
+    def test_shipping_cost_rate_table_expires(self):
+        sr = ShippingRateFactory(countries=[self.country])
+        get_shipping_cost(Configuration(), self.country.pk, sr.name)
+        # A change another process made without a shared version is used
+        # once the table expires
+        ShippingRate.objects.filter(pk=sr.pk).update(rate=7)
+        result = get_shipping_cost(Configuration(), self.country.pk, sr.name)
+        self.assertEqual(result["rate"], sr.rate)
+        with mock.patch('longclaw.shipping.utils.time.monotonic', return_value=time.monotonic() + 60):
+            result = get_shipping_cost(Configuration(), self.country.pk, sr.name)
+        self.assertEqual(result["rate"], 7)
+
+    def test_rate_table_leaves_out_ambiguous_rates(self):
+        rows = [
+            (self.country.pk, 'one', Decimal('1'), 'd', 'c'),
+            (self.country.pk, 'two', Decimal('2'), 'd', 'c'),
+            (self.country.pk, 'two', Decimal('3'), 'd', 'c'),
+        ]
+        through = ShippingRate.countries.through
+        with mock.patch.object(through.objects, 'values_list', return_value=rows):
+            table = compile_rate_table()
+        self.assertEqual(table[('one', self.country.pk)]["rate"], Decimal('1'))
+        self.assertNotIn(('two', self.country.pk), table)
+
+    def test_basket_rates_do_not_change_rates_version(self):
+        version = rates_version()
+        ShippingRate.objects.create(name='basket', rate=1, carrier='c', description='d', basket_id='foo')
+        ShippingRate.objects.filter(basket_id='foo').delete()
+        self.assertEqual(rates_version(), version)
+
 
 class ShippingBasketTests(LongclawTestCase):
     def setUp(self):
@@ -224,16 +277,12 @@ class ShippingBasketTests(LongclawTestCase):
         self.assertEqual(result["rate"], 95)
         self.assertEqual(result["description"], '78b03c47-b20f-4f91-8161-47340367fb34')
     
-    def test_clear_basket_rates_is_connected(self):
-        result = basket_modified.disconnect(clear_basket_rates)
-        self.assertTrue(result)
-        basket_modified.connect(clear_basket_rates)
-    
-    def test_clear_basket_rates(self):
-        self.assertTrue(ShippingRate.objects.filter(pk__in=[self.rate1.pk, self.rate2.pk, self.rate3.pk]).exists())
-        clear_basket_rates(sender=ShippingRate, basket_id=self.bid)
-        self.assertFalse(ShippingRate.objects.filter(pk__in=[self.rate1.pk, self.rate2.pk]).exists())
-        self.assertTrue(ShippingRate.objects.filter(pk__in=[self.rate3.pk]).exists())
+    def test_basket_modified_keeps_rates(self):
+        # Rates are not deleted every time a basket changes
+        with CaptureQueriesContext(connection) as queries:
+            basket_modified.send(sender=ShippingRate, basket_id=self.bid)
+        self.assertFalse([query for query in queries if query['sql'].startswith('DELETE')])
+        self.assertEqual(ShippingRate.objects.filter(pk__in=[self.rate1.pk, self.rate2.pk, self.rate3.pk]).count(), 3)
 
 
 class AddressModifiedSignalTest(LongclawTestCase):
@@ -283,16 +332,12 @@ class AddressModifiedSignalTest(LongclawTestCase):
             destination=address,
         )
     
-    def test_clear_address_rates_is_connected(self):
-        result = address_modified.disconnect(clear_address_rates)
-        self.assertTrue(result)
-        address_modified.connect(clear_address_rates)
-    
-    def test_clear_address_rates(self):
-        self.assertTrue(ShippingRate.objects.filter(pk__in=[self.rate1.pk, self.rate2.pk, self.rate3.pk]).exists())
-        clear_address_rates(sender=ShippingRate, instance=self.ratedAddress)
-        self.assertTrue(ShippingRate.objects.filter(pk__in=[self.rate1.pk]).exists())
-        self.assertFalse(ShippingRate.objects.filter(pk__in=[self.rate2.pk, self.rate3.pk]).exists())
+    def test_address_modified_keeps_rates(self):
+        # Rates are not deleted every time an address changes
+        with CaptureQueriesContext(connection) as queries:
+            address_modified.send(sender=ShippingRate, instance=self.ratedAddress)
+        self.assertFalse([query for query in queries if query['sql'].startswith('DELETE')])
+        self.assertEqual(ShippingRate.objects.filter(pk__in=[self.rate1.pk, self.rate2.pk, self.rate3.pk]).count(), 3)
 
     # def test_create_address_sends_signal(self):
     #     with catch_signal(address_modified) as handler:
@@ -477,6 +522,93 @@ class ShippingRateProcessorTest(LongclawTestCase):
         
         self.assertEqual(processor.get_rates(), rates_alt)
 
+    def test_get_rates_cache_key(self):
+        address = AddressFactory()
+        BasketItemFactory(basket_id='foo')
+        processor = ShippingRateProcessor.objects.create()
+        other = ShippingRateProcessor.objects.create()
+        kwargs = dict(settings=Configuration(), basket_id='foo', destination=address)
+
+        key = processor.get_rates_cache_key(**kwargs)
+        self.assertEqual(processor.get_rates_cache_key(**kwargs), key)
+        self.assertNotEqual(other.get_rates_cache_key(**kwargs), key)
+
+        address_modified.send(sender=Address, instance=address)
+        self.assertNotEqual(processor.get_rates_cache_key(**kwargs), key)
+        key = processor.get_rates_cache_key(**kwargs)
+
+        BasketItemFactory(basket_id='foo')
+        self.assertNotEqual(processor.get_rates_cache_key(**kwargs), key)
+
+
+    def single_flight_processor(self, rates):
+        processor = ShippingRateProcessor()
+        processor.process_rates = mock.Mock(return_value=rates)
+        processor.get_rates_cache_key = lambda **kwargs: 'single-flight'
+        cache.delete('single-flight')
+        cache.delete('single-flight:lock')
+        return processor
+
+    def test_get_rates_replaces_saved_rates(self):
+        processor = ShippingRateProcessor.objects.create()
+        address = AddressFactory()
+        kwargs = dict(settings=None, basket_id='foo', destination=address)
+        old = ShippingRate.objects.create(
+            name='old', rate=1, carrier='c', description='d', basket_id='foo', destination=address, processor=processor
+        )
+        other = ShippingRate.objects.create(
+            name='other', rate=1, carrier='c', description='d', basket_id='bar', destination=address, processor=processor
+        )
+        processor.process_rates = mock.Mock(return_value=[])
+        processor.get_rates(**kwargs)
+        self.assertFalse(ShippingRate.objects.filter(pk=old.pk).exists())
+        self.assertTrue(ShippingRate.objects.filter(pk=other.pk).exists())
+
+    def test_get_rates_releases_lock(self):
+        processor = self.single_flight_processor(['fresh'])
+        self.assertEqual(processor.get_rates(), ['fresh'])
+        self.assertIsNone(cache.get('single-flight:lock'))
+
+    def test_get_rates_waits_for_request_in_flight(self):
+        processor = self.single_flight_processor(['fresh'])
+        cache.add('single-flight:lock', 'other', 30)
+
+        # The other request finishes while this one is waiting
+        def finish(seconds):
+            cache.set('single-flight', ['theirs'])
+        with mock.patch('longclaw.shipping.models.processors.time.sleep', side_effect=finish) as sleep:
+            self.assertEqual(processor.get_rates(), ['theirs'])
+        sleep.assert_called_once()
+        processor.process_rates.assert_not_called()
+        self.assertEqual(cache.get('single-flight:lock'), 'other')
+
+    def test_get_rates_stops_waiting(self):
+        processor = self.single_flight_processor(['fresh'])
+        processor.rates_lock_timeout = 0
+        cache.add('single-flight:lock', 'other', 30)
+
+        self.assertEqual(processor.get_rates(), ['fresh'])
+        processor.process_rates.assert_called_once()
+        # The lock isn't this request's to release
+        self.assertEqual(cache.get('single-flight:lock'), 'other')
+
+    def test_get_rates_serves_stale(self):
+        processor = self.single_flight_processor(['fresh'])
+        processor.rates_serve_stale = True
+        cache.set(processor.get_stale_rates_cache_key(basket_id=None, destination=None), ['stale'])
+        cache.add('single-flight:lock', 'other', 30)
+
+        with mock.patch('longclaw.shipping.models.processors.time.sleep') as sleep:
+            self.assertEqual(processor.get_rates(), ['stale'])
+        sleep.assert_not_called()
+        processor.process_rates.assert_not_called()
+
+        cache.delete('single-flight:lock')
+        self.assertEqual(processor.get_rates(), ['fresh'])
+        self.assertEqual(
+            cache.get(processor.get_stale_rates_cache_key(basket_id=None, destination=None)), ['fresh']
+        )
+
 
 class ShippingRateProcessorAPITest(LongclawTestCase):
     def setUp(self):
@@ -518,6 +650,72 @@ class ShippingRateProcessorAPITest(LongclawTestCase):
             response = self.get_test('longclaw_applicable_shipping_rate_list', params=params)
             self.assertEqual(mocked_get_rates.call_count, 3)
 
+    def test_shipping_option_endpoint_reports_failed_processors(self):
+        processor = ShippingRateProcessor()
+        processor.save()
+        processor.countries.add(self.country)
+        params = {
+            'destination': self.address.pk,
+        }
+        with mock.patch('longclaw.shipping.api.ShippingRateProcessor.get_rates', side_effect=ValueError()):
+            response = self.get_test('longclaw_applicable_shipping_rate_list', params=params)
+        failed = response['Shipping-Processors-Failed'].split(', ')
+        self.assertEqual(sorted(failed), sorted([str(self.processor.pk), str(processor.pk)]))
+        self.assertNotIn('Shipping-Processors-Late', response)
+
+
+def mock_processor(pk, delay=0, error=None, timeout=None):
+    def get_rates(**kwargs):
+        time.sleep(delay)
+        if error:
+            raise error
+        return []
+    return mock.Mock(pk=pk, rates_timeout=timeout, get_rates=mock.Mock(side_effect=get_rates))
+
+
+class RunProcessorsTest(SimpleTestCase):
+
+    def test_processors_run_concurrently(self):
+        processors = [mock_processor(1, delay=0.2), mock_processor(2, delay=0.2)]
+        start = time.monotonic()
+        report = run_processors(processors, settings=None, basket_id='foo', destination=None)
+        self.assertLess(time.monotonic() - start, 0.35)
+        self.assertEqual(report, {'late': [], 'failed': []})
+        processors[0].get_rates.assert_called_once_with(settings=None, basket_id='foo', destination=None)
+
+    def test_late_and_failed_processors(self):
+        processors = [
+            mock_processor(1),
+            mock_processor(2, delay=0.5, timeout=0.05),
+            mock_processor(3, error=ValueError()),
+        ]
+        start = time.monotonic()
+        report = run_processors(processors, settings=None, basket_id='foo', destination=None)
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(report, {'late': [2], 'failed': [3]})
+
+    def test_single_processor_has_a_timeout(self):
+        start = time.monotonic()
+        report = run_processors([mock_processor(1, delay=0.5, timeout=0.05)], settings=None, basket_id='foo', destination=None)
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(report, {'late': [1], 'failed': []})
+
+    @mock.patch('longclaw.shipping.utils.SHIPPING_PROCESSOR_WORKERS', 0)
+    def test_processors_run_in_calling_thread(self):
+        processors = [
+            mock_processor(1, delay=0.1),
+            mock_processor(2, error=ValueError()),
+            mock_processor(3, timeout=0.05),
+            mock_processor(4),
+        ]
+        with mock.patch('longclaw.shipping.utils.get_processor_executor') as executor:
+            report = run_processors(processors, settings=None, basket_id='foo', destination=None)
+        executor.assert_not_called()
+        # Processors whose time is up before they start are skipped
+        self.assertEqual(report, {'late': [3], 'failed': [2]})
+        processors[2].get_rates.assert_not_called()
+        processors[3].get_rates.assert_called_once_with(settings=None, basket_id='foo', destination=None)
+
 
 class ShippingOptionEndpointTest(LongclawTestCase):
     def setUp(self):
@@ -1,6 +1,35 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from django.core.cache import cache
+from django.db import connections
 from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 
+from longclaw.settings import (
+    SHIPPING_PROCESSOR_TIMEOUT, SHIPPING_PROCESSOR_WORKERS, SHIPPING_RATE_TABLE_TIMEOUT
+)
 from longclaw.shipping import models
+from longclaw.shipping.signals import address_modified
+
+ADDRESS_VERSION_KEY = 'longclaw:address-version:{}'
+
+# Seconds an address version is kept for
+ADDRESS_VERSION_TIMEOUT = 60 * 60 * 24
+
+RATES_VERSION_KEY = 'longclaw:shipping-rates-version'
+
+# The compiled table of static shipping rates in this process, the version
+# of the rates it was compiled from and when it expires
+_rate_table = (None, 0, {})
+_rate_table_lock = threading.Lock()
+
+# Threads running shipping rate processors, shared by all requests
+_processor_executor = None
+_processor_executor_lock = threading.Lock()
 
 
 class InvalidShippingRate(Exception):
@@ -15,11 +44,81 @@ class InvalidShippingDestination(Exception):
     pass
 
 
+def rates_version():
+    """Return a token which changes whenever a static shipping rate
+    (one with countries) is modified
+    """
+    version = cache.get(RATES_VERSION_KEY)
+    if version is None:
+        cache.add(RATES_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(RATES_VERSION_KEY)
+    return version
+
+
+def compile_rate_table():
+    """
+    Return a dict of the shipping rates for each (name, country code),
+    built with a single query. Like a query for the rate, a (name, country code)
+    matching more than one rate has no rate.
+    """
+    table = {}
+    ambiguous = set()
+    rates = models.ShippingRate.countries.through.objects.values_list(
+        'country_id', 'shippingrate__name', 'shippingrate__rate',
+        'shippingrate__description', 'shippingrate__carrier'
+    )
+    for country_code, name, rate, description, carrier in rates:
+        key = (name, country_code)
+        if key in table:
+            ambiguous.add(key)
+        table[key] = {
+            "rate": rate,
+            "description": description,
+            "carrier": carrier}
+    for key in ambiguous:
+        del table[key]
+    return table
+
+
+def get_rate_table():
+    """
+    Return the table of static shipping rates. It is compiled once per
+    process and compiled again when the rates version changes, or after
+    ``SHIPPING_RATE_TABLE_TIMEOUT`` seconds in case the version is not
+    shared with the process which changed the rates.
+    """
+    global _rate_table
+    version = rates_version()
+    table_version, expires, table = _rate_table
+    if table_version != version or time.monotonic() >= expires:
+        with _rate_table_lock:
+            table_version, expires, table = _rate_table
+            if table_version != version or time.monotonic() >= expires:
+                table = compile_rate_table()
+                _rate_table = (version, time.monotonic() + SHIPPING_RATE_TABLE_TIMEOUT, table)
+    return table
+
+
+@receiver(post_save, sender=models.ShippingRate)
+@receiver(post_delete, sender=models.ShippingRate)
+def bump_rates_version(sender, instance=None, **kwargs):
+    # Rates for a basket or destination (e.g. from processors) are not in the table
+    if instance is not None and (instance.basket_id or instance.destination_id):
+        return
+    cache.set(RATES_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+@receiver(m2m_changed, sender=models.ShippingRate.countries.through)
+def bump_rates_version_on_countries_change(sender, **kwargs):
+    if kwargs['action'] in ('post_add', 'post_remove', 'post_clear'):
+        bump_rates_version(sender)
+
+
 def get_shipping_cost(settings, country_code=None, name=None, basket_id=None, destination=None):
     """Return the shipping cost for a given country code and shipping option (shipping rate name)
     """
     if not country_code and destination:
-        country_code = destination.country.pk
+        country_code = destination.country_id
         
     shipping_rate = None
     invalid_country = False
@@ -33,14 +132,9 @@ def get_shipping_cost(settings, country_code=None, name=None, basket_id=None, de
         invalid_country = True
 
     if country_code:
-        qrs = models.ShippingRate.objects.filter(countries__in=[country_code], name=name)
-        count = qrs.count()
-        if count == 1:
-            shipping_rate_qrs = qrs[0]
-            shipping_rate = {
-                "rate": shipping_rate_qrs.rate,
-                "description": shipping_rate_qrs.description,
-                "carrier": shipping_rate_qrs.carrier}
+        country_rate = get_rate_table().get((name, country_code))
+        if country_rate is not None:
+            shipping_rate = dict(country_rate)
     
     if basket_id or destination:
         q = Q()
@@ -54,14 +148,26 @@ def get_shipping_cost(settings, country_code=None, name=None, basket_id=None, de
         if basket_id:
             q.add(Q(destination=None, basket_id=basket_id), Q.OR)
             
-        qrs = models.ShippingRate.objects.filter(name=name).filter(q)
-        count = qrs.count()
-        if count == 1:
+        qrs = list(models.ShippingRate.objects.filter(name=name).filter(q)[:2])
+        if len(qrs) == 1:
             shipping_rate_qrs = qrs[0]
             shipping_rate = {
                 "rate": shipping_rate_qrs.rate,
                 "description": shipping_rate_qrs.description,
                 "carrier": shipping_rate_qrs.carrier}
+
+    if destination and country_code:
+        from longclaw.shipping.quotes import find_quote
+
+        processor_ids = list(models.ShippingRateProcessor.objects.filter(
+            countries__in=[country_code]
+        ).values_list('pk', flat=True))
+        quote = find_quote(name, processor_ids, basket_id, destination)
+        if quote is not None:
+            shipping_rate = {
+                "rate": quote.rate,
+                "description": quote.description,
+                "carrier": quote.carrier}
     
     if not shipping_rate:
         if invalid_country:
@@ -69,3 +175,118 @@ def get_shipping_cost(settings, country_code=None, name=None, basket_id=None, de
         raise InvalidShippingRate()
         
     return shipping_rate
+
+
+def get_processor_executor():
+    global _processor_executor
+    if _processor_executor is None:
+        with _processor_executor_lock:
+            if _processor_executor is None:
+                _processor_executor = ThreadPoolExecutor(
+                    max_workers=SHIPPING_PROCESSOR_WORKERS,
+                    thread_name_prefix='longclaw-shipping'
+                )
+    return _processor_executor
+
+
+def _get_processor_rates(processor, kwargs):
+    try:
+        return processor.get_rates(**kwargs)
+    finally:
+        # Worker threads are reused, so don't leave their connections open
+        connections.close_all()
+
+
+def run_processors(processors, **kwargs):
+    """
+    Get the rates of each shipping rate processor, concurrently.
+    Each processor has ``rates_timeout`` seconds (``SHIPPING_PROCESSOR_TIMEOUT``
+    by default) to finish. A processor which is late carries on in the
+    background, so its rates are cached for the next request.
+
+    With ``SHIPPING_PROCESSOR_WORKERS`` set to 0 the processors are run one
+    after another in the calling thread instead (e.g. so they see its
+    uncommitted changes); processors whose time is up before they start
+    are skipped and reported as late.
+
+    Returns a dict of the ids of the processors which were ``late``
+    and of those which ``failed``.
+    """
+    report = {'late': [], 'failed': []}
+    start = time.monotonic()
+    if not SHIPPING_PROCESSOR_WORKERS:
+        for processor in processors:
+            timeout = getattr(processor, 'rates_timeout', None) or SHIPPING_PROCESSOR_TIMEOUT
+            if time.monotonic() - start >= timeout:
+                report['late'].append(processor.pk)
+                continue
+            try:
+                processor.get_rates(**kwargs)
+            except Exception:
+                report['failed'].append(processor.pk)
+        return report
+
+    executor = get_processor_executor()
+    futures = [
+        (processor, executor.submit(_get_processor_rates, processor, kwargs))
+        for processor in processors
+    ]
+    for processor, future in futures:
+        timeout = getattr(processor, 'rates_timeout', None) or SHIPPING_PROCESSOR_TIMEOUT
+        try:
+            future.result(timeout=max(0, start + timeout - time.monotonic()))
+        except TimeoutError:
+            report['late'].append(processor.pk)
+        except Exception:
+            report['failed'].append(processor.pk)
+    return report
+
+
+def get_shipping_options(settings, country_code=None, basket_id=None, destination=None):
+    """
+    Return a list of the shipping rates available for a country and/or
+    destination address, running any shipping rate processors for the
+    country, and the report of processors which were late or failed
+    (see ``run_processors``). The list includes the processors' quotes
+    (see ``longclaw.shipping.quotes``), which are not saved.
+    """
+    from longclaw.shipping.quotes import get_quotes
+
+    if not country_code and destination:
+        country_code = destination.country_id
+
+    report = {'late': [], 'failed': []}
+    quotes = []
+    processors = list(models.ShippingRateProcessor.objects.filter(countries__in=[country_code]))
+    if processors:
+        if not destination:
+            raise InvalidShippingDestination(
+                "Destination address is required for rates to {}.".format(country_code)
+            )
+        report = run_processors(processors, settings=settings, basket_id=basket_id, destination=destination)
+        quotes = get_quotes([processor.pk for processor in processors], basket_id, destination)
+
+    q = Q(countries__in=[country_code]) | Q(basket_id=basket_id, destination=None)
+
+    if destination:
+        q.add(Q(destination=destination, basket_id=''), Q.OR)
+        q.add(Q(destination=destination, basket_id=basket_id), Q.OR)
+
+    rates = list(models.ShippingRate.objects.filter(q)) + quotes
+    return sorted(rates, key=lambda rate: (rate.order_number, rate.name)), report
+
+
+def address_version(address_id):
+    """Return a token which changes whenever the address is modified
+    """
+    key = ADDRESS_VERSION_KEY.format(address_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, ADDRESS_VERSION_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+@receiver(address_modified)
+def bump_address_version(sender, instance, **kwargs):
+    cache.set(ADDRESS_VERSION_KEY.format(instance.pk), uuid.uuid4().hex, ADDRESS_VERSION_TIMEOUT)
@@ -1,4 +1,5 @@
 import datetime
+from django.db.models import Sum
 from wagtail.core import hooks
 from wagtail.admin.site_summary import SummaryItem
 from longclaw.orders.models import Order
@@ -53,7 +54,7 @@ class MonthlySales(LongclawSummaryItem):
         sales = stats.sales_for_time_period(*stats.current_month())
         return {
             'total': "{}{}".format(settings.currency_html_code,
-                                   sum(order.total for order in sales)),
+                                   sales.aggregate(total=Sum('items_total'))['total'] or 0),
             'text': 'In sales this month',
             'url': '/admin/orders/order/',
             'icon': 'icon-tick'
@@ -6,8 +6,9 @@ from longclaw.basket.utils import get_basket_items, destroy_basket
 from longclaw.coupon.utils import discount_total
 from longclaw.subscriptions.models import Subscription, SubscriptionOrderItem
 from longclaw.checkout.errors import PaymentError
-from longclaw.settings import STRIPE_SECRET_KEY
+from longclaw.checkout.gateways.stripe import get_stripe_gateway
 from longclaw.configuration.models import Configuration
+from longclaw.utils import variant_related_fields
 
 from django.apps import apps
 from longclaw.settings import ORDER_MODEL
@@ -15,7 +16,6 @@ Order = apps.get_model(*ORDER_MODEL.split('.'))
 
 from decimal import Decimal
 import datetime
-import stripe
 import math
 
 def next_weekday(d, weekday):
@@ -161,32 +161,18 @@ def create_order_from_subscription(subscription):
     order.save()
 
     # Create the order items & compute total
-    total = 0
-    for subscription_item in subscription.items.all():
-        item = subscription_item.product
-        quantity = subscription_item.quantity
-        total += subscription_item.total
-        order_item = order.items.create(
-            product=item,
-            base_product_id=item.product.id,
-            product_variant_id=item.id,
-            product_variant_price=item.price,
-            product_variant_ref=item.ref,
-            product_variant_title=item.get_product_title(),
-            quantity=quantity,
-            order=order,
-        )
-        # order_item.save()
+    subscription_items = subscription.items.select_related('product', *variant_related_fields('product__'))
+    order.add_items((item.product, item.quantity) for item in subscription_items)
+    total = order.items_total
 
     payment_amount = total + shipping_rate
     currency = Configuration.objects.first().currency
     description = 'Payment from {} for order id #{}'.format(subscription.account.email, order.id)
 
     # Create a Stripe payment using the saved PaymentMethod from the subscription
-    stripe.api_key = STRIPE_SECRET_KEY
-
     try:
-        stripe_payment_intent = stripe.PaymentIntent.create(
+        stripe_payment_intent = get_stripe_gateway().request(
+            'payment_intents.create',
             amount=int(math.ceil(payment_amount * 100)),
             currency=currency,
             customer=subscription.account.stripe_customer_id,
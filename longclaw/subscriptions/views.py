@@ -4,7 +4,7 @@ from django.shortcuts import render, redirect
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.generic.base import View, TemplateView
 
-from longclaw.basket.utils import basket_id, get_basket_items, add_to_basket, basket_total
+from longclaw.basket.utils import basket_id, get_basket_items, get_basket_summary, persist_basket, add_to_basket, basket_total
 from longclaw.basket.models import BasketItem
 from longclaw.configuration.models import Configuration
 from longclaw.subscriptions.models import Subscription
@@ -82,13 +82,13 @@ class SubscriptionCreateView(LoginRequiredMixin, TemplateView):
         shipping_address = account.shipping_address
         billing_address = account.billing_address
 
-        items, _ = get_basket_items(self.request)
+        summary, _ = get_basket_summary(self.request)
         shipping_rate = ShippingRate.objects.first()
         if shipping_rate:
             default_shipping_rate = shipping_rate.rate
         else:
             default_shipping_rate = Configuration.objects.first().default_shipping_rate
-        total_price = sum(item.total() for item in items)
+        total_price = summary.subtotal
 
         context = {
             'product_variants': product_variants,
@@ -110,7 +110,9 @@ class SubscriptionCreateView(LoginRequiredMixin, TemplateView):
         except Exception as e:
             raise e
         
-        basket, bid = get_basket_items(request)
+        # Starting a subscription is a checkout, so the basket items need to be
+        # stored in the database for the form to refer to them by id
+        basket, bid = persist_basket(request)
 
         subscription_form = SubscriptionForm()
         if account.active_payment_method:
@@ -2,7 +2,7 @@ import hashlib
 
 from django.utils.encoding import force_bytes, force_text
 from longclaw.shipping.models import ShippingRateProcessor, ShippingRate
-from longclaw.basket.models import BasketItem
+from longclaw.basket.utils import get_basket_backend
 
 
 class TrivialShippingRateProcessor(ShippingRateProcessor):
@@ -10,7 +10,7 @@ class TrivialShippingRateProcessor(ShippingRateProcessor):
         destination = kwargs['destination']
         basket_id = kwargs['basket_id']
         
-        item_count = BasketItem.objects.filter(basket_id=basket_id).count()
+        item_count = len(get_basket_backend().get_items(basket_id))
         
         rates = []
         
@@ -26,19 +26,15 @@ class TrivialShippingRateProcessor(ShippingRateProcessor):
             quotes.append((item_count * 16, 'cheetah'))
         
         for amount, speed in quotes:
-            name = self.get_processed_rate_name(destination, basket_id, speed)
-            lookups = dict(name=name)
-            values = dict(
+            rates.append(ShippingRate(
+                name=self.get_processed_rate_name(destination, basket_id, speed),
                 rate=amount,
                 carrier='TrivialShippingRateProcessor',
                 description='Delivered with {} speed'.format(speed),
                 basket_id=basket_id,
                 destination=destination,
                 processor=self,
-            )
-            
-            rate = ShippingRate.objects.update_or_create(defaults=values, **lookups)
-            rates.append(rate)
+            ))
         
         return rates
     
@@ -1,4 +1,5 @@
 import mock
+from django.core.cache import cache
 
 from longclaw.tests.utils import LongclawTestCase, AddressFactory, CountryFactory, BasketItemFactory
 from longclaw.shipping.models import Address, ShippingRate, ShippingRateProcessor
@@ -7,8 +8,11 @@ from .models import TrivialShippingRateProcessor
 
 
 @mock.patch('longclaw.shipping.api.basket_id', return_value='foo')
+# The processor runs in the test's thread, so it sees the test's transaction
+@mock.patch('longclaw.shipping.utils.SHIPPING_PROCESSOR_WORKERS', 0)
 class TrivialShippingRateProcessorAPITest(LongclawTestCase):
     def setUp(self):
+        cache.clear()
         self.country = CountryFactory()
         self.country.iso = '11'
         self.country.save()
@@ -115,3 +119,23 @@ class TrivialShippingRateProcessorAPITest(LongclawTestCase):
         self.assert_contains_turtle(response)
         self.assert_contains_rabbit(response)
         self.assert_contains_cheetah(response)
+
+    def test_quotes_are_not_saved(self, m1):
+        self.test_one_rate_cost()
+        self.assertFalse(ShippingRate.objects.exists())
+
+    def test_quotes_follow_basket(self, m1):
+        name = self.test_one_rate().data[0]['name']
+        self.add_item_to_basket()
+
+        params = dict(
+            destination=self.address.pk,
+            shipping_rate_name=name,
+        )
+        # The quote was for a basket with one item
+        self.get_test('longclaw_shipping_cost', params=params, success_expected=False)
+
+        response = self.get_test('longclaw_applicable_shipping_rate_list', params={'destination': self.address.pk})
+        self.assertEqual(len(response.data), 2, response.content)
+        response = self.get_test('longclaw_shipping_cost', params=params)
+        self.assertEqual(response.data['rate'], 4)
@@ -12,3 +12,12 @@ def maybe_get_product_model():
         return field.related_model
     except:
         pass
+
+
+def variant_related_fields(prefix=''):
+    """Fields to ``select_related`` so a variant and its product
+    are loaded with the query that fetches them
+    """
+    if maybe_get_product_model():
+        return [prefix + 'product']
+    return []